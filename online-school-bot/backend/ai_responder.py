@@ -3,26 +3,116 @@ from config import Config
 from pdf_processor import PDFProcessor
 from excel_processor import ExcelProcessor
 from spreadsheet import SpreadsheetService
+from vector_store import VectorStore
+from course_index import CourseIndex
+from embedding_cache import QueryEmbeddingCache, embedding_cache_model
 from typing import List, Dict, Optional
-import json
 
 class AIResponder:
     """AI回答生成（教材内容 + ネット検索）"""
     
-    def __init__(self):
+    def __init__(self, pdf_processor: Optional[PDFProcessor] = None,
+                 excel_processor: Optional[ExcelProcessor] = None):
+        """pdf_processor・excel_processorを渡した場合はそれを使う（サーバー内で同じインスタンスを共有する）"""
         self.client = OpenAI(api_key=Config.OPENAI_API_KEY) if Config.OPENAI_API_KEY else None
+        self.pdf_processor = pdf_processor
+        if self.pdf_processor is None:
+            try:
+                self.pdf_processor = PDFProcessor()
+            except:
+                self.pdf_processor = None
+        self.excel_processor = excel_processor
+        if self.excel_processor is None:
+            try:
+                self.excel_processor = ExcelProcessor()
+            except:
+                self.excel_processor = None
         try:
-            self.pdf_processor = PDFProcessor()
+            self.spreadsheet_service = SpreadsheetService()
         except:
-            self.pdf_processor = None
+            self.spreadsheet_service = None
         try:
-            self.excel_processor = ExcelProcessor()
+            self.vector_store = self.pdf_processor.vector_store if self.pdf_processor else VectorStore()
         except:
-            self.excel_processor = None
+            self.vector_store = None
         try:
-            self.spreadsheet_service = SpreadsheetService()
-        except:
-            self.spreadsheet_service = None
+            self.query_cache = QueryEmbeddingCache()
+        except Exception as e:
+            print(f"質問埋め込みキャッシュ初期化エラー: {e}")
+            self.query_cache = None
+    
+    def get_query_embedding(self, user_message: str, dimensions: Optional[int] = None) -> List[float]:
+        """質問文をベクトル化（同じ質問はキャッシュから返す、dimensionsは教材と同じ次元数の指定）"""
+        cache_model = embedding_cache_model(Config.EMBEDDING_MODEL, dimensions)
+        options = {"dimensions": dimensions} if dimensions else {}
+        if self.query_cache:
+            cached = self.query_cache.get(cache_model, user_message)
+            if cached is not None:
+                return cached
+        
+        # 遅い場合はBM25のみの検索に切り替えるため、タイムアウトを短くしリトライしない
+        embedding = self.client.with_options(
+            timeout=Config.QUERY_EMBEDDING_TIMEOUT_SECONDS, max_retries=0
+        ).embeddings.create(
+            model=Config.EMBEDDING_MODEL,
+            input=[user_message],
+            **options
+        ).data[0].embedding
+        
+        if self.query_cache:
+            try:
+                self.query_cache.put(cache_model, user_message, embedding)
+            except Exception as e:
+                print(f"質問埋め込みキャッシュ保存エラー: {e}")
+        return embedding
+    
+    def search_lexical(self, course_index: CourseIndex, user_message: str, top_k: int = 5,
+                       material_names: Optional[List[str]] = None) -> List[Dict]:
+        """BM25だけで教材を検索"""
+        return course_index.search(
+            None, top_k=top_k, query_text=user_message, min_lexical_score=Config.LEXICAL_MIN_SCORE,
+            material_names=material_names
+        )
+    
+    def search_hybrid(self, course_index: CourseIndex, user_message: str, top_k: int,
+                      material_names: Optional[List[str]], lexical_chunks: List[Dict]) -> List[Dict]:
+        """質問をベクトル化してハイブリッド検索（ベクトル化に失敗したらBM25の結果を返す）"""
+        try:
+            query_embedding = self.get_query_embedding(user_message, course_index.embedding_dimensions)
+        except Exception as e:
+            print(f"質問のベクトル化エラー（BM25のみで検索）: {e}")
+            return lexical_chunks
+        
+        return course_index.search(
+            query_embedding, top_k=top_k, min_similarity=0.7,
+            query_text=user_message, min_lexical_score=Config.LEXICAL_MIN_SCORE,
+            material_names=material_names
+        )
+    
+    def search_course(self, course_id: str, user_message: str, top_k: int = 5) -> List[Dict]:
+        """コースの教材と、コースに追加された共有ライブラリの教材を検索して結果をまとめる
+        
+        BM25で質問の語がほぼすべて一致した場合（講座コードや関数名など）は埋め込みAPIを呼ばずに返し、
+        埋め込みの取得に失敗・タイムアウトした場合もBM25の結果だけで回答する。
+        スコアの種類をそろえるため、BM25だけで返すかどうかは両方のBM25の結果を見てまとめて決める。
+        質問のベクトルはインデックスごとの次元数で取得する（同じ次元数ならキャッシュから返る）。
+        """
+        targets = []
+        course_index = CourseIndex.get(self.vector_store, course_id)
+        if course_index:
+            targets.append((course_index, None))
+        library = CourseIndex.get_library(self.vector_store, course_id)
+        if library:
+            targets.append(library)
+        
+        lexical_lists = [self.search_lexical(index, user_message, top_k, names) for index, names in targets]
+        if any(chunks and chunks[0]["lexical_score"] >= Config.LEXICAL_FAST_PATH_SCORE for chunks in lexical_lists):
+            return CourseIndex.merge_results(lexical_lists, top_k)
+        result_lists = [
+            self.search_hybrid(index, user_message, top_k, names, lexical_chunks)
+            for (index, names), lexical_chunks in zip(targets, lexical_lists)
+        ]
+        return CourseIndex.merge_results(result_lists, top_k)
     
     def search_web(self, query: str) -> Optional[str]:
         """ネット検索（OpenAIの関数呼び出し機能を使用）"""
@@ -38,62 +128,13 @@ class AIResponder:
         if not self.client:
             return "申し訳ございません。AIサービスが利用できません。"
         
-        # 教材から関連情報を検索（PDF、Excel、CSV、スプレッドシートすべてから）
+        # 教材から関連情報を検索
         relevant_chunks = []
         try:
-            # ユーザーの質問をベクトル化
-            query_embedding = self.client.embeddings.create(
-                model=Config.EMBEDDING_MODEL,
-                input=[user_message]
-            ).data[0].embedding
-            
-            # PDFから検索
-            if self.pdf_processor:
-                try:
-                    similar_chunks = self.pdf_processor.search_similar_chunks(
-                        query_embedding, course_id, top_k=5
-                    )
-                    relevant_chunks.extend([chunk["chunk"] for chunk in similar_chunks if chunk["similarity"] > 0.7])
-                except Exception as e:
-                    print(f"PDF検索エラー: {e}")
-            
-            # Excel/CSVから検索
-            if self.excel_processor:
-                try:
-                    similar_chunks = self.excel_processor.search_similar_chunks(
-                        query_embedding, course_id, top_k=5
-                    )
-                    relevant_chunks.extend([chunk["chunk"] for chunk in similar_chunks if chunk["similarity"] > 0.7])
-                except Exception as e:
-                    print(f"Excel/CSV検索エラー: {e}")
-            
-            # スプレッドシートから検索（リアルタイム読み込み）
-            if self.excel_processor:
-                try:
-                    # スプレッドシートのベクトルファイルを検索
-                    from pathlib import Path
-                    vector_dir = Config.VECTOR_STORAGE_DIR
-                    spreadsheet_files = list(vector_dir.glob(f"{course_id}_spreadsheet_*.json"))
-                    
-                    for spreadsheet_file in spreadsheet_files:
-                        with open(spreadsheet_file, "r", encoding="utf-8") as f:
-                            data = json.load(f)
-                            if "embeddings" in data and "chunks" in data:
-                                # コサイン類似度を計算
-                                import numpy as np
-                                query_vec = np.array(query_embedding)
-                                similarities = []
-                                
-                                for i, emb in enumerate(data["embeddings"]):
-                                    emb_vec = np.array(emb)
-                                    similarity = np.dot(query_vec, emb_vec) / (np.linalg.norm(query_vec) * np.linalg.norm(emb_vec))
-                                    if similarity > 0.7:
-                                        similarities.append((similarity, i, data["chunks"][i]))
-                                
-                                similarities.sort(reverse=True, key=lambda x: x[0])
-                                relevant_chunks.extend([chunk for _, _, chunk in similarities[:5]])
-                except Exception as e:
-                    print(f"スプレッドシート検索エラー: {e}")
+            # コース内の全教材（PDF、Excel、CSV、スプレッドシート）と共有ライブラリの教材を検索
+            if self.vector_store:
+                similar_chunks = self.search_course(course_id, user_message)
+                relevant_chunks.extend([chunk["chunk"] for chunk in similar_chunks])
                     
         except Exception as e:
             print(f"教材検索エラー: {e}")
@@ -0,0 +1,111 @@
+import numpy as np
+from pathlib import Path
+from typing import Dict, Optional
+import json
+from atomic_files import atomic_write
+
+class IVFIndex:
+    """IVF-flat方式の近似最近傍インデックス（NumPy実装）
+
+    正規化済みベクトルを球面k-meansでnlist個のリストに振り分け、
+    検索時はクエリに近いnprobe個のリストの中だけを総当たりで採点する。
+    nprobeを大きくするほど再現率が上がり、遅くなる。
+    """
+
+    def __init__(self, centroids: np.ndarray, order: np.ndarray, list_offsets: np.ndarray, info: Dict):
+        self.centroids = centroids
+        self.order = order
+        self.list_offsets = list_offsets
+        self.info = info
+
+    @property
+    def nlist(self) -> int:
+        return int(self.centroids.shape[0])
+
+    @staticmethod
+    def default_nlist(count: int) -> int:
+        """チャンク数から標準的なリスト数（およそ√n）を決める"""
+        return int(max(1, min(4096, round(np.sqrt(count)))))
+
+    @staticmethod
+    def _assign(matrix: np.ndarray, centroids: np.ndarray, batch_size: int = 8192) -> np.ndarray:
+        """各行を最も近い（内積が最大の）セントロイドに割り当てる"""
+        assignments = np.empty(matrix.shape[0], dtype=np.int32)
+        for start in range(0, matrix.shape[0], batch_size):
+            batch = np.asarray(matrix[start:start + batch_size], dtype=np.float32)
+            assignments[start:start + batch_size] = np.argmax(batch @ centroids.T, axis=1)
+        return assignments
+
+    @classmethod
+    def build(cls, matrix: np.ndarray, nlist: Optional[int] = None, iterations: int = 10,
+              sample_per_list: int = 64, seed: int = 0) -> "IVFIndex":
+        """正規化済み行列からインデックスを構築"""
+        count = matrix.shape[0]
+        nlist = min(nlist or cls.default_nlist(count), count)
+        rng = np.random.default_rng(seed)
+
+        # 学習はサンプルで行い、全件の割り当ては最後に1回だけ行う
+        sample_size = min(count, nlist * sample_per_list)
+        sample_rows = np.sort(rng.choice(count, size=sample_size, replace=False))
+        sample = np.asarray(matrix[sample_rows], dtype=np.float32)
+        centroids = sample[rng.choice(sample_size, size=nlist, replace=False)].copy()
+
+        for _ in range(iterations):
+            assignments = cls._assign(sample, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, sample)
+            sizes = np.bincount(assignments, minlength=nlist)
+            # 空のリストはランダムな点で埋め直す
+            empty = sizes == 0
+            if empty.any():
+                sums[empty] = sample[rng.choice(sample_size, size=int(empty.sum()))]
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            centroids = (sums / norms).astype(np.float32)
+
+        assignments = cls._assign(matrix, centroids)
+        order = np.argsort(assignments, kind="stable").astype(np.int64)
+        sizes = np.bincount(assignments, minlength=nlist)
+        list_offsets = np.concatenate(([0], np.cumsum(sizes))).astype(np.int64)
+        info = {"count": int(count), "nlist": int(nlist), "iterations": iterations}
+        return cls(centroids, order, list_offsets, info)
+
+    def candidates(self, query_vec: np.ndarray, nprobe: int) -> np.ndarray:
+        """クエリに近いnprobe個のリストに含まれる行番号を返す"""
+        nprobe = max(1, min(nprobe, self.nlist))
+        centroid_scores = self.centroids @ query_vec
+        if nprobe < self.nlist:
+            lists = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+        else:
+            lists = np.arange(self.nlist)
+        return np.concatenate([
+            self.order[self.list_offsets[i]:self.list_offsets[i + 1]] for i in lists
+        ])
+
+    def save(self, path: Path):
+        """インデックスを保存（一時ファイルに書いてfsyncしてから置き換え）"""
+        with atomic_write(path) as f:
+            np.savez(
+                f,
+                centroids=self.centroids,
+                order=self.order,
+                list_offsets=self.list_offsets,
+                info=np.array(json.dumps(self.info, ensure_ascii=False))
+            )
+
+    @classmethod
+    def load(cls, path: Path) -> Optional["IVFIndex"]:
+        """保存済みインデックスを読み込み"""
+        if not path.exists():
+            return None
+        with np.load(path) as data:
+            return cls(
+                data["centroids"],
+                data["order"],
+                data["list_offsets"],
+                json.loads(str(data["info"]))
+            )
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.centroids.nbytes + self.order.nbytes + self.list_offsets.nbytes)
@@ -0,0 +1,58 @@
+from contextlib import contextmanager
+from pathlib import Path
+from typing import IO, Iterator
+import os
+import shutil
+import uuid
+
+def fsync_dir(path: Path):
+    """ディレクトリのエントリ（名前の置き換え）をディスクに反映（対応していないOSでは何もしない）"""
+    try:
+        fd = os.open(str(path), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+@contextmanager
+def atomic_write(path: Path, mode: str = "wb", encoding: str = None) -> Iterator[IO]:
+    """一時ファイルに書き、fsyncしてから本来の名前に置き換える
+
+    読む側は置き換え前か後のどちらかの完全なファイルだけを見る（書きかけのファイルは見えない）。
+    一時ファイル名は書き込みごとに変えるので、同じファイルを同時に書いても混ざらない。
+    途中で例外が起きた場合は一時ファイルを消し、元のファイルはそのまま残る。
+    """
+    path = Path(path)
+    tmp_path = path.with_name(f"{path.name}.{uuid.uuid4().hex[:8]}.tmp")
+    try:
+        with open(tmp_path, mode, encoding=encoding) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if tmp_path.exists():
+            tmp_path.unlink()
+        raise
+    fsync_dir(path.parent)
+
+def place_file(src: Path, dest: Path, move: bool = True) -> Path:
+    """ファイルを保存先へ置く（.partに移動・コピーしてから置き換えるので、書きかけの保存先は見えない）"""
+    src, dest = Path(src), Path(dest)
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    part_path = dest.parent / f".{dest.name}.{uuid.uuid4().hex}.part"
+    try:
+        if move:
+            shutil.move(str(src), str(part_path))
+        else:
+            shutil.copy2(src, part_path)
+        os.replace(part_path, dest)
+    finally:
+        if part_path.exists():
+            part_path.unlink()
+    fsync_dir(dest.parent)
+    return dest
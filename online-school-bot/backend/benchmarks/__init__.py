@@ -0,0 +1 @@
+# オフラインで実行できるベンチマーク（cd backend && python -m benchmarks.<name>）
@@ -0,0 +1,67 @@
+"""
+チャンク分割のスループット計測
+
+    cd backend
+    python -m benchmarks.chunker --pages 500
+    python -m benchmarks.chunker --pdf path/to/material.pdf
+"""
+import argparse
+import random
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from text_chunker import TextChunker
+
+_WORDS = ["課題", "提出", "期限", "講義", "資料", "マーケティング", "SNS運用", "分析", "データ",
+          "SEO", "キーワード", "コンテンツ", "改善", "施策", "目標", "KPI", "顧客", "投稿"]
+
+def synthetic_pages(pages: int, chars_per_page: int = 1800, seed: int = 0):
+    """日本語の教材風のページを生成"""
+    rng = random.Random(seed)
+    result = []
+    for _ in range(pages):
+        sentences = []
+        length = 0
+        while length < chars_per_page:
+            sentence = "の".join(rng.choice(_WORDS) for _ in range(rng.randint(3, 12)))
+            sentence += rng.choice(["です。", "します。", "ですか？", "！", "\n"])
+            sentences.append(sentence)
+            length += len(sentence)
+        result.append("".join(sentences))
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="チャンク分割のスループット計測")
+    parser.add_argument("--pages", type=int, default=500, help="生成するページ数")
+    parser.add_argument("--pdf", help="実際のPDFで計測する場合のパス")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.pdf:
+        from pdf_processor import PDFProcessor
+        pages = PDFProcessor().extract_pages(args.pdf)
+    else:
+        pages = synthetic_pages(args.pages)
+    total_chars = sum(len(p) for p in pages)
+
+    chunker = TextChunker()
+    timings = []
+    for _ in range(args.repeat):
+        started = time.perf_counter()
+        chunks, _ = chunker.split_segments(({"page": i + 1}, p + "\n") for i, p in enumerate(pages))
+        timings.append(time.perf_counter() - started)
+
+    best = min(timings)
+    token_counts = [chunker.count_tokens(c) for c in chunks]
+    print(f"ページ数: {len(pages)}  文字数: {total_chars:,}")
+    print(f"チャンク数: {len(chunks)}  上限: {chunker.max_tokens}トークン  オーバーラップ: {chunker.overlap_tokens}トークン")
+    print(f"所要時間: {best:.3f}秒  ({len(pages) / best:,.0f}ページ/秒, {total_chars / best / 1e6:.2f}M文字/秒)")
+    print(f"チャンクのトークン数: 平均 {statistics.mean(token_counts):.0f} / "
+          f"標準偏差 {statistics.pstdev(token_counts):.0f} / 最小 {min(token_counts)} / 最大 {max(token_counts)}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+"""
+検索のレイテンシ計測（合成コース・ランダムベクトルでオフライン実行）
+
+    cd backend
+    python -m benchmarks.retrieval --chunks 1000,10000,100000
+    python -m benchmarks.retrieval --chunks 50000 --dim 1536 --queries 500 --ann on --quantize
+
+コースサイズごとに別プロセスで実行し、インデックスの読み込み時間と
+PDFProcessor / ExcelProcessor（種類を絞ったハイブリッド検索）、AIResponder.search_course
+（回答時の経路: スプレッドシートを含む全教材と、コースに追加した共有ライブラリのハイブリッド検索・統合）の
+検索レイテンシ（p50/p95/p99）、ピークRSSを表示する。埋め込みAPIは呼ばない。
+"""
+import argparse
+import json
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from benchmarks.chunker import _WORDS
+from config import Config
+
+# 合成コースの教材の種類と割合
+_SOURCE_MIX = [("pdf", 0.5), ("excel", 0.2), ("csv", 0.1), ("spreadsheet", 0.2)]
+
+def peak_rss_mb() -> float:
+    """このプロセスのピークRSS（MB、Linuxはキロバイト・macOSはバイト単位で返る）"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def percentiles(timings) -> dict:
+    ms = np.asarray(timings) * 1000
+    return {
+        "p50": round(float(np.percentile(ms, 50)), 3),
+        "p95": round(float(np.percentile(ms, 95)), 3),
+        "p99": round(float(np.percentile(ms, 99)), 3),
+        "mean": round(float(ms.mean()), 3)
+    }
+
+def synthetic_chunk(rng: random.Random, words: int) -> str:
+    """教材のチャンク風のテキスト"""
+    return "の".join(rng.choice(_WORDS) for _ in range(words)) + "です。"
+
+def build_course(vector_store, course_id: str, chunk_count: int, dim: int,
+                 chunks_per_material: int, seed: int = 0):
+    """合成コースを保存（教材ごとにランダムな正規化ベクトルと日本語風テキスト）"""
+    rng = random.Random(seed)
+    np_rng = np.random.default_rng(seed)
+    material = 0
+    for source_type, ratio in _SOURCE_MIX:
+        remaining = int(chunk_count * ratio) if source_type != "spreadsheet" else \
+            chunk_count - sum(int(chunk_count * r) for t, r in _SOURCE_MIX if t != "spreadsheet")
+        while remaining > 0:
+            count = min(chunks_per_material, remaining)
+            chunks = [synthetic_chunk(rng, rng.randint(20, 80)) for _ in range(count)]
+            embeddings = np_rng.standard_normal((count, dim), dtype=np.float32)
+            name = f"{course_id}_bench{material:04d}"
+            info = {"course_id": course_id, "source_type": source_type,
+                    "metadata": {"filename": f"bench{material:04d}", "chunk_count": count}}
+            if source_type == "spreadsheet":
+                info["spreadsheet_id"] = f"bench{material:04d}"
+                name = f"{course_id}_spreadsheet_bench{material:04d}"
+            elif source_type != "pdf":
+                info["file_type"] = source_type
+                name += f"_{source_type}"
+            vector_store.save(name, chunks, embeddings, info)
+            remaining -= count
+            material += 1
+    return material
+
+class _OfflineEmbeddings:
+    """質問のベクトル化をランダムベクトルで代用（AIResponderの検索経路を外部APIなしで通す）"""
+
+    def __init__(self, dim: int, seed: int = 0):
+        self.dim = dim
+        self.rng = np.random.default_rng(seed)
+
+    def create(self, model, input, dimensions=None):
+        data = [type("Embedding", (), {"embedding": self.rng.standard_normal(dimensions or self.dim).tolist()})
+                for _ in input]
+        return type("Response", (), {"data": data})
+
+class _OfflineClient:
+    def __init__(self, dim: int):
+        self.embeddings = _OfflineEmbeddings(dim)
+
+    def with_options(self, **kwargs):
+        return self
+
+def run_size(args) -> dict:
+    """1つのコースサイズを計測（Configの保存先は一時ディレクトリに向ける）"""
+    from pdf_processor import PDFProcessor
+    from excel_processor import ExcelProcessor
+    from ai_responder import AIResponder
+    from course_index import CourseIndex
+    from index_cache import course_index_cache
+
+    work_dir = Path(tempfile.mkdtemp(prefix="retrieval-bench-"))
+    Config.VECTOR_STORAGE_DIR = work_dir / "vectors"
+    Config.PDF_STORAGE_DIR = work_dir / "pdfs"
+    Config.CACHE_DIR = work_dir / "cache"
+    Config.QUANTIZE_INT8 = args.quantize
+
+    try:
+        pdf_processor = PDFProcessor()
+        excel_processor = ExcelProcessor()
+        ai_responder = AIResponder(pdf_processor, excel_processor)
+        return _measure(args, pdf_processor, excel_processor, ai_responder, CourseIndex, course_index_cache)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def _measure(args, pdf_processor, excel_processor, ai_responder, CourseIndex, course_index_cache) -> dict:
+    vector_store = pdf_processor.vector_store
+    course_id = "bench"
+
+    started = time.perf_counter()
+    materials = build_course(vector_store, course_id, args.chunks, args.dim, args.chunks_per_material)
+    # 共有ライブラリの教材をコースに追加（search_courseはコースとライブラリの結果をまとめる）
+    library_names = []
+    if args.library_chunks:
+        build_course(vector_store, Config.LIBRARY_ID, args.library_chunks, args.dim,
+                     args.chunks_per_material, seed=1)
+        library_names = sorted(vector_store.list_names(f"{Config.LIBRARY_ID}_*"))
+    for target in [course_id] + ([Config.LIBRARY_ID] if library_names else []):
+        settings = vector_store.load_search_settings(target)
+        settings.update({"ann": args.ann, "quantize": args.quantize})
+        if target == course_id and library_names:
+            settings["library_materials"] = library_names
+        vector_store.save_search_settings(target, settings)
+    ann = CourseIndex.rebuild_ann(vector_store, course_id)
+    if library_names:
+        CourseIndex.rebuild_ann(vector_store, Config.LIBRARY_ID)
+    build_seconds = time.perf_counter() - started
+
+    # 読み込み（キャッシュを空にしてから）
+    load_timings = []
+    for _ in range(args.load_repeat):
+        course_index_cache.invalidate(course_id)
+        started = time.perf_counter()
+        course_index = pdf_processor.load_vectors(course_id)
+        load_timings.append(time.perf_counter() - started)
+
+    ai_responder.client = _OfflineClient(args.dim)
+    ai_responder.query_cache = None
+
+    rng = random.Random(1)
+    np_rng = np.random.default_rng(1)
+    queries = [np_rng.standard_normal(args.dim).tolist() for _ in range(args.queries)]
+    query_texts = [synthetic_chunk(rng, rng.randint(3, 8)) for _ in range(args.queries)]
+
+    paths = {
+        "pdf": lambda i: pdf_processor.search_similar_chunks(
+            queries[i], course_id, args.top_k, query_text=query_texts[i]
+        ),
+        "excel": lambda i: excel_processor.search_similar_chunks(
+            queries[i], course_id, args.top_k, query_text=query_texts[i]
+        ),
+        "search_course": lambda i: ai_responder.search_course(course_id, query_texts[i], args.top_k)
+    }
+    search = {}
+    for label, run in paths.items():
+        for i in range(min(args.warmup, args.queries)):
+            run(i)
+        timings = []
+        for i in range(args.queries):
+            started = time.perf_counter()
+            run(i)
+            timings.append(time.perf_counter() - started)
+        search[label] = percentiles(timings)
+
+    return {
+        "chunks": course_index.chunk_count,
+        "materials": materials,
+        "library_chunks": args.library_chunks,
+        "dim": args.dim,
+        "ann": ann is not None,
+        "quantize": args.quantize,
+        "build_seconds": round(build_seconds, 3),
+        "load_ms": percentiles(load_timings),
+        "index_mb": round(course_index.nbytes / (1024 * 1024), 1),
+        "search_ms": search,
+        "peak_rss_mb": round(peak_rss_mb(), 1)
+    }
+
+def print_report(results):
+    print(f"{'チャンク数':>10} {'次元':>5} {'ANN':>4} {'読込p50':>9} {'索引MB':>8} {'ピークRSS':>10}  "
+          f"{'経路':<13}{'p50':>9}{'p95':>9}{'p99':>9}  (ms)")
+    for r in results:
+        first = True
+        for label, t in r["search_ms"].items():
+            head = (f"{r['chunks']:>10,} {r['dim']:>5} {'on' if r['ann'] else 'off':>4} "
+                    f"{r['load_ms']['p50']:>9.1f} {r['index_mb']:>8.1f} {r['peak_rss_mb']:>10.1f}") if first \
+                else " " * 52
+            print(f"{head}  {label:<13}{t['p50']:>9.3f}{t['p95']:>9.3f}{t['p99']:>9.3f}")
+            first = False
+
+def main():
+    parser = argparse.ArgumentParser(description="検索のレイテンシ計測（合成コース）")
+    parser.add_argument("--chunks", default="1000,10000,50000", help="コースのチャンク数（カンマ区切りで複数）")
+    parser.add_argument("--dim", type=int, default=1536, help="埋め込みの次元数")
+    parser.add_argument("--queries", type=int, default=200, help="経路ごとの検索回数")
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--load-repeat", type=int, default=3, help="インデックス読み込みの計測回数")
+    parser.add_argument("--chunks-per-material", type=int, default=2000, help="1教材あたりのチャンク数")
+    parser.add_argument("--ann", choices=["auto", "on", "off"], default="auto")
+    parser.add_argument("--quantize", action="store_true", help="int8量子化 + float32再ランキング")
+    parser.add_argument("--library-chunks", type=int, default=1000,
+                        help="コースに追加する共有ライブラリのチャンク数（0で追加しない）")
+    parser.add_argument("--json", action="store_true", help="結果をJSONで出力")
+    args = parser.parse_args()
+
+    sizes = [int(s) for s in args.chunks.split(",") if s.strip()]
+    if len(sizes) == 1:
+        args.chunks = sizes[0]
+        results = [run_size(args)]
+    else:
+        # ピークRSSがサイズごとに分かれるよう、1サイズずつ別プロセスで計測する
+        results = []
+        for size in sizes:
+            argv = [a for a in sys.argv[1:] if a != "--json"]
+            if "--chunks" in argv:
+                index = argv.index("--chunks")
+                del argv[index:index + 2]
+            argv = [a for a in argv if not a.startswith("--chunks=")]
+            output = subprocess.run(
+                [sys.executable, "-m", "benchmarks.retrieval", "--chunks", str(size), "--json"] + argv,
+                cwd=str(Path(__file__).parent.parent), capture_output=True, text=True, check=True
+            ).stdout
+            results.append(json.loads(output.strip().splitlines()[-1]))
+
+    if args.json:
+        print(json.dumps(results[0] if len(results) == 1 else results, ensure_ascii=False))
+    else:
+        print_report(results)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+import os
+import threading
+import time
+import zipfile
+from config import Config
+from course_index import CourseIndex
+from extraction_cache import file_sha256
+from material_library import MaterialLibrary
+from uploads import safe_filename
+
+# 拡張子から判定する教材の種類
+_SUFFIX_TYPES = {".pdf": "pdf", ".xlsx": "excel", ".xlsm": "excel", ".xls": "excel", ".csv": "csv"}
+# 先頭バイト（PDF、xlsx（zip）、xls（OLE））
+_PDF_MAGIC = b"%PDF"
+_ZIP_MAGIC = b"PK\x03\x04"
+_OLE_MAGIC = b"\xd0\xcf\x11\xe0"
+
+class BulkIngestion:
+    """zipやサーバー上のフォルダに入った教材をまとめて取り込む
+
+    種類は拡張子と先頭バイトで判定し、同じ内容（SHA-256）のファイルは1回だけ取り込む。
+    コースに取り込み済みの内容もforceを指定しない限り飛ばし、共有ライブラリにある内容は
+    取り込まずにライブラリの教材をコースに追加する。
+    各ファイルはPDFProcessor / ExcelProcessorで並列に処理し、コースのバージョン更新と
+    近似最近傍インデックスの再構築はファイルごとではなく最後に1回だけ行う。結果はファイルごとの状態の一覧で返す。
+    """
+
+    def __init__(self, pdf_processor, excel_processor, max_workers: Optional[int] = None):
+        self.pdf_processor = pdf_processor
+        self.excel_processor = excel_processor
+        self.vector_store = pdf_processor.vector_store
+        self.max_workers = max_workers or Config.BULK_INGESTION_WORKERS
+
+    @staticmethod
+    def detect_type(path: Path) -> Optional[str]:
+        """教材の種類（pdf/excel/csv、取り込めないものはNone）"""
+        with open(path, "rb") as f:
+            head = f.read(8)
+        if head.startswith(_PDF_MAGIC):
+            return "pdf"
+        file_type = _SUFFIX_TYPES.get(path.suffix.lower())
+        if file_type == "excel" and (head.startswith(_ZIP_MAGIC) or head.startswith(_OLE_MAGIC)):
+            return "excel"
+        if file_type == "csv":
+            return "csv"
+        return None
+
+    @staticmethod
+    def _is_hidden(parts) -> bool:
+        # .DS_Storeや__MACOSXなど、OSが作るファイルは取り込まない
+        return any(part.startswith(".") or part == "__MACOSX" for part in parts)
+
+    @staticmethod
+    def _member_name(info: zipfile.ZipInfo) -> str:
+        """zip内のファイル名（UTF-8フラグのないWindowsのzipはCP932として読む）"""
+        if info.flag_bits & 0x800:
+            return info.filename
+        try:
+            return info.filename.encode("cp437").decode("cp932")
+        except UnicodeError:
+            return info.filename
+
+    def unpack_zip(self, zip_path: Path, staging_dir: Path) -> List[Dict]:
+        """zipを一時ディレクトリに展開（ファイル数・展開後の合計サイズに上限あり、zip外への展開はしない）"""
+        entries = []
+        extracted_bytes = 0
+        try:
+            archive = zipfile.ZipFile(zip_path)
+        except zipfile.BadZipFile:
+            raise Exception("zipファイルを読み込めません")
+        with archive:
+            members = [info for info in archive.infolist() if not info.is_dir()]
+            members = [info for info in members
+                       if not self._is_hidden(Path(self._member_name(info)).parts)]
+            if len(members) > Config.BULK_MAX_FILES:
+                raise Exception(f"zip内のファイル数が上限（{Config.BULK_MAX_FILES}）を超えています")
+            for i, info in enumerate(members):
+                name = self._member_name(info)
+                # ファイル名だけを使うので、../や絶対パスを含んでいても展開先の外には書かない
+                dest_dir = staging_dir / f"{i:05d}"
+                dest_dir.mkdir(parents=True, exist_ok=True)
+                dest = dest_dir / safe_filename(name)
+                with archive.open(info) as src, open(dest, "wb") as f:
+                    while True:
+                        block = src.read(Config.UPLOAD_CHUNK_BYTES)
+                        if not block:
+                            break
+                        # ヘッダーのサイズは偽れるので、実際に書いたバイト数で判定する
+                        extracted_bytes += len(block)
+                        if extracted_bytes > Config.BULK_MAX_EXTRACTED_BYTES:
+                            raise Exception(
+                                f"展開後のサイズが上限（{Config.BULK_MAX_EXTRACTED_BYTES // (1024 * 1024)}MB）を超えています"
+                            )
+                        f.write(block)
+                entries.append({"name": name, "path": dest, "move": True})
+        return entries
+
+    @staticmethod
+    def resolve_folder(folder: str) -> Path:
+        """取り込むフォルダのパス（BULK_IMPORT_ROOTの中だけ許可、相対パスはその中からの位置）"""
+        if not Config.BULK_IMPORT_ROOT:
+            raise Exception("フォルダからの取り込みは無効です（BULK_IMPORT_ROOTが設定されていません）")
+        root = Path(Config.BULK_IMPORT_ROOT).resolve()
+        path = (root / folder).resolve()
+        if path != root and root not in path.parents:
+            raise Exception("許可されていないフォルダです")
+        if not path.is_dir():
+            raise Exception(f"フォルダが見つかりません: {folder}")
+        return path
+
+    def list_folder(self, folder: Path) -> List[Dict]:
+        """フォルダ内（サブフォルダを含む）のファイル一覧"""
+        root = Path(Config.BULK_IMPORT_ROOT).resolve() if Config.BULK_IMPORT_ROOT else folder
+        entries = []
+        for path in sorted(folder.rglob("*")):
+            relative = path.relative_to(folder)
+            if not path.is_file() or self._is_hidden(relative.parts):
+                continue
+            # フォルダ外を指すシンボリックリンクは読まない
+            resolved = path.resolve()
+            if resolved != root and root not in resolved.parents:
+                continue
+            entries.append({"name": str(relative), "path": path, "move": False})
+        if len(entries) > Config.BULK_MAX_FILES:
+            raise Exception(f"フォルダ内のファイル数が上限（{Config.BULK_MAX_FILES}）を超えています")
+        return entries
+
+    def existing_hashes(self, course_id: str) -> Dict[str, str]:
+        """コースに取り込み済みの教材（ファイル内容のSHA-256 → 保存名）"""
+        hashes = {}
+        for name in self.vector_store.list_names(f"{course_id}_*"):
+            data = self.vector_store.load(name)
+            if not data or data.get("course_id") != course_id:
+                continue
+            sha256 = data.get("metadata", {}).get("sha256")
+            if sha256:
+                hashes.setdefault(sha256, name)
+        return hashes
+
+    @staticmethod
+    def vector_name(course_id: str, filename: str, file_type: str) -> str:
+        """取り込み後の教材名（PDFProcessor / ExcelProcessorと同じ規則）"""
+        stem = Path(filename).stem
+        return f"{course_id}_{stem}" if file_type == "pdf" else f"{course_id}_{stem}_{file_type}"
+
+    def ingest(self, course_id: str, entries: List[Dict], force: bool = False,
+               progress: Optional[Callable] = None) -> Dict:
+        """ファイルをまとめて取り込み、ファイルごとの結果を返す（progressの処理数はファイル数）"""
+        started = time.perf_counter()
+        existing = {} if force else self.existing_hashes(course_id)
+        library = {} if force or course_id == Config.LIBRARY_ID else self.existing_hashes(Config.LIBRARY_ID)
+        library_names = []
+        files = []
+        tasks = []
+        seen: Dict[str, str] = {}
+        claimed = set()
+        for entry in entries:
+            item = {"name": entry["name"], "size": entry["path"].stat().st_size}
+            files.append(item)
+            try:
+                file_type = self.detect_type(entry["path"])
+            except OSError as e:
+                item.update({"status": "failed", "error": str(e)})
+                continue
+            if file_type is None:
+                item["status"] = "unsupported"
+                continue
+            sha256 = file_sha256(entry["path"])
+            item.update({"type": file_type, "sha256": sha256})
+            if sha256 in seen:
+                item.update({"status": "duplicate", "duplicate_of": seen[sha256]})
+                continue
+            seen[sha256] = entry["name"]
+            if sha256 in existing:
+                item.update({"status": "unchanged", "duplicate_of": existing[sha256]})
+                continue
+            if sha256 in library:
+                item.update({"status": "library", "duplicate_of": library[sha256]})
+                library_names.append(library[sha256])
+                continue
+
+            # 別のフォルダにある同名のファイルや、a.xlsxとa.xlsのように教材名が同じになるファイルは
+            # 並列に保存したときに上書きし合わないよう名前を変える
+            filename = safe_filename(Path(entry["name"]).name)
+            keys = (filename.lower(), self.vector_name(course_id, filename, file_type).lower())
+            if any(key in claimed for key in keys):
+                stem, suffix = os.path.splitext(filename)
+                filename = f"{stem}_{sha256[:8]}{suffix}"
+                keys = (filename.lower(), self.vector_name(course_id, filename, file_type).lower())
+            claimed.update(keys)
+            item.update({"status": "queued", "filename": filename})
+            tasks.append((item, entry))
+
+        total = len(tasks)
+        done = 0
+        lock = threading.Lock()
+        if progress:
+            progress("ingesting", 0, total)
+
+        def run(task):
+            nonlocal done
+            item, entry = task
+            file_started = time.perf_counter()
+            try:
+                # 元ファイルはベクトルの保存後にコースのディレクトリへ置かれる（zipから展開したものは移動）
+                if item["type"] == "pdf":
+                    result = self.pdf_processor.process_pdf(
+                        str(entry["path"]), course_id, None, item["sha256"], rebuild_index=False,
+                        filename=item["filename"], move_source=entry["move"]
+                    )
+                else:
+                    result = self.excel_processor.process_file(
+                        str(entry["path"]), course_id, item["type"], None, item["sha256"], rebuild_index=False,
+                        filename=item["filename"], move_source=entry["move"]
+                    )
+                item.update({
+                    "status": "ingested",
+                    "vector_file": result["vector_file"],
+                    "chunk_count": result["chunk_count"],
+                    "embeddings": result["embeddings"]
+                })
+            except Exception as e:
+                print(f"一括取り込みエラー ({course_id} {entry['name']}): {e}")
+                item.update({"status": "failed", "error": str(e)})
+            item["seconds"] = round(time.perf_counter() - file_started, 3)
+            with lock:
+                done += 1
+                if progress:
+                    progress("ingesting", done, total)
+
+        if tasks:
+            with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="bulk-ingestion") as executor:
+                list(executor.map(run, tasks))
+
+        if library_names:
+            MaterialLibrary(self.vector_store).attach(course_id, library_names)
+
+        # 教材ごとではなく、最後に1回だけコースのバージョンを上げてインデックスを作り直す
+        ann = None
+        if any(item["status"] == "ingested" for item in files):
+            if progress:
+                progress("indexing")
+            self.vector_store.bump_version(course_id)
+            ann = CourseIndex.rebuild_ann(self.vector_store, course_id)
+
+        return {
+            "course_id": course_id,
+            "summary": dict(Counter(item["status"] for item in files)),
+            "chunk_count": sum(item.get("chunk_count", 0) for item in files),
+            "ann": ann,
+            "files": files,
+            "seconds": round(time.perf_counter() - started, 3)
+        }
+
+    def ingest_zip(self, course_id: str, zip_path: Path, staging_dir: Path, force: bool = False,
+                   progress: Optional[Callable] = None) -> Dict:
+        """zipを展開して取り込む"""
+        if progress:
+            progress("unpacking")
+        entries = self.unpack_zip(zip_path, staging_dir / "files")
+        zip_path.unlink()
+        return self.ingest(course_id, entries, force, progress)
+
+    def ingest_folder(self, course_id: str, folder: Path, force: bool = False,
+                      progress: Optional[Callable] = None) -> Dict:
+        """サーバー上のフォルダの教材を取り込む（元のファイルはコピーし、移動しない）"""
+        return self.ingest(course_id, self.list_folder(folder), force, progress)
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+ベクトル保存ディレクトリを整理するスクリプト
+
+    python compact_vectors.py              # 全コース
+    python compact_vectors.py --course c1  # 指定コースのみ
+    python compact_vectors.py --dry-run    # 削除せず対象だけ表示
+
+サーバーからは POST /api/index/compact で同じ処理を実行できる。
+"""
+import argparse
+import sys
+from pathlib import Path
+
+# プロジェクトルートをパスに追加
+sys.path.insert(0, str(Path(__file__).parent))
+
+from compaction import VectorCompactor
+from ingestion_jobs import IngestionJobStore
+from vector_store import VectorStore
+
+def format_bytes(size: int) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.1f}{unit}" if unit != "B" else f"{size}B"
+        size /= 1024
+
+def main():
+    parser = argparse.ArgumentParser(description="ベクトル保存ディレクトリの整理")
+    parser.add_argument("--course", help="対象のコースID（省略時は全コース）")
+    parser.add_argument("--dry-run", action="store_true", help="削除せず対象だけ表示")
+    parser.add_argument("--grace-seconds", type=int, help="一時ファイルなどを消すまでの猶予（秒）")
+    args = parser.parse_args()
+
+    # サーバーで取り込み中のコースは対象外にする（ジョブの状態はサーバーと共有のSQLiteから読む）
+    jobs = IngestionJobStore()
+    compactor = VectorCompactor(VectorStore(), grace_seconds=args.grace_seconds,
+                                active_courses=lambda: jobs.active_courses(exclude_kinds=("compaction",)))
+    report = compactor.compact(args.course, args.dry_run)
+
+    print("=" * 50)
+    print("ベクトル保存ディレクトリの整理" + ("（確認のみ）" if args.dry_run else ""))
+    print("=" * 50)
+    labels = {
+        "duplicates": "重複した教材",
+        "incomplete": "不完全な保存データ",
+        "temporary": "一時ファイル",
+        "sources": "参照されていない元ファイル",
+        "ann": "不要な近似最近傍インデックス",
+        "snapshots": "不要なインデックスのスナップショット"
+    }
+    for kind, paths in report["removed"].items():
+        print(f"{labels[kind]}: {len(paths)}件")
+        for path in paths:
+            print(f"  - {path}")
+    print()
+    if report["skipped_active_courses"]:
+        print(f"取り込み中のため対象外のコース: {', '.join(report['skipped_active_courses'])}")
+    print(f"有効な教材: {report['live_materials']}件")
+    print(f"削除{'対象' if args.dry_run else ''}ファイル: {report['files_removed']}件"
+          f"（{format_bytes(report['bytes_reclaimed'])}）")
+    print(f"整理前: {report['before']['files']}ファイル / {format_bytes(report['before']['bytes'])}")
+    if report["after"]:
+        print(f"整理後: {report['after']['files']}ファイル / {format_bytes(report['after']['bytes'])}")
+    print(f"処理時間: {report['seconds']}秒")
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("\n\nキャンセルされました")
+    except Exception as e:
+        print(f"\n❌ エラーが発生しました: {e}")
+        sys.exit(1)
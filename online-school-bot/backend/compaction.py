@@ -0,0 +1,262 @@
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Set
+import json
+import shutil
+import threading
+import time
+from config import Config
+from course_index import CourseIndex
+from extraction_cache import file_sha256
+from vector_store import VectorStore
+from index_cache import course_index_cache
+
+# 同時に2つの整理処理が走らないようにする
+_compaction_lock = threading.Lock()
+
+class VectorCompactor:
+    """ベクトル保存ディレクトリの整理
+
+    - 同じコースに重複して取り込まれた教材（ファイル名または内容のハッシュが同じ）は最新のものだけ残す
+      （名前も内容も違う新しい版は判別できないので、古い版は教材の削除で消す）
+    - 行列・サイドカー・BM25の一部だけ残ったファイル、書き込み途中で残った一時ファイルを消す
+    - どの教材のサイドカーからも参照されていないアップロード済みの元ファイルを消す
+    - 教材がなくなったコースの近似最近傍インデックス・スナップショットを消し、残ったコースは作り直す
+    取り込み中のファイルを消さないよう、一時ファイルなどは更新から一定時間経ったものだけ対象にし、
+    取り込みジョブが待機中・実行中のコース（active_coursesが返すコース）は丸ごと対象外にする。
+    """
+
+    def __init__(self, vector_store: VectorStore, source_dir: Optional[Path] = None,
+                 grace_seconds: Optional[int] = None,
+                 active_courses: Optional[Callable[[], Set[str]]] = None):
+        self.vector_store = vector_store
+        self.source_dir = Path(source_dir) if source_dir else Config.PDF_STORAGE_DIR
+        self.grace_seconds = Config.COMPACTION_GRACE_SECONDS if grace_seconds is None else grace_seconds
+        self.active_courses = active_courses
+
+    def _is_stale(self, path: Path, now: float) -> bool:
+        try:
+            return now - path.stat().st_mtime >= self.grace_seconds
+        except FileNotFoundError:
+            return False
+
+    @staticmethod
+    def _material_name(path: Path) -> Optional[str]:
+        for suffix in (VectorStore.MATRIX_SUFFIX, VectorStore.SIDECAR_SUFFIX, VectorStore.LEXICAL_SUFFIX):
+            if path.name.endswith(suffix):
+                return path.name[:-len(suffix)]
+        return None
+
+    def _material_files(self, name: str) -> List[Path]:
+        return [self.vector_store.matrix_path(name), self.vector_store.sidecar_path(name),
+                self.vector_store.lexical_path(name)]
+
+    def _read_sidecar(self, name: str) -> Optional[Dict]:
+        """サイドカーだけを読む（行列が書き込み途中で読み込めない教材の元ファイルも参照中として扱うため）"""
+        try:
+            with open(self.vector_store.sidecar_path(name), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _storage_usage(self) -> Dict:
+        files = 0
+        total = 0
+        for directory in (self.vector_store.vector_dir, self.source_dir):
+            for path in directory.rglob("*"):
+                if path.is_file():
+                    files += 1
+                    total += path.stat().st_size
+        return {"files": files, "bytes": total}
+
+    @staticmethod
+    def _source_path(data: Dict) -> Optional[Path]:
+        path = data.get("pdf_path") or data.get("file_path")
+        return Path(path) if path else None
+
+    def _source_key(self, data: Dict) -> List[tuple]:
+        """同じ教材とみなすキー（出典の種類ごとのファイル名・内容のハッシュ）"""
+        if data.get("spreadsheet_id"):
+            return []
+        source_type = data.get("source_type") or data.get("file_type") or "pdf"
+        metadata = data.get("metadata", {})
+        keys = []
+        if metadata.get("filename"):
+            keys.append((source_type, "filename", metadata["filename"]))
+        file_hash = metadata.get("sha256")
+        source_path = self._source_path(data)
+        if not file_hash and source_path and source_path.exists():
+            # ハッシュを記録していない古いデータは元ファイルから計算する
+            file_hash = file_sha256(source_path)
+        if file_hash:
+            keys.append((source_type, "sha256", file_hash))
+        return keys
+
+    def compact(self, course_id: Optional[str] = None, dry_run: bool = False,
+                progress: Optional[Callable] = None) -> Dict:
+        """整理を実行し、削除したファイルと回収したバイト数を返す（dry_runでは削除せず対象だけ返す）"""
+        with _compaction_lock:
+            return self._compact(course_id, dry_run, progress)
+
+    def _compact(self, course_id: Optional[str], dry_run: bool, progress: Optional[Callable]) -> Dict:
+        started_at = time.perf_counter()
+        now = time.time()
+        before = self._storage_usage()
+        vector_dir = self.vector_store.vector_dir
+        prefix = f"{course_id}_" if course_id else ""
+        removals: Dict[str, List[Path]] = {
+            "duplicates": [], "incomplete": [], "temporary": [], "sources": [], "ann": [], "snapshots": []
+        }
+        # 取り込み中のコースは教材・元ファイル・インデックスのどれも消さない
+        active = set(self.active_courses()) if self.active_courses else set()
+
+        def is_active(name: str) -> bool:
+            return any(name == active_course or name.startswith(f"{active_course}_") for active_course in active)
+
+        # 教材ごとにファイルをまとめ、揃っていないものは書き込み途中でなければ削除対象にする
+        if progress:
+            progress("compacting")
+        names = set()
+        for path in vector_dir.glob(f"{prefix}*"):
+            if not path.is_file():
+                continue
+            if is_active(path.name):
+                continue
+            if path.name.endswith(".tmp"):
+                if self._is_stale(path, now):
+                    removals["temporary"].append(path)
+                continue
+            name = self._material_name(path)
+            if name is not None:
+                names.add(name)
+
+        materials = {}
+        sidecars = {}
+        for name in sorted(names):
+            files = self._material_files(name)
+            sidecar = self._read_sidecar(name) if files[1].exists() else None
+            if sidecar is not None:
+                sidecars[name] = sidecar
+            data = self.vector_store.load(name) if files[0].exists() and sidecar is not None else None
+            if data is None:
+                if all(self._is_stale(path, now) for path in files if path.exists()):
+                    removals["incomplete"].extend(path for path in files if path.exists())
+                continue
+            materials[name] = data
+
+        # 同じコースに重複して取り込まれた教材は更新日時が最新のものだけ残す
+        newest_first = sorted(materials, key=lambda n: self.vector_store.matrix_path(n).stat().st_mtime,
+                              reverse=True)
+        seen = set()
+        duplicates = []
+        for name in newest_first:
+            data = materials[name]
+            keys = [(data.get("course_id"),) + key for key in self._source_key(data)]
+            if any(key in seen for key in keys):
+                duplicates.append(name)
+            seen.update(keys)
+        for name in duplicates:
+            removals["duplicates"].extend(path for path in self._material_files(name) if path.exists())
+
+        live = {name: data for name, data in materials.items() if name not in duplicates}
+        touched_courses = {materials[name].get("course_id") for name in duplicates}
+
+        # どの教材のサイドカーからも参照されていない元ファイルと、書き込み途中で残った.partファイル
+        # 行列を読み込めない教材（書き込み途中など）もサイドカーがあれば元ファイルは参照中とみなす
+        # 保存時のパスが相対・絶対のどちらでも比べられるよう、コースのディレクトリ名とファイル名で照合する
+        referenced = {
+            (path.parent.name, path.name)
+            for path in (self._source_path(data) for name, data in sidecars.items() if name not in duplicates)
+            if path
+        }
+        if course_id:
+            source_dirs = [self.source_dir / course_id]
+        else:
+            source_dirs = [path for path in self.source_dir.iterdir() if path.is_dir()] \
+                if self.source_dir.exists() else []
+        for directory in source_dirs:
+            if directory.name in active:
+                continue
+            for path in directory.glob("*"):
+                if not path.is_file() or not self._is_stale(path, now):
+                    continue
+                if path.name.endswith(".part"):
+                    removals["temporary"].append(path)
+                elif (directory.name, path.name) not in referenced:
+                    removals["sources"].append(path)
+
+        # 教材が残っていないコースの近似最近傍インデックス
+        live_courses = {data.get("course_id") for data in live.values()}
+        ann_dir = self.vector_store.ann_dir
+        for path in ann_dir.glob(f"{course_id}.*" if course_id else "*"):
+            if any(path.name.startswith(f"{active_course}.") for active_course in active):
+                continue
+            if path.name.endswith(".tmp"):
+                if self._is_stale(path, now):
+                    removals["temporary"].append(path)
+            elif path.name.endswith(".ivf.npz"):
+                ann_course = path.name[:-len(".ivf.npz")]
+                if ann_course not in live_courses:
+                    removals["ann"].append(path)
+                    touched_courses.add(ann_course)
+
+        # 教材が残っていないコースのスナップショットと、公開途中で残った一時ディレクトリ
+        snapshot_dirs = []
+        snapshot_root = self.vector_store.snapshots.root
+        if snapshot_root.exists():
+            for course_dir in snapshot_root.iterdir():
+                if not course_dir.is_dir() or (course_id and course_dir.name != course_id):
+                    continue
+                if course_dir.name in active:
+                    continue
+                if course_dir.name not in live_courses:
+                    snapshot_dirs.append(course_dir)
+                    continue
+                snapshot_dirs.extend(
+                    path for path in course_dir.iterdir()
+                    if path.is_dir() and path.name.endswith(".tmp") and self._is_stale(path, now)
+                )
+        for directory in snapshot_dirs:
+            removals["snapshots"].extend(path for path in directory.rglob("*") if path.is_file())
+
+        files_removed = 0
+        bytes_reclaimed = 0
+        for paths in removals.values():
+            for path in paths:
+                try:
+                    size = path.stat().st_size
+                    if not dry_run:
+                        path.unlink()
+                except FileNotFoundError:
+                    continue
+                files_removed += 1
+                bytes_reclaimed += size
+        if not dry_run:
+            for directory in snapshot_dirs:
+                shutil.rmtree(directory, ignore_errors=True)
+
+        # 残った教材でコースのインデックスを作り直す
+        rebuilt = {}
+        if not dry_run:
+            if progress:
+                progress("indexing")
+            for name in duplicates:
+                course_index_cache.invalidate_material(name)
+            for touched in sorted(c for c in touched_courses if c):
+                self.vector_store.bump_version(touched)
+                if touched in live_courses:
+                    rebuilt[touched] = CourseIndex.rebuild_ann(self.vector_store, touched)
+
+        return {
+            "dry_run": dry_run,
+            "course_id": course_id,
+            "live_materials": len(live),
+            "duplicate_materials": duplicates,
+            "skipped_active_courses": sorted(active),
+            "removed": {kind: [str(path) for path in paths] for kind, paths in removals.items()},
+            "files_removed": files_removed,
+            "bytes_reclaimed": bytes_reclaimed,
+            "before": before,
+            "after": self._storage_usage() if not dry_run else None,
+            "rebuilt_courses": rebuilt,
+            "seconds": round(time.perf_counter() - started_at, 3)
+        }
@@ -25,6 +25,9 @@ class Config:
     # OpenAI Models
     GPT_MODEL = "gpt-4o-mini"
     EMBEDDING_MODEL = "text-embedding-3-small"
+    # 埋め込みの次元数（0はモデルの既定の1536、256や512に減らすとインデックスが小さく検索も速くなる）
+    # コースごとの検索設定（embedding_dimensions）で上書きできる
+    EMBEDDING_DIMENSIONS = int(os.getenv("EMBEDDING_DIMENSIONS", "0"))
     
     # Google Sheets
     GOOGLE_CREDENTIALS_PATH = os.getenv("GOOGLE_CREDENTIALS_PATH", "credentials.json")
@@ -36,6 +39,86 @@ class Config:
     CONFIG_FILE = CONFIG_DIR / "config.json"
     PDF_STORAGE_DIR = CONFIG_DIR / "pdfs"
     VECTOR_STORAGE_DIR = CONFIG_DIR / "vectors"
+    CACHE_DIR = CONFIG_DIR / "cache"
+    # 複数のコースで共有する教材（共有ライブラリ）を保存する予約コースID
+    LIBRARY_ID = os.getenv("LIBRARY_ID", "_library")
+    
+    # チャンク分割（埋め込みモデルのトークン数で上限・オーバーラップを指定）
+    CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "500"))
+    CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "100"))
+    
+    # コースインデックスのキャッシュ（バイト数上限、ファイル更新チェック間隔）
+    INDEX_CACHE_MAX_BYTES = int(os.getenv("INDEX_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+    INDEX_CACHE_CHECK_SECONDS = float(os.getenv("INDEX_CACHE_CHECK_SECONDS", "5"))
+    # 起動時に読み込んでおくコース数（直近WARMUP_ACTIVITY_DAYS日の会話数が多い順、0で無効）
+    WARMUP_COURSES = int(os.getenv("WARMUP_COURSES", "5"))
+    WARMUP_ACTIVITY_DAYS = int(os.getenv("WARMUP_ACTIVITY_DAYS", "30"))
+    # 連結・量子化済みの行列をファイルに書き出し、ワーカープロセス間でmmapして共有する
+    INDEX_SNAPSHOTS = os.getenv("INDEX_SNAPSHOTS", "true").lower() == "true"
+    
+    # 近似最近傍（IVF）インデックス
+    # ANN_MIN_CHUNKS未満のコースは総当たり検索、ANN_DEFAULT_NPROBEは検索するリスト数の既定値
+    ANN_MIN_CHUNKS = int(os.getenv("ANN_MIN_CHUNKS", "20000"))
+    ANN_DEFAULT_NPROBE = int(os.getenv("ANN_DEFAULT_NPROBE", "8"))
+    
+    # int8量子化（全体の既定値。コースごとに検索設定 quantize で上書き可）と、float32で再ランキングする候補数
+    QUANTIZE_INT8 = os.getenv("QUANTIZE_INT8", "false").lower() == "true"
+    QUANTIZE_RERANK_CANDIDATES = int(os.getenv("QUANTIZE_RERANK_CANDIDATES", "50"))
+    
+    # BM25（文字n-gram）とベクトル類似度のハイブリッド検索
+    # HYBRID_VECTOR_WEIGHT: 融合時のベクトル類似度の重み、LEXICAL_MIN_SCORE: BM25だけで採用する下限
+    # LEXICAL_FAST_PATH_SCORE: BM25の最上位がこれ以上なら埋め込みAPIを呼ばずに回答に使う
+    HYBRID_VECTOR_WEIGHT = float(os.getenv("HYBRID_VECTOR_WEIGHT", "0.7"))
+    LEXICAL_MIN_SCORE = float(os.getenv("LEXICAL_MIN_SCORE", "0.6"))
+    LEXICAL_FAST_PATH_SCORE = float(os.getenv("LEXICAL_FAST_PATH_SCORE", "0.9"))
+    QUERY_EMBEDDING_TIMEOUT_SECONDS = float(os.getenv("QUERY_EMBEDDING_TIMEOUT_SECONDS", "3"))
+    
+    # 質問文の埋め込みキャッシュ（有効期限、最大件数）
+    QUERY_EMBEDDING_CACHE_TTL_SECONDS = float(os.getenv("QUERY_EMBEDDING_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+    QUERY_EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("QUERY_EMBEDDING_CACHE_MAX_ENTRIES", "10000"))
+    
+    # チャンクの埋め込みキャッシュ（全コース共有、最大件数）
+    CHUNK_EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("CHUNK_EMBEDDING_CACHE_MAX_ENTRIES", "200000"))
+    
+    # 抽出結果キャッシュ（PDFのページ・Excelのシートごとのテキスト、圧縮後の合計サイズ上限）
+    EXTRACTION_CACHE_MAX_BYTES = int(os.getenv("EXTRACTION_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+    # 1ファイル分の抽出結果をキャッシュする上限（圧縮前のテキスト、超えるファイルは行を溜めずにキャッシュしない）
+    EXTRACTION_CACHE_MAX_ENTRY_BYTES = int(os.getenv("EXTRACTION_CACHE_MAX_ENTRY_BYTES", str(32 * 1024 * 1024)))
+    
+    # 教材の埋め込み生成（バッチの件数・トークン数、同時リクエスト数、TPM上限、再試行回数）
+    EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "100"))
+    EMBEDDING_BATCH_MAX_TOKENS = int(os.getenv("EMBEDDING_BATCH_MAX_TOKENS", "100000"))
+    EMBEDDING_MAX_CONCURRENCY = int(os.getenv("EMBEDDING_MAX_CONCURRENCY", "4"))
+    EMBEDDING_TOKENS_PER_MINUTE = int(os.getenv("EMBEDDING_TOKENS_PER_MINUTE", "1000000"))
+    EMBEDDING_MAX_RETRIES = int(os.getenv("EMBEDDING_MAX_RETRIES", "5"))
+    
+    # 教材取り込みジョブ（同時に処理する教材数、保持する終了済みジョブ数）
+    INGESTION_WORKERS = int(os.getenv("INGESTION_WORKERS", "2"))
+    INGESTION_MAX_FINISHED_JOBS = int(os.getenv("INGESTION_MAX_FINISHED_JOBS", "200"))
+    
+    # 連携スプレッドシートの自動更新（既定の間隔（分、0で無効、コースごとに変更可）、確認間隔（秒））
+    SPREADSHEET_REFRESH_MINUTES = int(os.getenv("SPREADSHEET_REFRESH_MINUTES", "60"))
+    SPREADSHEET_SYNC_CHECK_SECONDS = int(os.getenv("SPREADSHEET_SYNC_CHECK_SECONDS", "60"))
+    
+    # ベクトル保存ディレクトリの整理（一時ファイル・参照されていないファイルを消すまでの猶予（秒））
+    COMPACTION_GRACE_SECONDS = int(os.getenv("COMPACTION_GRACE_SECONDS", "3600"))
+    
+    # アップロード（1ファイルの上限サイズ、読み込み単位）
+    UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(300 * 1024 * 1024)))
+    UPLOAD_CHUNK_BYTES = int(os.getenv("UPLOAD_CHUNK_BYTES", str(1024 * 1024)))
+    
+    # 教材の一括取り込み（同時に処理するファイル数、zipの上限サイズ・ファイル数・展開後の合計サイズ）
+    BULK_INGESTION_WORKERS = int(os.getenv("BULK_INGESTION_WORKERS", "4"))
+    BULK_UPLOAD_MAX_BYTES = int(os.getenv("BULK_UPLOAD_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+    BULK_MAX_FILES = int(os.getenv("BULK_MAX_FILES", "500"))
+    BULK_MAX_EXTRACTED_BYTES = int(os.getenv("BULK_MAX_EXTRACTED_BYTES", str(4 * 1024 * 1024 * 1024)))
+    # サーバー上のフォルダから取り込む場合に許可するディレクトリ（空ならフォルダ指定は使えない）
+    BULK_IMPORT_ROOT = os.getenv("BULK_IMPORT_ROOT", "")
+    
+    # PDFの並列抽出（プロセス数、1タスクのページ数、並列化する最小ページ数）
+    PDF_EXTRACT_WORKERS = int(os.getenv("PDF_EXTRACT_WORKERS", str(min(4, os.cpu_count() or 1))))
+    PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "8"))
+    PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", "16"))
     
     # 満足度判定の閾値
     SATISFACTION_THRESHOLD = 0.3  # 0.3以下で不満と判定
@@ -84,6 +84,24 @@ class ConversationManager:
         
         self.save_conversation(conversation)
     
+    def count_by_course(self, course_ids: List[str], since: Optional[datetime] = None) -> Dict[str, int]:
+        """コースごとの会話数（sinceを指定した場合はそれ以降に更新された会話のみ）
+
+        ファイル名（{course_id}_{user_id}_{日時}.json）とファイルの更新日時だけで数え、中身は読まない。
+        コースIDが前方一致する場合（"1" と "1_a" など）は長い方に数える。
+        """
+        counts = {course_id: 0 for course_id in course_ids}
+        prefixes = sorted(course_ids, key=len, reverse=True)
+        since_ts = since.timestamp() if since else None
+        for path in self.conversations_dir.glob("*.json"):
+            course_id = next((c for c in prefixes if path.name.startswith(f"{c}_")), None)
+            if course_id is None:
+                continue
+            if since_ts is not None and path.stat().st_mtime < since_ts:
+                continue
+            counts[course_id] += 1
+        return counts
+    
     def get_conversation_history(self, conversation_id: str, limit: int = 20) -> List[Dict]:
         """会話履歴を取得"""
         conversation = self.load_conversation(conversation_id)
@@ -0,0 +1,536 @@
+import json
+import numpy as np
+from pathlib import Path
+from typing import List, Dict, Optional, Tuple
+from vector_store import VectorStore
+from index_cache import course_index_cache
+from ann_index import IVFIndex
+from quantization import Int8Matrix
+from lexical_index import LexicalIndex
+from config import Config
+import sys
+import time
+
+class CourseIndex:
+    """コース単位の検索インデックス（全教材のチャンクを1つの行列にまとめて検索）"""
+
+    def __init__(self, course_id: str, matrices: List[np.ndarray], materials: List[Dict],
+                 quantize: bool = False, shared: Optional[Dict[str, np.ndarray]] = None):
+        self.course_id = course_id
+        self.materials = materials
+        self.source_types = np.array([m["source"]["type"] for m in materials])
+        self.material_names = np.array([m["name"] for m in materials])
+
+        counts = [m.shape[0] for m in matrices]
+        self.row_material = np.repeat(np.arange(len(materials), dtype=np.int32), counts)
+        self.material_starts = np.concatenate(([0], np.cumsum(counts)[:-1])).astype(np.int64)
+        self.row_offsets = self.material_starts[self.row_material]
+
+        # 量子化する場合はint8だけを常駐させ、float32は再ランキング用にmmapのまま参照する
+        # sharedは公開済みスナップショット（連結・量子化済みの行列のmmap）
+        self.matrices = matrices
+        self.quantized: Optional[Int8Matrix] = None
+        self.matrix: Optional[np.ndarray] = None
+        self.shared = shared is not None
+        if quantize:
+            self.quantized = Int8Matrix(shared["codes"], shared["scales"]) if shared else \
+                Int8Matrix.from_matrices(matrices)
+        elif shared:
+            self.matrix = shared["matrix"]
+        else:
+            self.matrix = matrices[0] if len(matrices) == 1 else np.concatenate(matrices, axis=0)
+
+        # 教材をベクトル化したときの次元数の指定（質問も同じ指定でベクトル化する、Noneはモデルの既定）
+        self.embedding_dimensions = materials[0]["data"].get("embedding_dimensions") if materials else None
+        self.lexical: Optional[LexicalIndex] = None
+        self.ann: Optional[IVFIndex] = None
+        self.nprobe = Config.ANN_DEFAULT_NPROBE
+        self.rerank_candidates = Config.QUANTIZE_RERANK_CANDIDATES
+
+    @staticmethod
+    def describe_source(name: str, data: Dict) -> Dict:
+        """サイドカーの情報から教材の出典情報を作成"""
+        if data.get("source_type"):
+            source_type = data["source_type"]
+        elif data.get("file_type"):
+            source_type = data["file_type"]
+        elif data.get("spreadsheet_id"):
+            source_type = "spreadsheet"
+        else:
+            source_type = "pdf"
+
+        metadata = data.get("metadata", {})
+        if metadata.get("filename"):
+            file = metadata["filename"]
+        elif data.get("pdf_path") or data.get("file_path"):
+            file = Path(data.get("pdf_path") or data.get("file_path")).name
+        else:
+            file = data.get("spreadsheet_id", name)
+
+        source = {"name": name, "type": source_type, "file": file}
+        if data.get("sheet_name"):
+            source["sheet"] = data["sheet_name"]
+        return source
+
+    @classmethod
+    def load(cls, vector_store: VectorStore, course_id: str,
+             quantize: Optional[bool] = None, publish: bool = True) -> Optional["CourseIndex"]:
+        """コースの全教材を読み込んでインデックスを構築（quantize=Noneなら検索設定に従う）
+
+        publish=Trueなら連結・量子化した行列をスナップショットとして公開し、そのmmapを使う
+        （他のワーカーは同じファイルを開くだけで済む）。
+
+        次元数の異なる教材が混ざっている場合（次元数の設定を変えて再ベクトル化している途中など）は、
+        コースの設定と同じ次元数の教材があればそちらを、なければ最初の教材の次元数を使う。
+        """
+        settings = vector_store.load_search_settings(course_id)
+        loaded = []
+        for name in sorted(vector_store.list_names(f"{course_id}_*")):
+            try:
+                stat = vector_store.material_stat(name)
+            except FileNotFoundError:
+                continue
+            data = vector_store.load(name)
+            # 前方一致で別コース（例: "1" に対する "1_a"）を拾わないように確認
+            if not data or data.get("course_id", course_id) != course_id or not data.get("count"):
+                continue
+            loaded.append((name, data, stat))
+        if not loaded:
+            return None
+
+        configured = settings.get("embedding_dimensions") or None
+        dimensions = configured if any(
+            (data.get("embedding_dimensions") or None) == configured for _, data, _ in loaded
+        ) else (loaded[0][1].get("embedding_dimensions") or None)
+
+        materials = []
+        matrices = []
+        stats = []
+        dim = None
+        for name, data, stat in loaded:
+            matrix = data.pop("matrix")
+            if (data.get("embedding_dimensions") or None) != dimensions or (dim is not None and matrix.shape[1] != dim):
+                print(f"次元数が一致しないため除外 ({name}): {matrix.shape[1]}")
+                continue
+            dim = matrix.shape[1]
+            materials.append({
+                "name": name,
+                "source": cls.describe_source(name, data),
+                "data": data
+            })
+            matrices.append(matrix)
+            stats.append(stat)
+
+        if not materials:
+            return None
+
+        if quantize is None:
+            quantize = bool(settings.get("quantize"))
+        # 教材が1つで量子化しない場合は教材の行列のmmapをそのまま使えるので公開しない
+        shared = None
+        if publish and Config.INDEX_SNAPSHOTS and (quantize or len(matrices) > 1):
+            shared = cls.open_snapshot(vector_store, course_id, matrices, stats, quantize)
+        course_index = cls(course_id, matrices, materials, quantize=quantize, shared=shared)
+        course_index.nprobe = int(settings.get("nprobe") or Config.ANN_DEFAULT_NPROBE)
+        course_index.rerank_candidates = int(
+            settings.get("rerank_candidates") or Config.QUANTIZE_RERANK_CANDIDATES
+        )
+
+        try:
+            course_index.lexical = LexicalIndex(
+                [vector_store.load_lexical(m["name"], m["data"]) for m in materials],
+                course_index.material_starts
+            )
+        except Exception as e:
+            print(f"BM25インデックスの読み込みエラー ({course_id}): {e}")
+
+        # 近似最近傍インデックスは、構築時と教材構成が同じ場合のみ使う
+        if settings.get("ann") != "off":
+            try:
+                ann = IVFIndex.load(vector_store.ann_path(course_id))
+                if ann and ann.info.get("materials") == course_index.material_layout():
+                    course_index.ann = ann
+            except Exception as e:
+                print(f"近似最近傍インデックスの読み込みエラー ({course_id}): {e}")
+        return course_index
+
+    @staticmethod
+    def open_snapshot(vector_store: VectorStore, course_id: str, matrices: List[np.ndarray],
+                      stats: List[tuple], quantize: bool) -> Optional[Dict[str, np.ndarray]]:
+        """連結・量子化済みの行列をスナップショットから開く（なければ作って公開する）"""
+        try:
+            # 読み込み中に教材が置き換えられた場合は、次の読み込みで公開する
+            if [vector_store.material_stat(stat[0]) for stat in stats] != stats:
+                return None
+
+            def build():
+                if quantize:
+                    quantized = Int8Matrix.from_matrices(matrices)
+                    return {"codes": quantized.codes, "scales": quantized.scales}
+                return {"matrix": np.concatenate(matrices, axis=0)}
+
+            version = vector_store.snapshots.version(stats, "int8" if quantize else "float32")
+            return vector_store.snapshots.get_or_publish(course_id, version, build)
+        except Exception as e:
+            print(f"インデックスのスナップショットを使えません ({course_id}): {e}")
+            return None
+
+    @staticmethod
+    def count_chunks(vector_store: VectorStore, course_id: str) -> int:
+        """コースの教材のチャンク数の合計（サイドカーの件数だけを見る）"""
+        total = 0
+        for name in vector_store.list_names(f"{course_id}_*"):
+            try:
+                with open(vector_store.sidecar_path(name), "r", encoding="utf-8") as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if data.get("course_id", course_id) == course_id:
+                total += int(data.get("count") or 0)
+        return total
+
+    @classmethod
+    def rebuild_ann(cls, vector_store: VectorStore, course_id: str) -> Optional[Dict]:
+        """教材の追加・更新後に近似最近傍インデックスを再構築（小さいコースは削除して総当たり）"""
+        settings = vector_store.load_search_settings(course_id)
+        ann_path = vector_store.ann_path(course_id)
+
+        def remove_ann():
+            if ann_path.exists():
+                ann_path.unlink()
+                vector_store.bump_version(course_id)
+            return None
+
+        # インデックスを作らないコースは、行列を連結・公開せずに終える（教材の追加ごとに全体をコピーしない）
+        mode = settings.get("ann", "auto")
+        if mode == "off" or (mode == "auto" and cls.count_chunks(vector_store, course_id) < Config.ANN_MIN_CHUNKS):
+            return remove_ann()
+
+        # 量子化しないコースは、ここで公開したスナップショットを各ワーカーがそのまま開ける
+        course_index = cls.load(vector_store, course_id, quantize=False,
+                                publish=not settings.get("quantize"))
+        # 次元数の異なる教材を除くと閾値を下回ることがある
+        if course_index is None or (mode == "auto" and course_index.chunk_count < Config.ANN_MIN_CHUNKS):
+            return remove_ann()
+
+        started = time.perf_counter()
+        ann = IVFIndex.build(course_index.matrix, nlist=settings.get("nlist"))
+        ann.info["materials"] = course_index.material_layout()
+        ann.save(ann_path)
+        vector_store.bump_version(course_id)
+        return {
+            "nlist": ann.nlist,
+            "nprobe": int(settings.get("nprobe") or Config.ANN_DEFAULT_NPROBE),
+            "chunk_count": course_index.chunk_count,
+            "build_seconds": round(time.perf_counter() - started, 3)
+        }
+
+    @classmethod
+    def reembed(cls, vector_store: VectorStore, embedder, course_id: str,
+                progress=None) -> Dict:
+        """次元数の設定と異なる教材を、保存済みのチャンクテキストから再ベクトル化
+
+        テキストの抽出・チャンク分割はやり直さず、チャンクとページ・行の情報はそのまま残す。
+        """
+        dimensions = vector_store.embedding_dimensions(course_id)
+        targets = []
+        for name in sorted(vector_store.list_names(f"{course_id}_*")):
+            data = vector_store.load(name)
+            if not data or data.get("course_id", course_id) != course_id or not data.get("count"):
+                continue
+            if (data.get("embedding_dimensions") or None) != dimensions:
+                targets.append((name, data["count"]))
+
+        total = sum(count for _, count in targets)
+        done = 0
+        stats = []
+        for name, count in targets:
+            data = vector_store.load(name)
+            data.pop("matrix")
+            chunks = VectorStore.get_chunks(data)
+            chunk_meta = data.pop("chunk_meta", None)
+            info = {k: v for k, v in data.items() if k not in ("name", "dim", "count", "offsets", "text")}
+            info["embedding_model"] = embedder.model
+            info["embedding_dimensions"] = dimensions
+
+            def report(stage, material_done, material_total, offset=done):
+                if progress:
+                    progress(stage, offset + material_done, total)
+
+            embeddings, embedding_stats = embedder.embed(chunks, report, dimensions=dimensions)
+            if progress:
+                progress("saving")
+            vector_store.save(name, chunks, embeddings, info, chunk_meta)
+            done += count
+            stats.append({"name": name, "chunk_count": count, "embeddings": embedding_stats})
+
+        if progress:
+            progress("indexing")
+        return {
+            "course_id": course_id,
+            "embedding_dimensions": dimensions,
+            "materials": stats,
+            "chunk_count": total,
+            "ann": cls.rebuild_ann(vector_store, course_id)
+        }
+
+    def material_layout(self) -> List[List]:
+        """行の並び（教材名とチャンク数）"""
+        counts = np.bincount(self.row_material, minlength=len(self.materials))
+        return [[m["name"], int(c)] for m, c in zip(self.materials, counts)]
+
+    @classmethod
+    def get(cls, vector_store: VectorStore, course_id: str) -> Optional["CourseIndex"]:
+        """キャッシュ経由でコースのインデックスを取得"""
+        return course_index_cache.get(
+            course_id,
+            lambda: vector_store.course_signature(course_id),
+            lambda: cls.load(vector_store, course_id)
+        )
+
+    @classmethod
+    def get_library(cls, vector_store: VectorStore, course_id: str) -> Optional[Tuple["CourseIndex", List[str]]]:
+        """コースに追加された共有ライブラリの教材（ライブラリのインデックスと教材名、なければNone）
+
+        ライブラリのインデックスは全コースで1つだけ読み込み、検索時に教材名で絞り込む。
+        """
+        if course_id == Config.LIBRARY_ID:
+            return None
+        names = vector_store.load_search_settings(course_id).get("library_materials")
+        if not names:
+            return None
+        library = cls.get(vector_store, Config.LIBRARY_ID)
+        return (library, names) if library is not None else None
+
+    @staticmethod
+    def score_mode(result: Dict) -> str:
+        """検索結果のスコアの種類（hybrid: 融合スコア、lexical: BM25のみ、vector: 類似度のみ）"""
+        if result.get("lexical_score") is None:
+            return "vector"
+        return "lexical" if result.get("similarity") is None else "hybrid"
+
+    @classmethod
+    def merge_results(cls, result_lists: List[List[Dict]], top_k: int) -> List[Dict]:
+        """複数のインデックスの検索結果をスコアの高い順にまとめる
+
+        スコアの種類がそろっていればそのまま比べる。インデックスによって種類が違う場合
+        （片方だけBM25がない、片方だけベクトル化に失敗した等）は、種類ごとに最上位の値で割って
+        0〜1にそろえてから比べる。
+        """
+        results = [result for results in result_lists for result in results]
+        raw = [r["score"] if r.get("score") is not None else (r["similarity"] or 0.0) for r in results]
+        modes = [cls.score_mode(r) for r in results]
+        keys = raw
+        if len(set(modes)) > 1:
+            highest = {}
+            for mode, value in zip(modes, raw):
+                highest[mode] = max(highest.get(mode, 0.0), value)
+            keys = [value / highest[mode] if highest[mode] > 0 else 0.0 for mode, value in zip(modes, raw)]
+        order = sorted(range(len(results)), key=lambda i: keys[i], reverse=True)
+        return [results[i] for i in order[:top_k]]
+
+    @classmethod
+    def search_with_library(cls, vector_store: VectorStore, course_id: str, query_embedding: Optional[List[float]],
+                            top_k: int = 5, **kwargs) -> List[Dict]:
+        """コースの教材と、コースに追加された共有ライブラリの教材をまとめて検索
+
+        ライブラリの次元数が質問のベクトルと異なる場合はコースの教材だけを検索する
+        （query_embeddingがNoneのBM25だけの検索では次元数を確かめない）。
+        """
+        result_lists = []
+        course_index = cls.get(vector_store, course_id)
+        if course_index is not None:
+            result_lists.append(course_index.search(query_embedding, top_k, **kwargs))
+        library = cls.get_library(vector_store, course_id)
+        if library is not None:
+            library_index, names = library
+            if query_embedding is None or library_index.matrices[0].shape[1] == len(query_embedding):
+                result_lists.append(library_index.search(query_embedding, top_k, material_names=names, **kwargs))
+        return cls.merge_results(result_lists, top_k)
+
+    @property
+    def chunk_count(self) -> int:
+        return int(self.row_material.shape[0])
+
+    @property
+    def nbytes(self) -> int:
+        """おおよそのメモリ使用量（行列 + 行の対応表 + チャンクテキスト）"""
+        total = self.row_material.nbytes + self.row_offsets.nbytes
+        total += self.quantized.nbytes if self.quantized is not None else self.matrix.nbytes
+        if self.ann is not None:
+            total += self.ann.nbytes
+        if self.lexical is not None:
+            total += self.lexical.nbytes
+        for material in self.materials:
+            total += sys.getsizeof(material["data"]["text"])
+        return int(total)
+
+    def get_vectors(self, rows: np.ndarray) -> np.ndarray:
+        """指定行のfloat32ベクトルを取得（量子化時は教材ごとのmmapから読む）"""
+        if self.matrix is not None:
+            return np.asarray(self.matrix[rows])
+        rows = np.asarray(rows)
+        vectors = np.empty((len(rows), self.matrices[0].shape[1]), dtype=np.float32)
+        # 教材ごとにまとめて1回のファンシーインデックスで読む
+        materials = self.row_material[rows]
+        order = np.argsort(materials, kind="stable")
+        boundaries = np.flatnonzero(np.diff(materials[order])) + 1
+        for positions in np.split(order, boundaries):
+            if len(positions) == 0:
+                continue
+            material = materials[positions[0]]
+            vectors[positions] = self.matrices[material][rows[positions] - self.material_starts[material]]
+        return vectors
+
+    def score(self, query_vec: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """コサイン類似度（量子化時はint8による近似値）"""
+        if self.quantized is not None:
+            return self.quantized.score(query_vec, rows)
+        if rows is None:
+            return self.matrix @ query_vec
+        return self.matrix[rows] @ query_vec
+
+    def get_result(self, row: int, similarity: Optional[float],
+                   lexical_score: Optional[float] = None, score: Optional[float] = None) -> Dict:
+        """行番号から検索結果（チャンク + 出典）を作成"""
+        material = self.materials[self.row_material[row]]
+        index = int(row - self.row_offsets[row])
+        data = material["data"]
+        source = dict(material["source"])
+        chunk_meta = data.get("chunk_meta")
+        if chunk_meta:
+            source.update(chunk_meta[index])
+        if self.course_id == Config.LIBRARY_ID:
+            source["library"] = True
+        result = {
+            "chunk": VectorStore.get_chunk(data, index),
+            "similarity": float(similarity) if similarity is not None else None,
+            "index": index,
+            "source": source
+        }
+        if lexical_score is not None:
+            result["lexical_score"] = lexical_score
+            result["score"] = score
+        return result
+
+    @staticmethod
+    def top_indices(scores: np.ndarray, k: int) -> np.ndarray:
+        """argpartitionで上位k件を取り出してから、その中だけをソート（-infは除く）"""
+        k = min(k, len(scores))
+        if k <= 0:
+            return np.empty(0, dtype=np.int64)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return top[scores[top] > -np.inf]
+
+    def vector_search(self, query_vec: np.ndarray, top_k: int, allowed: Optional[np.ndarray] = None,
+                      nprobe: Optional[int] = None, exact: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+        """ベクトル検索の上位k件（行番号と類似度、類似度の降順）"""
+        rows = None
+        if self.ann is not None and not exact:
+            rows = self.ann.candidates(query_vec, nprobe or self.nprobe)
+            # 絞り込み（教材の種類・ライブラリの教材）で候補が足りなければ総当たりにする
+            if len(rows) < top_k or (allowed is not None and np.count_nonzero(allowed[rows]) < top_k):
+                rows = None
+            else:
+                rows.sort()
+        similarities = self.score(query_vec, rows)
+
+        if allowed is not None:
+            similarities = np.where(allowed if rows is None else allowed[rows], similarities, -np.inf)
+
+        # 量子化時は近似スコアの上位候補だけをfloat32で採点し直す
+        if self.quantized is not None:
+            candidates = self.top_indices(similarities, max(top_k, self.rerank_candidates))
+            rows = candidates if rows is None else rows[candidates]
+            similarities = self.get_vectors(rows) @ query_vec
+
+        top = self.top_indices(similarities, top_k)
+        return (top if rows is None else rows[top]), similarities[top]
+
+    def search(self, query_embedding: Optional[List[float]], top_k: int = 5,
+               min_similarity: Optional[float] = None,
+               source_types: Optional[List[str]] = None,
+               nprobe: Optional[int] = None, exact: bool = False,
+               query_text: Optional[str] = None,
+               min_lexical_score: Optional[float] = None,
+               vector_weight: Optional[float] = None,
+               material_names: Optional[List[str]] = None) -> List[Dict]:
+        """全教材を対象に上位k件を検索
+
+        近似最近傍インデックスがあれば、クエリに近いnprobe個のリストだけを採点する。
+        exact=Trueなら常に総当たり。量子化時はint8で絞り込んでからfloat32で再ランキングする。
+        query_textを渡すとBM25のスコアをvector_weightの比率で融合し、
+        query_embeddingがNoneならBM25だけで検索する。
+        しきい値はmin_similarity（コサイン類似度）かmin_lexical_score（BM25）のどちらかを満たせば通す。
+        material_namesを渡すとその教材だけを対象にする（共有ライブラリのうちコースに追加された教材など）。
+        """
+        if self.chunk_count == 0 or top_k <= 0:
+            return []
+
+        allowed = None
+        if source_types is not None or material_names is not None:
+            material_allowed = np.ones(len(self.materials), dtype=bool)
+            if source_types is not None:
+                material_allowed &= np.isin(self.source_types, source_types)
+            if material_names is not None:
+                material_allowed &= np.isin(self.material_names, material_names)
+            if not material_allowed.any():
+                return []
+            allowed = material_allowed[self.row_material]
+
+        lexical_scores = None
+        if query_text and self.lexical is not None:
+            lexical_scores = self.lexical.score(query_text)
+            if lexical_scores is not None and allowed is not None:
+                lexical_scores = np.where(allowed, lexical_scores, -np.inf)
+
+        # BM25のみ
+        if query_embedding is None:
+            if lexical_scores is None:
+                return []
+            results = []
+            for row in self.top_indices(lexical_scores, top_k):
+                score = float(lexical_scores[row])
+                if score <= 0 or (min_lexical_score is not None and score < min_lexical_score):
+                    break
+                results.append(self.get_result(int(row), None, lexical_score=score, score=score))
+            return results
+
+        query_vec = VectorStore.normalize(query_embedding)[0]
+
+        # ベクトルのみ
+        if lexical_scores is None:
+            rows, similarities = self.vector_search(query_vec, top_k, allowed, nprobe, exact)
+            results = []
+            for row, similarity in zip(rows, similarities):
+                if min_similarity is not None and similarity <= min_similarity:
+                    break
+                results.append(self.get_result(int(row), similarity))
+            return results
+
+        # ハイブリッド: 両方の上位候補を合わせ、float32の類似度とBM25を重み付きで融合
+        weight = Config.HYBRID_VECTOR_WEIGHT if vector_weight is None else vector_weight
+        pool = max(top_k * 4, 20)
+        vector_rows, _ = self.vector_search(query_vec, pool, allowed, nprobe, exact)
+        lexical_rows = self.top_indices(lexical_scores, pool)
+        lexical_rows = lexical_rows[lexical_scores[lexical_rows] > 0]
+        rows = np.union1d(vector_rows, lexical_rows)
+        if len(rows) == 0:
+            return []
+        similarities = self.get_vectors(rows) @ query_vec
+        lexical = lexical_scores[rows]
+        fused = weight * similarities + (1 - weight) * lexical
+
+        if min_similarity is not None or min_lexical_score is not None:
+            passed = np.zeros(len(rows), dtype=bool)
+            if min_similarity is not None:
+                passed |= similarities > min_similarity
+            if min_lexical_score is not None:
+                passed |= lexical >= min_lexical_score
+            fused = np.where(passed, fused, -np.inf)
+
+        return [
+            self.get_result(int(rows[i]), similarities[i], lexical_score=float(lexical[i]), score=float(fused[i]))
+            for i in self.top_indices(fused, top_k)
+        ]
@@ -65,3 +65,11 @@ class CourseManager:
             self._save_courses()
             return True
         return False
+    
+    def update_course_spreadsheet_refresh(self, course_id: str, minutes: int) -> bool:
+        """連携スプレッドシートの自動更新間隔（分、0で自動更新しない）を更新"""
+        if course_id in self.courses:
+            self.courses[course_id]["spreadsheet_refresh_minutes"] = minutes
+            self._save_courses()
+            return True
+        return False
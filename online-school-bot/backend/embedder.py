@@ -0,0 +1,218 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+import random
+import threading
+import time
+from openai import APIConnectionError, InternalServerError, RateLimitError
+from config import Config
+from embedding_cache import embedding_cache_model, get_chunk_embedding_cache
+
+# 一時的なエラー（429・5xx・接続エラー/タイムアウト）だけ再試行する
+RETRYABLE_ERRORS = (RateLimitError, InternalServerError, APIConnectionError)
+
+class TokenRateLimiter:
+    """1分あたりのトークン数上限を守るためのトークンバケット（スレッドセーフ）"""
+
+    def __init__(self, tokens_per_minute: int):
+        self.capacity = float(tokens_per_minute)
+        self.rate = tokens_per_minute / 60.0
+        self.available = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: int):
+        """tokens分の枠が空くまで待つ（上限を超える大きさの要求はバケットが満杯になった時点で通す）"""
+        tokens = min(float(tokens), self.capacity)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.available = min(self.capacity, self.available + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.available >= tokens:
+                    self.available -= tokens
+                    return
+                wait = (tokens - self.available) / self.rate
+            time.sleep(wait)
+
+# 同じAPIキーのTPM枠を使うので、PDF・Excelの取り込みで1つのリミッターを共有する
+_shared_rate_limiter: Optional[TokenRateLimiter] = None
+_shared_rate_limiter_lock = threading.Lock()
+
+def get_shared_rate_limiter() -> TokenRateLimiter:
+    global _shared_rate_limiter
+    with _shared_rate_limiter_lock:
+        if _shared_rate_limiter is None:
+            _shared_rate_limiter = TokenRateLimiter(Config.EMBEDDING_TOKENS_PER_MINUTE)
+        return _shared_rate_limiter
+
+class BatchEmbedder:
+    """チャンクの埋め込み生成（PDF・Excel・スプレッドシート共通）
+
+    キャッシュにないチャンクだけをバッチに分け、同時実行数とTPM（トークン/分）の
+    上限の範囲で並行してAPIに送る。429や一時的なエラーはバッチ単位で指数バックオフして
+    再試行し、結果は入力と同じ順序に並べ直して返す。
+    """
+
+    CACHE_LOOKUP_SIZE = 100
+
+    def __init__(self, client, count_tokens: Callable[[str], int], model: Optional[str] = None,
+                 batch_size: Optional[int] = None, max_concurrency: Optional[int] = None,
+                 tokens_per_minute: Optional[int] = None, max_retries: Optional[int] = None):
+        # リトライはこちらで制御するのでSDK側の自動リトライは切る
+        self.client = client.with_options(max_retries=0) if client else None
+        self.count_tokens = count_tokens
+        self.model = model or Config.EMBEDDING_MODEL
+        self.batch_size = batch_size or Config.EMBEDDING_BATCH_SIZE
+        self.batch_max_tokens = Config.EMBEDDING_BATCH_MAX_TOKENS
+        self.max_concurrency = max_concurrency or Config.EMBEDDING_MAX_CONCURRENCY
+        self.max_retries = Config.EMBEDDING_MAX_RETRIES if max_retries is None else max_retries
+        self.rate_limiter = TokenRateLimiter(tokens_per_minute) if tokens_per_minute else get_shared_rate_limiter()
+        self.cache = get_chunk_embedding_cache()
+
+    @staticmethod
+    def retry_delay(error: Exception, attempt: int) -> float:
+        """再試行までの待ち時間（Retry-Afterがあればそれに従う）"""
+        response = getattr(error, "response", None)
+        if response is not None:
+            retry_after = response.headers.get("retry-after")
+            try:
+                if retry_after is not None:
+                    return float(retry_after)
+            except ValueError:
+                pass
+        return min(60.0, 2 ** attempt) * (0.5 + random.random() / 2)
+
+    def _embed_batch(self, batch: List[str], tokens: int,
+                     dimensions: Optional[int] = None) -> Tuple[List[List[float]], int]:
+        """1バッチ分を埋め込み（戻り値は埋め込みと再試行回数）"""
+        options = {"dimensions": dimensions} if dimensions else {}
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire(tokens)
+            try:
+                response = self.client.embeddings.create(model=self.model, input=batch, **options)
+                return [item.embedding for item in response.data], attempt
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self.retry_delay(e, attempt)
+                print(f"埋め込み生成リトライ（{attempt + 1}/{self.max_retries}、{delay:.1f}秒後）: {e}")
+                time.sleep(delay)
+
+    def embed(self, texts: List[str], progress: Optional[Callable] = None,
+              dimensions: Optional[int] = None) -> Tuple[List[List[float]], Dict]:
+        """テキストのベクトル化（戻り値は入力順の埋め込みと処理統計）
+
+        progressを渡すと、バッチが終わるたびに("embedding", 処理済み件数, 全件数)で呼ぶ。
+        dimensionsを渡すと次元数を減らした埋め込みを返す（Noneはモデルの既定）。
+        """
+        _, embeddings, stats = self.embed_stream(texts, progress, total=len(texts), dimensions=dimensions)
+        return embeddings, stats
+
+    def embed_stream(self, texts: Iterable[str], progress: Optional[Callable] = None,
+                     total: Optional[int] = None,
+                     dimensions: Optional[int] = None) -> Tuple[List[str], List[List[float]], Dict]:
+        """チャンクを順に受け取りながらベクトル化（戻り値は受け取ったテキスト・埋め込み・処理統計）
+
+        キャッシュの確認はCACHE_LOOKUP_SIZE件ずつ、APIへの送信はバッチが件数・トークン数の
+        上限に達した時点で行うので、PDFの抽出やチャンク分割と並行して埋め込みが進む。
+        送信中のバッチは同時実行数の2倍までに抑える。
+        """
+        if not self.client:
+            raise Exception("OpenAI APIキーが設定されていません")
+
+        started_at = time.perf_counter()
+        cache_model = embedding_cache_model(self.model, dimensions)
+        received: List[str] = []
+        embeddings: List[Optional[List[float]]] = []
+        lookup: List[int] = []  # キャッシュ未確認
+        pending: List[int] = []  # 次のバッチ（キャッシュになかったもの）
+        pending_tokens = 0
+        in_flight = set()
+        counts = {"cached": 0, "embedded": 0, "batches": 0, "retries": 0, "tokens": 0, "done": 0}
+
+        def report():
+            if progress:
+                progress("embedding", counts["done"], total or len(received))
+
+        def run(batch_indices: List[int]):
+            batch = [received[i] for i in batch_indices]
+            tokens = sum(self.count_tokens(text) for text in batch)
+            batch_embeddings, retries = self._embed_batch(batch, tokens, dimensions)
+            self.cache.put_many(cache_model, batch, batch_embeddings)
+            return batch_indices, batch_embeddings, retries, tokens
+
+        def collect(done_futures):
+            for future in done_futures:
+                in_flight.discard(future)
+                batch_indices, batch_embeddings, retries, tokens = future.result()
+                for i, embedding in zip(batch_indices, batch_embeddings):
+                    embeddings[i] = embedding
+                counts["retries"] += retries
+                counts["tokens"] += tokens
+                counts["done"] += len(batch_indices)
+            report()
+
+        def submit_pending():
+            nonlocal pending, pending_tokens
+            if not pending:
+                return
+            while len(in_flight) >= self.max_concurrency * 2:
+                collect(wait(in_flight, return_when=FIRST_COMPLETED).done)
+            in_flight.add(executor.submit(run, pending))
+            counts["batches"] += 1
+            counts["embedded"] += len(pending)
+            pending = []
+            pending_tokens = 0
+
+        def check_cache():
+            nonlocal pending_tokens
+            cached = self.cache.get_many(cache_model, [received[i] for i in lookup])
+            for i, embedding in zip(lookup, cached):
+                if embedding is not None:
+                    embeddings[i] = embedding
+                    counts["cached"] += 1
+                    counts["done"] += 1
+                    continue
+                tokens = self.count_tokens(received[i])
+                if pending and (len(pending) >= self.batch_size
+                                or pending_tokens + tokens > self.batch_max_tokens):
+                    submit_pending()
+                pending.append(i)
+                pending_tokens += tokens
+            lookup.clear()
+            report()
+
+        executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+        try:
+            for text in texts:
+                lookup.append(len(received))
+                received.append(text)
+                embeddings.append(None)
+                if len(lookup) >= self.CACHE_LOOKUP_SIZE:
+                    check_cache()
+            if lookup:
+                check_cache()
+            submit_pending()
+            while in_flight:
+                collect(wait(in_flight, return_when=FIRST_COMPLETED).done)
+        except Exception as e:
+            # 送信待ちのバッチは取り消し、実行中のものは待たずに戻る
+            executor.shutdown(wait=False, cancel_futures=True)
+            print(f"埋め込み生成エラー: {e}")
+            raise
+        executor.shutdown()
+
+        seconds = time.perf_counter() - started_at
+        stats = {
+            "chunk_count": len(received),
+            "dimensions": dimensions,
+            "cached": counts["cached"],
+            "embedded": counts["embedded"],
+            "batches": counts["batches"],
+            "retries": counts["retries"],
+            "tokens": counts["tokens"],
+            "seconds": round(seconds, 3),
+            "chunks_per_second": round(counts["embedded"] / seconds, 1) if seconds > 0 else None,
+            "tokens_per_second": round(counts["tokens"] / seconds, 1) if seconds > 0 else None
+        }
+        return received, embeddings, stats
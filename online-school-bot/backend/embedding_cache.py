@@ -0,0 +1,210 @@
+import numpy as np
+from pathlib import Path
+from typing import List, Optional
+import hashlib
+import sqlite3
+import threading
+import time
+import unicodedata
+from config import Config
+
+def embedding_cache_model(model: str, dimensions: Optional[int] = None) -> str:
+    """キャッシュのキーに使うモデル名（次元数を減らした埋め込みは別のモデルとして扱う）"""
+    return f"{model}@{dimensions}" if dimensions else model
+
+class QueryEmbeddingCache:
+    """質問文の埋め込みキャッシュ（SQLiteに保存するLRU、TTL・件数上限付き）"""
+
+    def __init__(self, db_path: Optional[Path] = None, ttl_seconds: Optional[float] = None,
+                 max_entries: Optional[int] = None):
+        self.db_path = Path(db_path) if db_path else Config.CACHE_DIR / "query_embeddings.sqlite3"
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.ttl_seconds = Config.QUERY_EMBEDDING_CACHE_TTL_SECONDS if ttl_seconds is None else ttl_seconds
+        self.max_entries = Config.QUERY_EMBEDDING_CACHE_MAX_ENTRIES if max_entries is None else max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS query_embeddings ("
+            " key TEXT PRIMARY KEY,"
+            " embedding BLOB NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " last_used REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_query_embeddings_last_used ON query_embeddings (last_used)"
+        )
+        self._conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize_text(text: str) -> str:
+        """全角・半角や空白の違いを吸収（「課題の提出期限は？」と「課題の提出期限は?」を同一視）"""
+        text = unicodedata.normalize("NFKC", text)
+        return " ".join(text.split()).lower()
+
+    @classmethod
+    def make_key(cls, model: str, text: str) -> str:
+        normalized = cls.normalize_text(text)
+        return hashlib.sha256(f"{model}\n{normalized}".encode("utf-8")).hexdigest()
+
+    def get(self, model: str, text: str) -> Optional[List[float]]:
+        """キャッシュ済みの埋め込みを取得（期限切れはNone）"""
+        key = self.make_key(model, text)
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT embedding, created_at FROM query_embeddings WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or now - row[1] > self.ttl_seconds:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE query_embeddings SET last_used = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+        return np.frombuffer(row[0], dtype=np.float32).tolist()
+
+    def put(self, model: str, text: str, embedding: List[float]):
+        """埋め込みを保存し、上限を超えた分は最後に使われた日時が古いものから削除"""
+        key = self.make_key(model, text)
+        now = time.time()
+        blob = np.asarray(embedding, dtype=np.float32).tobytes()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO query_embeddings (key, embedding, created_at, last_used) VALUES (?, ?, ?, ?)",
+                (key, blob, now, now)
+            )
+            self._conn.execute(
+                "DELETE FROM query_embeddings WHERE created_at < ?", (now - self.ttl_seconds,)
+            )
+            self._conn.execute(
+                "DELETE FROM query_embeddings WHERE key IN ("
+                " SELECT key FROM query_embeddings ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM query_embeddings").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "entries": entries,
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0
+        }
+
+class ChunkEmbeddingCache:
+    """チャンクの埋め込みキャッシュ（モデル名 + テキストのSHA-256で引く、全コース・全教材で共有）
+
+    同じ資料を複数コースにアップロードした場合や、一部だけ修正して再アップロードした場合に、
+    変更のないチャンクの埋め込みAPI呼び出しを省く。
+    """
+
+    BATCH_SIZE = 500
+
+    def __init__(self, db_path: Optional[Path] = None, max_entries: Optional[int] = None):
+        self.db_path = Path(db_path) if db_path else Config.CACHE_DIR / "chunk_embeddings.sqlite3"
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_entries = Config.CHUNK_EMBEDDING_CACHE_MAX_ENTRIES if max_entries is None else max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS chunk_embeddings ("
+            " model TEXT NOT NULL,"
+            " text_hash TEXT NOT NULL,"
+            " embedding BLOB NOT NULL,"
+            " last_used REAL NOT NULL,"
+            " PRIMARY KEY (model, text_hash))"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_chunk_embeddings_last_used ON chunk_embeddings (last_used)"
+        )
+        self._conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def text_hash(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get_many(self, model: str, texts: List[str]) -> List[Optional[List[float]]]:
+        """複数チャンクの埋め込みをまとめて取得（ないものはNone）"""
+        hashes = [self.text_hash(text) for text in texts]
+        found = {}
+        now = time.time()
+        with self._lock:
+            for start in range(0, len(hashes), self.BATCH_SIZE):
+                batch = list(set(hashes[start:start + self.BATCH_SIZE]))
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT text_hash, embedding FROM chunk_embeddings"
+                    f" WHERE model = ? AND text_hash IN ({placeholders})",
+                    [model] + batch
+                ).fetchall()
+                found.update(rows)
+                if rows:
+                    self._conn.execute(
+                        f"UPDATE chunk_embeddings SET last_used = ?"
+                        f" WHERE model = ? AND text_hash IN ({','.join('?' * len(rows))})",
+                        [now, model] + [row[0] for row in rows]
+                    )
+            self._conn.commit()
+
+        results = []
+        for h in hashes:
+            blob = found.get(h)
+            results.append(np.frombuffer(blob, dtype=np.float32).tolist() if blob is not None else None)
+        hits = sum(1 for r in results if r is not None)
+        self.hits += hits
+        self.misses += len(results) - hits
+        return results
+
+    def put_many(self, model: str, texts: List[str], embeddings: List[List[float]]):
+        """埋め込みを保存し、上限を超えた分は最後に使われた日時が古いものから削除"""
+        now = time.time()
+        rows = [
+            (model, self.text_hash(text), np.asarray(embedding, dtype=np.float32).tobytes(), now)
+            for text, embedding in zip(texts, embeddings)
+        ]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO chunk_embeddings (model, text_hash, embedding, last_used)"
+                " VALUES (?, ?, ?, ?)",
+                rows
+            )
+            count = self._conn.execute("SELECT COUNT(*) FROM chunk_embeddings").fetchone()[0]
+            if count > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM chunk_embeddings WHERE rowid IN ("
+                    " SELECT rowid FROM chunk_embeddings ORDER BY last_used ASC LIMIT ?)",
+                    (count - self.max_entries,)
+                )
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM chunk_embeddings").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "entries": entries,
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0
+        }
+
+# プロセス内で共有するチャンク埋め込みキャッシュ（初回使用時に開く）
+_chunk_embedding_cache: Optional[ChunkEmbeddingCache] = None
+_chunk_embedding_cache_lock = threading.Lock()
+
+def get_chunk_embedding_cache() -> ChunkEmbeddingCache:
+    """PDF・Excel・スプレッドシートの取り込みで共有するキャッシュを取得"""
+    global _chunk_embedding_cache
+    with _chunk_embedding_cache_lock:
+        if _chunk_embedding_cache is None:
+            _chunk_embedding_cache = ChunkEmbeddingCache()
+        return _chunk_embedding_cache
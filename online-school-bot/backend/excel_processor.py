@@ -1,207 +1,367 @@
+import openpyxl
 import pandas as pd
+from datetime import datetime
 from pathlib import Path
-from typing import List, Dict, Optional
-import json
-import hashlib
+from typing import Callable, Iterable, Iterator, List, Dict, Optional, Tuple
+import codecs
+import csv
+import re
 from openai import OpenAI
 from config import Config
-import os
+from vector_store import VectorStore
+from course_index import CourseIndex
+from text_chunker import TextChunker
+from embedder import BatchEmbedder
+from extraction_cache import file_sha256, get_extraction_cache
+from atomic_files import place_file
+
+# ひらがな・カタカナ・漢字（CSVのエンコーディング判定用）
+_JAPANESE_CHARS = re.compile(r"[\u3040-\u30ff\u4e00-\u9fff]")
 
 class ExcelProcessor:
     """Excel/CSV教材の処理とベクトル化"""
     
+    # 抽出結果キャッシュのキー（抽出方法を変えたら上げる）
+    EXCEL_EXTRACTOR = "excel-rows-v1"
+    
     def __init__(self):
         self.client = OpenAI(api_key=Config.OPENAI_API_KEY) if Config.OPENAI_API_KEY else None
         self.data_dir = Config.PDF_STORAGE_DIR  # 既存のディレクトリ構造を再利用
         self.vector_dir = Config.VECTOR_STORAGE_DIR
         self.data_dir.mkdir(parents=True, exist_ok=True)
         self.vector_dir.mkdir(parents=True, exist_ok=True)
+        self.vector_store = VectorStore(self.vector_dir)
+        self.chunker = TextChunker()
+        self.embedder = BatchEmbedder(self.client, self.chunker.count_tokens)
+        self.extraction_cache = get_extraction_cache()
     
-    def extract_text_from_excel(self, file_path: str) -> str:
-        """Excelファイルからテキストを抽出"""
-        try:
-            # Excelファイルを読み込み
+    @staticmethod
+    def format_value(value) -> str:
+        """セルの値を文字列に（整数値のfloatや日付は短く表す）"""
+        if isinstance(value, float) and value.is_integer():
+            return str(int(value))
+        if isinstance(value, datetime):
+            return value.strftime("%Y-%m-%d %H:%M") if (value.hour or value.minute) else value.strftime("%Y-%m-%d")
+        return " ".join(str(value).split())
+    
+    @staticmethod
+    def is_blank(value) -> bool:
+        """空のセルか（openpyxlはNone、pandasで読んだ.xlsはNaN）"""
+        return value is None or (isinstance(value, float) and value != value)
+    
+    @classmethod
+    def format_row(cls, headers: List[str], values) -> str:
+        """1行を「列名: 値 | 列名: 値 | …」の形にする（空のセルは省く）"""
+        fields = []
+        for i, value in enumerate(values):
+            if cls.is_blank(value):
+                continue
+            text = cls.format_value(value)
+            if not text:
+                continue
+            header = headers[i] if i < len(headers) and headers[i] else f"列{i + 1}"
+            fields.append(f"{header}: {text}")
+        return " | ".join(fields)
+    
+    def _read_sheet_rows(self, file_path: str) -> Iterator[Tuple[str, Iterator[Tuple[int, tuple]]]]:
+        """シートごとに(シート名, (行番号, セルの値)の列)を返す
+
+        .xlsxは読み取り専用モードで1行ずつ読み、シート全体をメモリに載せない。
+        openpyxlで読めない.xlsはpandasで読み込む。
+        """
+        if Path(file_path).suffix.lower() == ".xls":
             excel_file = pd.ExcelFile(file_path)
-            text_parts = []
-            
-            # 各シートを処理
             for sheet_name in excel_file.sheet_names:
-                df = pd.read_excel(excel_file, sheet_name=sheet_name)
-                text_parts.append(f"シート名: {sheet_name}\n")
-                # データフレームをテキスト形式に変換
-                text_parts.append(df.to_string(index=False))
-                text_parts.append("\n\n")
-            
-            return "\n".join(text_parts).strip()
+                df = pd.read_excel(excel_file, sheet_name=sheet_name, header=None)
+                yield sheet_name, ((i + 1, tuple(row)) for i, row in enumerate(df.itertuples(index=False)))
+            return
+        
+        workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+        try:
+            for worksheet in workbook.worksheets:
+                yield worksheet.title, enumerate(worksheet.iter_rows(values_only=True), start=1)
+        finally:
+            workbook.close()
+    
+    def iter_excel_rows(self, file_path: str, file_hash: Optional[str] = None) -> Iterator[Tuple[str, int, str]]:
+        """Excelの各行を(シート名, 行番号, 行のテキスト)で順に返す
+
+        最初の空でない行を見出しとして、以降の行を「列名: 値 | …」の形にする。
+        同じ内容のファイルを抽出済みならキャッシュから返し、なければ読みながら返して最後に保存する。
+        保存用に溜めた行のテキストがEXTRACTION_CACHE_MAX_ENTRY_BYTESを超えたら溜めるのをやめて
+        キャッシュしない（大きいブックでもメモリ使用量がファイルの大きさに比例しないように）。
+        """
+        file_hash = file_hash or file_sha256(Path(file_path))
+        cached = self.extraction_cache.get(file_hash, self.EXCEL_EXTRACTOR)
+        if cached is not None:
+            for sheet_name, rows in cached:
+                for row_number, row_text in rows:
+                    yield sheet_name, row_number, row_text
+            return
+        
+        sheets = []
+        cached_bytes = 0
+        try:
+            for sheet_name, rows in self._read_sheet_rows(file_path):
+                sheet_rows = []
+                if sheets is not None:
+                    sheets.append((sheet_name, sheet_rows))
+                headers = None
+                for row_number, values in rows:
+                    if headers is None:
+                        if any(not self.is_blank(v) and str(v).strip() for v in values):
+                            headers = ["" if self.is_blank(v) else self.format_value(v) for v in values]
+                        continue
+                    row_text = self.format_row(headers, values)
+                    if not row_text:
+                        continue
+                    if sheets is not None:
+                        cached_bytes += len(row_text.encode("utf-8"))
+                        if cached_bytes > Config.EXTRACTION_CACHE_MAX_ENTRY_BYTES:
+                            print(f"抽出結果が大きいためキャッシュしません: {Path(file_path).name}")
+                            sheets = None
+                            sheet_rows = []
+                        else:
+                            sheet_rows.append((row_number, row_text))
+                    yield sheet_name, row_number, row_text
         except Exception as e:
             raise Exception(f"Excel抽出失敗: {str(e)}")
+        
+        if sheets is not None:
+            self.extraction_cache.put(file_hash, self.EXCEL_EXTRACTOR, sheets)
     
-    def extract_text_from_csv(self, file_path: str) -> str:
-        """CSVファイルからテキストを抽出"""
+    @staticmethod
+    def _row_range(sheet_name: Optional[str], row_start: int, row_end: int) -> Tuple[str, Dict]:
+        """チャンク先頭に付ける見出しとメタ情報（CSVはシート名なし）"""
+        rows = f"{row_start}行目" if row_start == row_end else f"{row_start}〜{row_end}行目"
+        meta = {"row_start": row_start, "row_end": row_end}
+        if sheet_name is None:
+            return f"（{rows}）", meta
+        return f"シート名: {sheet_name}（{rows}）", {"sheet": sheet_name, **meta}
+    
+    def chunk_rows(self, rows: Iterable[Tuple[Optional[str], int, str]]) -> Iterator[Tuple[str, Dict]]:
+        """行をトークン数の上限まで詰めてチャンクにする（メタ情報はシート名と行範囲）
+
+        各チャンクの先頭にシート名と行範囲を付け、行の途中では切らない。
+        1行だけで上限を超える場合はその行を文単位で分割する。
+        """
+        sheet_name = None
+        lines = []
+        tokens = 0
+        row_start = row_end = None
+        
+        def emit():
+            header, meta = self._row_range(sheet_name, row_start, row_end)
+            return header + "\n" + "\n".join(lines), meta
+        
+        for row_sheet, row_number, row_text in rows:
+            row_tokens = self.chunker.count_tokens(row_text) + 1
+            if lines and (row_sheet != sheet_name or tokens + row_tokens > self.chunker.max_tokens):
+                yield emit()
+                lines = []
+            if not lines:
+                sheet_name = row_sheet
+                row_start = row_number
+                tokens = self.chunker.count_tokens(self._row_range(sheet_name, row_number, row_number + 1)[0])
+            if tokens + row_tokens > self.chunker.max_tokens:
+                # 1行で上限を超える長い行
+                header, meta = self._row_range(sheet_name, row_number, row_number)
+                for piece in self.chunker.split(row_text):
+                    yield f"{header}\n{piece}", meta
+                continue
+            lines.append(row_text)
+            tokens += row_tokens
+            row_end = row_number
+        
+        if lines:
+            yield emit()
+    
+    def extract_sheets_from_excel(self, file_path: str, file_hash: Optional[str] = None) -> List[Tuple[str, str]]:
+        """Excelファイルからシートごとのテキストを抽出"""
+        sheets = []
+        for sheet_name, _, row_text in self.iter_excel_rows(file_path, file_hash):
+            if not sheets or sheets[-1][0] != sheet_name:
+                sheets.append((sheet_name, [f"シート名: {sheet_name}\n"]))
+            sheets[-1][1].append(row_text)
+        return [(sheet_name, "\n".join(lines)) for sheet_name, lines in sheets]
+    
+    def extract_text_from_excel(self, file_path: str, file_hash: Optional[str] = None) -> str:
+        """Excelファイルからテキストを抽出"""
+        return "\n\n\n".join(text for _, text in self.extract_sheets_from_excel(file_path, file_hash)).strip()
+    
+    @staticmethod
+    def detect_encoding(file_path: str, sample_size: int = 64 * 1024) -> str:
+        """先頭のバイト列からCSVのエンコーディングを判定
+
+        BOM → UTF-8（厳密にデコードできるか） → CP932/EUC-JP（デコードでき、
+        かな・漢字の割合が高い方） → latin-1 の順に判定する。
+        """
+        with open(file_path, "rb") as f:
+            sample = f.read(sample_size)
+        
+        if sample.startswith(codecs.BOM_UTF8):
+            return "utf-8-sig"
+        if sample.startswith(codecs.BOM_UTF16_LE) or sample.startswith(codecs.BOM_UTF16_BE):
+            return "utf-16"
+        
+        def decode(encoding: str) -> Optional[str]:
+            # サンプル末尾で切れた文字は無視する（final=False）
+            try:
+                return codecs.getincrementaldecoder(encoding)().decode(sample, final=False)
+            except UnicodeDecodeError:
+                return None
+        
+        if decode("utf-8") is not None:
+            return "utf-8"
+        
+        best_encoding, best_score = None, -1.0
+        for encoding in ("cp932", "euc_jp"):
+            text = decode(encoding)
+            if text is None:
+                continue
+            japanese = len(_JAPANESE_CHARS.findall(text))
+            score = japanese / max(1, len(text))
+            if score > best_score:
+                best_encoding, best_score = encoding, score
+        return best_encoding or "latin-1"
+    
+    def iter_csv_rows(self, file_path: str) -> Iterator[Tuple[None, int, str]]:
+        """CSVの各行を(None, 行番号, 行のテキスト)で順に返す（1行目を見出しとして「列名: 値 | …」にする）
+
+        ファイル全体を読み込まず、1行ずつ読んでチャンク分割に渡す。
+        """
+        encoding = self.detect_encoding(file_path)
         try:
-            # エンコーディングを自動検出
-            encodings = ['utf-8', 'shift_jis', 'cp932', 'euc-jp', 'latin-1']
-            df = None
-            
-            for encoding in encodings:
-                try:
-                    df = pd.read_csv(file_path, encoding=encoding)
-                    break
-                except UnicodeDecodeError:
-                    continue
-            
-            if df is None:
-                raise Exception("CSVファイルのエンコーディングを検出できませんでした")
-            
-            # データフレームをテキスト形式に変換
-            return df.to_string(index=False)
+            # 判定に使った先頭以降に不正なバイトがあっても止めずに置き換える
+            with open(file_path, encoding=encoding, errors="replace", newline="") as f:
+                reader = csv.reader(f)
+                headers = None
+                for row_number, values in enumerate(reader, start=1):
+                    if headers is None:
+                        if any(v.strip() for v in values):
+                            headers = [v.strip() for v in values]
+                        continue
+                    row_text = self.format_row(headers, [v if v.strip() else None for v in values])
+                    if row_text:
+                        yield None, row_number, row_text
         except Exception as e:
             raise Exception(f"CSV抽出失敗: {str(e)}")
     
-    def split_text(self, text: str, chunk_size: int = 1000, overlap: int = 200) -> List[str]:
-        """テキストをチャンクに分割（PDFProcessorと同じロジック）"""
-        chunks = []
-        words = text.split()
-        current_chunk = []
-        current_length = 0
-        
-        for word in words:
-            word_length = len(word) + 1  # +1 for space
-            if current_length + word_length > chunk_size and current_chunk:
-                chunks.append(" ".join(current_chunk))
-                # オーバーラップ
-                overlap_words = current_chunk[-overlap:] if len(current_chunk) > overlap else current_chunk
-                current_chunk = overlap_words + [word]
-                current_length = sum(len(w) + 1 for w in current_chunk)
-            else:
-                current_chunk.append(word)
-                current_length += word_length
-        
-        if current_chunk:
-            chunks.append(" ".join(current_chunk))
-        
-        return chunks
+    def extract_text_from_csv(self, file_path: str) -> str:
+        """CSVファイルからテキストを抽出"""
+        return "\n".join(row_text for _, _, row_text in self.iter_csv_rows(file_path))
+    
+    def split_text(self, text: str) -> List[str]:
+        """テキストをチャンクに分割（PDFProcessorと共通のチャンカー）"""
+        return self.chunker.split(text)
     
     def create_embeddings(self, texts: List[str]) -> List[List[float]]:
-        """テキストのベクトル化（PDFProcessorと同じロジック）"""
-        if not self.client:
-            raise Exception("OpenAI APIキーが設定されていません")
-        
-        embeddings = []
-        # バッチ処理（最大100件ずつ）
-        batch_size = 100
-        for i in range(0, len(texts), batch_size):
-            batch = texts[i:i+batch_size]
-            try:
-                response = self.client.embeddings.create(
-                    model=Config.EMBEDDING_MODEL,
-                    input=batch
-                )
-                batch_embeddings = [item.embedding for item in response.data]
-                embeddings.extend(batch_embeddings)
-            except Exception as e:
-                print(f"埋め込み生成エラー: {e}")
-                raise
-        
+        """テキストのベクトル化（キャッシュ済みのチャンクはAPIを呼ばない）"""
+        embeddings, _ = self.embedder.embed(texts)
         return embeddings
     
-    def process_file(self, file_path: str, course_id: str, file_type: str) -> Dict:
-        """Excel/CSVファイルを処理してベクトル化し、保存"""
-        # ファイルをコースごとのディレクトリに保存
-        course_data_dir = self.data_dir / course_id
-        course_data_dir.mkdir(parents=True, exist_ok=True)
-        
-        # ファイルをコピー
+    def process_file(self, file_path: str, course_id: str, file_type: str,
+                     progress: Optional[Callable] = None, file_hash: Optional[str] = None,
+                     rebuild_index: bool = True, filename: Optional[str] = None,
+                     move_source: bool = False) -> Dict:
+        """Excel/CSVファイルを処理してベクトル化し、保存（progressには段階とチャンクの処理数が通知される）
+
+        元ファイルはfile_pathから読み、ベクトルを保存してからコースのディレクトリへ置く
+        （move_source=Trueなら移動、Falseならコピー、保存名はfilenameか元のファイル名）。
+        取り込みに失敗した場合、同じ名前の取り込み済み教材の元ファイルは置き換わらない。
+
+        rebuild_index=Falseならコースのバージョン更新と近似最近傍インデックスの再構築をしない
+        （一括取り込みで最後に1回だけ行う場合）。
+        """
+        # ファイルの保存先（コースごとのディレクトリ）
         source_file = Path(file_path)
-        saved_path = course_data_dir / source_file.name
-        import shutil
-        shutil.copy2(file_path, saved_path)
+        saved_path = self.data_dir / course_id / (filename or source_file.name)
+        file_hash = file_hash or file_sha256(source_file)
+        
+        # ファイルタイプに応じてテキスト抽出・チャンク分割
+        if progress:
+            progress("extracting")
+        text_length = 0
+        chunk_meta = []
         
-        # ファイルタイプに応じてテキスト抽出
+        # 行を読みながら「列名: 値」の形でチャンクにし、シート名と行範囲を付ける
         if file_type == "excel":
-            text = self.extract_text_from_excel(str(saved_path))
+            rows = self.iter_excel_rows(str(source_file), file_hash)
         elif file_type == "csv":
-            text = self.extract_text_from_csv(str(saved_path))
+            rows = self.iter_csv_rows(str(source_file))
         else:
             raise Exception(f"サポートされていないファイルタイプ: {file_type}")
         
-        # チャンク分割
-        chunks = self.split_text(text)
+        def counted_rows():
+            nonlocal text_length
+            for row in rows:
+                text_length += len(row[2]) + 1
+                yield row
         
-        # ベクトル化
-        embeddings = self.create_embeddings(chunks)
+        def chunk_stream():
+            for chunk, meta in self.chunk_rows(counted_rows()):
+                chunk_meta.append(meta)
+                yield chunk
+        
+        # ベクトル化（チャンクができた順にバッチを送る）
+        dimensions = self.vector_store.embedding_dimensions(course_id)
+        chunks, embeddings, embedding_stats = self.embedder.embed_stream(
+            chunk_stream(), progress, dimensions=dimensions
+        )
         
         # メタデータとベクトルを保存
-        vector_file = self.vector_dir / f"{course_id}_{saved_path.stem}_{file_type}.json"
-        data = {
+        if progress:
+            progress("saving")
+        vector_name = f"{course_id}_{saved_path.stem}_{file_type}"
+        info = {
             "course_id": course_id,
             "file_path": str(saved_path),
             "file_type": file_type,
-            "chunks": chunks,
-            "embeddings": embeddings,
+            "source_type": file_type,
+            "embedding_model": self.embedder.model,
+            "embedding_dimensions": dimensions,
             "metadata": {
-                "filename": source_file.name,
+                "filename": saved_path.name,
+                "sha256": file_hash,
                 "chunk_count": len(chunks),
-                "total_text_length": len(text)
+                "total_text_length": text_length
             }
         }
+        vector_file = self.vector_store.save(vector_name, chunks, embeddings, info, chunk_meta,
+                                             update_version=rebuild_index)
+        if source_file.resolve() != saved_path.resolve():
+            place_file(source_file, saved_path, move=move_source)
         
-        with open(vector_file, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        # 大きいコースは近似最近傍インデックスを再構築
+        ann = None
+        if rebuild_index:
+            if progress:
+                progress("indexing")
+            ann = CourseIndex.rebuild_ann(self.vector_store, course_id)
         
         return {
             "course_id": course_id,
             "file_path": str(saved_path),
             "vector_file": str(vector_file),
             "chunk_count": len(chunks),
-            "text_length": len(text),
-            "file_type": file_type
+            "text_length": text_length,
+            "file_type": file_type,
+            "ann": ann,
+            "embeddings": embedding_stats
         }
     
-    def load_vectors(self, course_id: str, file_type: Optional[str] = None) -> Optional[Dict]:
-        """コースのベクトルデータを読み込み"""
-        if file_type:
-            pattern = f"{course_id}_*_{file_type}.json"
-        else:
-            pattern = f"{course_id}_*.json"
-        
-        vector_files = list(self.vector_dir.glob(pattern))
-        if not vector_files:
-            return None
-        
-        # 最新のファイルを読み込み
-        latest_file = max(vector_files, key=lambda p: p.stat().st_mtime)
-        with open(latest_file, "r", encoding="utf-8") as f:
-            return json.load(f)
-    
-    def search_similar_chunks(self, query_embedding: List[float], course_id: str, top_k: int = 5) -> List[Dict]:
-        """類似チャンクを検索（PDFProcessorと同じロジック）"""
-        vector_data = self.load_vectors(course_id)
-        if not vector_data:
-            return []
-        
-        chunks = vector_data["chunks"]
-        embeddings = vector_data["embeddings"]
-        
-        # コサイン類似度を計算
-        import numpy as np
-        
-        query_vec = np.array(query_embedding)
-        similarities = []
-        
-        for i, emb in enumerate(embeddings):
-            emb_vec = np.array(emb)
-            # コサイン類似度
-            similarity = np.dot(query_vec, emb_vec) / (np.linalg.norm(query_vec) * np.linalg.norm(emb_vec))
-            similarities.append((similarity, i, chunks[i]))
-        
-        # 上位k件を返す
-        similarities.sort(reverse=True, key=lambda x: x[0])
-        return [
-            {
-                "chunk": chunk,
-                "similarity": float(sim),
-                "index": idx
-            }
-            for sim, idx, chunk in similarities[:top_k]
-        ]
+    def load_vectors(self, course_id: str) -> Optional[CourseIndex]:
+        """コースのベクトルデータを読み込み（全教材をまとめたインデックス）"""
+        return CourseIndex.get(self.vector_store, course_id)
+    
+    def search_similar_chunks(self, query_embedding: Optional[List[float]], course_id: str, top_k: int = 5,
+                              file_type: Optional[str] = None, query_text: Optional[str] = None) -> List[Dict]:
+        """類似チャンクを検索（コース内の全Excel/CSVと、コースに追加された共有ライブラリのExcel/CSVが対象）
+
+        query_textを渡すとBM25とのハイブリッド検索（query_embeddingがNoneならBM25のみ）。
+        """
+        source_types = [file_type] if file_type else ["excel", "csv"]
+        return CourseIndex.search_with_library(
+            self.vector_store, course_id, query_embedding, top_k, source_types=source_types,
+            query_text=query_text
+        )
@@ -0,0 +1,115 @@
+from pathlib import Path
+from typing import Any, Optional
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import zlib
+from config import Config
+
+def file_sha256(path: Path, block_size: int = 1024 * 1024) -> str:
+    """ファイル内容のSHA-256（一定サイズずつ読む）"""
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+class ExtractionCache:
+    """教材から抽出したテキストのキャッシュ（ファイル内容のハッシュ・抽出器の種類とバージョンで引く）
+
+    PDFはページごと、Excelはシートごとのテキストを圧縮して保存する。
+    同じファイルの再アップロードやチャンク設定を変えての再取り込みでは、パースを省いてここから読む。
+    抽出方法を変えたときは抽出器のバージョンを上げれば古い結果は使われなくなる。
+    """
+
+    def __init__(self, db_path: Optional[Path] = None, max_bytes: Optional[int] = None):
+        self.db_path = Path(db_path) if db_path else Config.CACHE_DIR / "extractions.sqlite3"
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = Config.EXTRACTION_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS extractions ("
+            " file_hash TEXT NOT NULL,"
+            " extractor TEXT NOT NULL,"
+            " content BLOB NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " last_used REAL NOT NULL,"
+            " PRIMARY KEY (file_hash, extractor))"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_extractions_last_used ON extractions (last_used)"
+        )
+        self._conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, file_hash: str, extractor: str) -> Optional[Any]:
+        """抽出結果を取得（なければNone）"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT content FROM extractions WHERE file_hash = ? AND extractor = ?",
+                (file_hash, extractor)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute(
+                "UPDATE extractions SET last_used = ? WHERE file_hash = ? AND extractor = ?",
+                (time.time(), file_hash, extractor)
+            )
+            self._conn.commit()
+            self.hits += 1
+        return json.loads(zlib.decompress(row[0]).decode("utf-8"))
+
+    def put(self, file_hash: str, extractor: str, content: Any):
+        """抽出結果を保存し、合計サイズが上限を超えた分は最後に使われた日時が古いものから削除"""
+        blob = zlib.compress(json.dumps(content, ensure_ascii=False).encode("utf-8"))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO extractions (file_hash, extractor, content, size, last_used)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (file_hash, extractor, blob, len(blob), time.time())
+            )
+            total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM extractions").fetchone()[0]
+            if total > self.max_bytes:
+                rows = self._conn.execute(
+                    "SELECT rowid, size FROM extractions ORDER BY last_used ASC"
+                ).fetchall()
+                expired = []
+                for rowid, size in rows:
+                    if total <= self.max_bytes:
+                        break
+                    expired.append((rowid,))
+                    total -= size
+                self._conn.executemany("DELETE FROM extractions WHERE rowid = ?", expired)
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries, total = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM extractions"
+            ).fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "entries": entries,
+            "bytes": total,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0
+        }
+
+# プロセス内で共有する抽出結果キャッシュ（初回使用時に開く）
+_extraction_cache: Optional[ExtractionCache] = None
+_extraction_cache_lock = threading.Lock()
+
+def get_extraction_cache() -> ExtractionCache:
+    """PDF・Excelの取り込みで共有するキャッシュを取得"""
+    global _extraction_cache
+    with _extraction_cache_lock:
+        if _extraction_cache is None:
+            _extraction_cache = ExtractionCache()
+        return _extraction_cache
@@ -0,0 +1,106 @@
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Any
+import threading
+import time
+from config import Config
+
+class CourseIndexCache:
+    """読み込み済みコースインデックスのLRUキャッシュ（バイト数上限 + ファイル更新で無効化）"""
+
+    def __init__(self, max_bytes: Optional[int] = None, check_seconds: Optional[float] = None):
+        self.max_bytes = Config.INDEX_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self.check_seconds = Config.INDEX_CACHE_CHECK_SECONDS if check_seconds is None else check_seconds
+        self._entries: "OrderedDict[str, Dict]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, course_id: str, signature_fn: Callable[[], Any], loader: Callable[[], Any]) -> Any:
+        """キャッシュから取得（なければloaderで読み込んで登録）
+
+        signature_fnはコースのバージョン番号（またはファイルの更新日時）から作る値で、前回から変わっていれば読み直す。
+        チェックはcheck_seconds秒に1回だけ行い、それ以外はディスクに触れずに返す。
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(course_id)
+            if entry and now - entry["checked_at"] < self.check_seconds:
+                self._entries.move_to_end(course_id)
+                self.hits += 1
+                return entry["index"]
+
+        signature = signature_fn()
+        with self._lock:
+            entry = self._entries.get(course_id)
+            if entry and entry["signature"] == signature:
+                entry["checked_at"] = now
+                self._entries.move_to_end(course_id)
+                self.hits += 1
+                return entry["index"]
+            self.misses += 1
+
+        index = loader()
+        nbytes = index.nbytes if index is not None else 0
+        with self._lock:
+            self._remove(course_id)
+            if nbytes <= self.max_bytes:
+                self._entries[course_id] = {
+                    "index": index,
+                    "signature": signature,
+                    "checked_at": now,
+                    "nbytes": nbytes
+                }
+                self.total_bytes += nbytes
+                self._evict()
+        return index
+
+    def invalidate(self, course_id: Optional[str] = None):
+        """コースのキャッシュを破棄（Noneなら全件）"""
+        with self._lock:
+            course_ids = list(self._entries) if course_id is None else [course_id]
+            for cid in course_ids:
+                if self._remove(cid):
+                    self.invalidations += 1
+
+    def invalidate_material(self, name: str):
+        """教材の保存名（{course_id}_...）に該当するコースのキャッシュを破棄"""
+        with self._lock:
+            for cid in [cid for cid in self._entries if name.startswith(f"{cid}_")]:
+                if self._remove(cid):
+                    self.invalidations += 1
+
+    def stats(self) -> Dict:
+        """キャッシュの統計情報"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "courses": list(self._entries),
+                "entries": len(self._entries),
+                "total_bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations
+            }
+
+    def _remove(self, course_id: str) -> bool:
+        entry = self._entries.pop(course_id, None)
+        if entry is None:
+            return False
+        self.total_bytes -= entry["nbytes"]
+        return True
+
+    def _evict(self):
+        # 古いものから上限に収まるまで追い出す
+        while self.total_bytes > self.max_bytes and self._entries:
+            course_id = next(iter(self._entries))
+            self._remove(course_id)
+            self.evictions += 1
+
+# プロセス内で共有するキャッシュ（PDF・Excel・スプレッドシート・AIResponderの全検索経路で使用）
+course_index_cache = CourseIndexCache()
@@ -0,0 +1,125 @@
+import numpy as np
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+from atomic_files import fsync_dir
+
+class IndexSnapshots:
+    """コースインデックスの行列を、読み取り専用で共有するバージョン付きファイルとして公開
+
+    uvicornの複数ワーカーがそれぞれ教材の行列を連結・量子化すると、ワーカー数だけメモリを使う。
+    最初に読み込んだプロセスが連結済みの行列（量子化時はint8のコードとスケール）を
+    published/{course_id}/{バージョン}/ に書き出し、各プロセスはそれをmmapで読むので、
+    実体はOSのページキャッシュに1つだけ載る。
+    バージョンは教材ファイルの更新状態から決まり、一度書いたファイルは変更しない。
+    取り込みで教材が変わると、各プロセスは次の読み込みで新しいバージョンに切り替わる。
+    一時ディレクトリに書いてから名前を変えて公開するので、書き込み途中のものは読まれない。
+    """
+
+    MANIFEST = "manifest.json"
+    # 読み込み中のプロセスのために、最新の1つ前のバージョンまで残す
+    KEEP_VERSIONS = 2
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+
+    @staticmethod
+    def version(material_stats: List[tuple], mode: str) -> str:
+        """教材ファイルの状態（名前・inode・更新日時・サイズ）と行列の種類からバージョンを決める"""
+        key = json.dumps([mode] + [list(s) for s in material_stats], ensure_ascii=False)
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+    def course_dir(self, course_id: str) -> Path:
+        return self.root / course_id
+
+    def open(self, course_id: str, version: str) -> Optional[Dict[str, np.ndarray]]:
+        """公開済みの行列を読み取り専用のmmapで開く（なければNone）"""
+        path = self.course_dir(course_id) / version
+        try:
+            with open(path / self.MANIFEST, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            return {name: np.load(path / f"{name}.npy", mmap_mode="r") for name in manifest["arrays"]}
+        except FileNotFoundError:
+            return None
+
+    def get_or_publish(self, course_id: str, version: str,
+                       build: Callable[[], Dict[str, np.ndarray]]) -> Dict[str, np.ndarray]:
+        """公開済みならそれを開き、なければbuildで作った行列を書き出してから開く"""
+        arrays = self.open(course_id, version)
+        if arrays is not None:
+            return arrays
+
+        course_dir = self.course_dir(course_id)
+        course_dir.mkdir(parents=True, exist_ok=True)
+        tmp_dir = course_dir / f".{version}.{uuid.uuid4().hex}.tmp"
+        tmp_dir.mkdir()
+        try:
+            built = build()
+            for name, array in built.items():
+                with open(tmp_dir / f"{name}.npy", "wb") as f:
+                    np.save(f, array)
+                    f.flush()
+                    os.fsync(f.fileno())
+            with open(tmp_dir / self.MANIFEST, "w", encoding="utf-8") as f:
+                json.dump({
+                    "course_id": course_id,
+                    "version": version,
+                    "arrays": {name: [list(a.shape), str(a.dtype)] for name, a in built.items()},
+                    "created_at": time.time()
+                }, f, ensure_ascii=False)
+                f.flush()
+                os.fsync(f.fileno())
+            del built
+            # 中身をディスクに書き切ってから名前を変える（電源断後に空のファイルが公開されないように）
+            fsync_dir(tmp_dir)
+            try:
+                os.rename(tmp_dir, course_dir / version)
+                fsync_dir(course_dir)
+            except OSError:
+                # 別のプロセスが先に同じバージョンを公開した
+                pass
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        self.prune(course_id, keep=version)
+        arrays = self.open(course_id, version)
+        if arrays is None:
+            raise Exception(f"インデックスの公開に失敗しました ({course_id} {version})")
+        return arrays
+
+    def prune(self, course_id: str, keep: Optional[str] = None):
+        """古いバージョンを削除（mmap中のプロセスはファイル削除後もそのまま読める）"""
+        course_dir = self.course_dir(course_id)
+        if not course_dir.exists():
+            return
+        versions = sorted(
+            (p for p in course_dir.iterdir() if p.is_dir() and not p.name.startswith(".")),
+            key=lambda p: p.stat().st_mtime,
+            reverse=True
+        )
+        others = [p for p in versions if p.name != keep]
+        keep_others = self.KEEP_VERSIONS - (1 if len(others) < len(versions) else 0)
+        for path in others[keep_others:]:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def remove(self, course_id: str):
+        """コースの公開済み行列をすべて削除"""
+        shutil.rmtree(self.course_dir(course_id), ignore_errors=True)
+
+    def stats(self) -> Dict:
+        courses = {}
+        if self.root.exists():
+            for course_dir in self.root.iterdir():
+                if not course_dir.is_dir():
+                    continue
+                files = [p for p in course_dir.rglob("*") if p.is_file()]
+                courses[course_dir.name] = {
+                    "versions": sum(1 for p in course_dir.iterdir() if p.is_dir() and not p.name.startswith(".")),
+                    "bytes": sum(p.stat().st_size for p in files)
+                }
+        return courses
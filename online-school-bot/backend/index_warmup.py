@@ -0,0 +1,97 @@
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+import threading
+import time
+import numpy as np
+from config import Config
+from course_index import CourseIndex
+from index_cache import course_index_cache
+
+class IndexWarmup:
+    """起動時に利用の多いコースのインデックスを読み込んでおく
+
+    デプロイ直後は各コースの最初の質問でインデックスの読み込みを待つことになるため、
+    直近の会話数が多いコースから順にキャッシュへ載せ、行列のページも一度触れておく。
+    それ以外のコースは従来どおり最初の質問で読み込む。
+    完了するまではreadyがFalseのままなので、readinessの判定に使える。
+    """
+
+    def __init__(self, vector_store, conversation_manager, course_manager,
+                 max_courses: Optional[int] = None, activity_days: Optional[int] = None):
+        self.vector_store = vector_store
+        self.conversation_manager = conversation_manager
+        self.course_manager = course_manager
+        self.max_courses = Config.WARMUP_COURSES if max_courses is None else max_courses
+        self.activity_days = Config.WARMUP_ACTIVITY_DAYS if activity_days is None else activity_days
+        self.status = "pending"  # pending, warming, ready
+        self.courses: List[Dict] = []
+        self.started_at = None
+        self.finished_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self) -> bool:
+        return self.status == "ready"
+
+    def hot_courses(self) -> List[str]:
+        """会話数の多いコース（会話のないコースは含めない）"""
+        course_ids = [course["course_id"] for course in self.course_manager.get_all_courses()
+                      if course.get("course_id")]
+        since = datetime.now() - timedelta(days=self.activity_days) if self.activity_days else None
+        counts = self.conversation_manager.count_by_course(course_ids, since)
+        ranked = sorted((c for c in course_ids if counts[c] > 0), key=lambda c: counts[c], reverse=True)
+        return ranked[:self.max_courses]
+
+    @staticmethod
+    def touch(course_index: CourseIndex):
+        """行列（mmap）のページを読み込んでおくため、ダミーのクエリで一度総当たり検索する"""
+        dim = course_index.matrices[0].shape[1]
+        query_vec = np.full(dim, 1.0 / np.sqrt(dim), dtype=np.float32)
+        course_index.vector_search(query_vec, 1, exact=True)
+
+    def run(self) -> Dict:
+        """ウォームアップを実行（キャッシュの上限を超えて追い出しが起きたらそこで打ち切る）"""
+        with self._lock:
+            self.status = "warming"
+            self.started_at = time.time()
+        try:
+            library_warmed = False
+            if self.max_courses > 0 and self.vector_store is not None:
+                for course_id in self.hot_courses():
+                    evictions = course_index_cache.stats()["evictions"]
+                    started = time.perf_counter()
+                    result = {"course_id": course_id}
+                    try:
+                        course_index = CourseIndex.get(self.vector_store, course_id)
+                        if course_index is not None:
+                            self.touch(course_index)
+                            result.update({"chunk_count": course_index.chunk_count, "bytes": course_index.nbytes})
+                        # 共有ライブラリのインデックスは全コースで1つなので、最初に使うコースで一度だけ読み込む
+                        library = CourseIndex.get_library(self.vector_store, course_id)
+                        if library is not None and not library_warmed:
+                            self.touch(library[0])
+                            library_warmed = True
+                            result["library_chunk_count"] = library[0].chunk_count
+                    except Exception as e:
+                        print(f"インデックスのウォームアップエラー ({course_id}): {e}")
+                        result["error"] = str(e)
+                    result["seconds"] = round(time.perf_counter() - started, 3)
+                    self.courses.append(result)
+                    if course_index_cache.stats()["evictions"] > evictions:
+                        print("インデックスキャッシュの上限に達したため、ウォームアップを打ち切ります")
+                        break
+        finally:
+            with self._lock:
+                self.status = "ready"
+                self.finished_at = time.time()
+        return self.to_dict()
+
+    def to_dict(self) -> Dict:
+        with self._lock:
+            end = self.finished_at or time.time()
+            return {
+                "status": self.status,
+                "ready": self.status == "ready",
+                "courses": list(self.courses),
+                "seconds": round(end - self.started_at, 3) if self.started_at else None
+            }
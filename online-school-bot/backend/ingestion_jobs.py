@@ -0,0 +1,326 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Set, Tuple
+import json
+import os
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+from config import Config
+
+# ジョブの段階（画面表示用）
+STAGE_LABELS = {
+    "queued": "待機中",
+    "unpacking": "zip展開中",
+    "ingesting": "教材を一括取り込み中",
+    "extracting": "テキスト抽出中",
+    "chunking": "チャンク分割中",
+    "embedding": "ベクトル化中",
+    "saving": "保存中",
+    "indexing": "インデックス更新中",
+    "compacting": "保存データ整理中",
+    "library": "共有ライブラリに集約中",
+    "done": "完了",
+    "failed": "失敗"
+}
+
+def job_dict(fields: Dict) -> Dict:
+    """ジョブの状態をAPIの応答の形にする（ワーカーのジョブ・保存済みのジョブで共通）"""
+    now = fields["finished_at"] or time.time()
+    started_at = fields["started_at"]
+    elapsed = now - started_at if started_at else 0.0
+    done, total = fields["chunks_done"], fields["chunks_total"]
+    return {
+        "job_id": fields["job_id"],
+        "kind": fields["kind"],
+        "course_id": fields["course_id"],
+        "filename": fields["filename"],
+        "status": fields["status"],
+        "stage": fields["stage"],
+        "stage_label": STAGE_LABELS.get(fields["stage"], fields["stage"]),
+        "progress": {
+            "chunks_done": done,
+            "chunks_total": total,
+            "ratio": done / total if total else None
+        },
+        "elapsed_seconds": round(elapsed, 3),
+        "chunks_per_second": round(done / elapsed, 1) if elapsed > 0 else None,
+        "created_at": datetime.fromtimestamp(fields["created_at"]).isoformat(),
+        "result": fields["result"],
+        "error": fields["error"]
+    }
+
+class IngestionJobStore:
+    """ジョブの状態を保存するSQLite（どのワーカープロセスからも同じジョブを参照できる）
+
+    uvicornを複数ワーカーで動かすと、ジョブを登録したプロセスと状態を問い合わせるプロセスが
+    別になるため、状態はメモリではなくここに書く。
+    """
+
+    _COLUMNS = ("job_id", "kind", "course_id", "filename", "status", "stage", "chunks_done", "chunks_total",
+                "result", "error", "created_at", "started_at", "finished_at", "pid")
+
+    def __init__(self, db_path: Optional[Path] = None):
+        self.db_path = Path(db_path) if db_path else Config.CACHE_DIR / "ingestion_jobs.sqlite3"
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False, timeout=30)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " job_id TEXT PRIMARY KEY,"
+            " kind TEXT NOT NULL,"
+            " course_id TEXT,"
+            " filename TEXT,"
+            " status TEXT NOT NULL,"
+            " stage TEXT NOT NULL,"
+            " chunks_done INTEGER NOT NULL,"
+            " chunks_total INTEGER NOT NULL,"
+            " result TEXT,"
+            " error TEXT,"
+            " created_at REAL NOT NULL,"
+            " started_at REAL,"
+            " finished_at REAL,"
+            " pid INTEGER NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_created_at ON jobs (created_at)")
+        self._conn.commit()
+
+    def save(self, fields: Dict):
+        row = [fields[column] for column in self._COLUMNS]
+        row[self._COLUMNS.index("result")] = json.dumps(fields["result"], ensure_ascii=False, default=str)
+        with self._lock:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO jobs ({', '.join(self._COLUMNS)}) "
+                f"VALUES ({', '.join('?' for _ in self._COLUMNS)})",
+                row
+            )
+            self._conn.commit()
+
+    def _fields(self, row) -> Dict:
+        fields = dict(zip(self._COLUMNS, row))
+        fields["result"] = json.loads(fields["result"]) if fields["result"] else None
+        return fields
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT {', '.join(self._COLUMNS)} FROM jobs WHERE job_id = ?", (job_id,)
+            ).fetchone()
+        return self._fields(row) if row else None
+
+    def list(self, course_id: Optional[str] = None) -> List[Dict]:
+        """保存済みのジョブ（新しい順）"""
+        query = f"SELECT {', '.join(self._COLUMNS)} FROM jobs"
+        params = ()
+        if course_id is not None:
+            query += " WHERE course_id = ?"
+            params = (course_id,)
+        with self._lock:
+            rows = self._conn.execute(query + " ORDER BY created_at DESC", params).fetchall()
+        return [self._fields(row) for row in rows]
+
+    def active_courses(self, exclude_kinds: Tuple[str, ...] = ()) -> Set[str]:
+        """待機中・実行中のジョブがあるコース（全ワーカープロセス分、exclude_kindsの種類のジョブは除く）"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT course_id, kind FROM jobs WHERE finished_at IS NULL AND course_id IS NOT NULL"
+            ).fetchall()
+        return {course_id for course_id, kind in rows if kind not in exclude_kinds}
+
+    def fail_orphans(self):
+        """終了したプロセスが残した未完了のジョブを失敗にする
+
+        起動したばかりのプロセスはまだジョブを持たないので、同じPIDのジョブも前回の残りとみなす
+        （コンテナではPIDが再利用されるため）。
+        """
+        now = time.time()
+        with self._lock:
+            rows = self._conn.execute("SELECT job_id, pid FROM jobs WHERE finished_at IS NULL").fetchall()
+            orphans = [job_id for job_id, pid in rows if pid == os.getpid() or not _process_alive(pid)]
+            for job_id in orphans:
+                self._conn.execute(
+                    "UPDATE jobs SET status = 'failed', stage = 'failed', finished_at = ?, error = ? WHERE job_id = ?",
+                    (now, "処理中にサーバーが停止しました", job_id)
+                )
+            self._conn.commit()
+
+    def prune(self, max_finished_jobs: int):
+        """終了済みジョブは新しいものから上限件数だけ残す"""
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM jobs WHERE job_id IN ("
+                " SELECT job_id FROM jobs WHERE finished_at IS NOT NULL"
+                " ORDER BY finished_at DESC LIMIT -1 OFFSET ?)",
+                (max_finished_jobs,)
+            )
+            self._conn.commit()
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, OSError):
+        return True
+    return True
+
+class IngestionJob:
+    """教材取り込みジョブ1件分の状態（変わるたびにIngestionJobStoreへ書き込む）"""
+
+    # 進捗（処理数）だけの更新を保存する最短の間隔（秒）
+    SAVE_INTERVAL_SECONDS = 0.5
+
+    def __init__(self, kind: str, course_id: str, filename: Optional[str] = None,
+                 store: Optional[IngestionJobStore] = None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.course_id = course_id
+        self.filename = filename
+        self.status = "queued"  # queued, running, succeeded, failed
+        self.stage = "queued"
+        self.chunks_done = 0
+        self.chunks_total = 0
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.store = store
+        self._saved_at = 0.0
+        self._lock = threading.Lock()
+
+    def report(self, stage: str, done: Optional[int] = None, total: Optional[int] = None):
+        """処理側から進捗を通知（段階とチャンクの処理数）"""
+        with self._lock:
+            changed_stage = stage != self.stage
+            self.stage = stage
+            if total is not None:
+                self.chunks_total = total
+            if done is not None:
+                self.chunks_done = done
+        if changed_stage or time.time() - self._saved_at >= self.SAVE_INTERVAL_SECONDS:
+            self.save()
+
+    def fields(self) -> Dict:
+        with self._lock:
+            return {
+                "job_id": self.id,
+                "kind": self.kind,
+                "course_id": self.course_id,
+                "filename": self.filename,
+                "status": self.status,
+                "stage": self.stage,
+                "chunks_done": self.chunks_done,
+                "chunks_total": self.chunks_total,
+                "result": self.result,
+                "error": self.error,
+                "created_at": self.created_at,
+                "started_at": self.started_at,
+                "finished_at": self.finished_at,
+                "pid": os.getpid()
+            }
+
+    def save(self):
+        if self.store is None:
+            return
+        self._saved_at = time.time()
+        try:
+            self.store.save(self.fields())
+        except Exception as e:
+            print(f"ジョブの状態の保存エラー（{self.kind} {self.id}）: {e}")
+
+    def to_dict(self) -> Dict:
+        return job_dict(self.fields())
+
+class IngestionJobQueue:
+    """教材取り込みのジョブキュー（ワーカー数で同時実行数を制限）
+
+    アップロードのリクエストではジョブを登録してIDを返すだけにし、
+    抽出・チャンク分割・ベクトル化はワーカースレッドで行う。
+    イベントループを塞がないので、大きな教材の取り込み中もWebhookに応答できる。
+    ジョブの状態はIngestionJobStoreに保存するので、別のワーカープロセスからも問い合わせられる。
+    """
+
+    def __init__(self, max_workers: Optional[int] = None, max_finished_jobs: Optional[int] = None,
+                 store: Optional[IngestionJobStore] = None):
+        self.max_workers = max_workers or Config.INGESTION_WORKERS
+        self.max_finished_jobs = max_finished_jobs or Config.INGESTION_MAX_FINISHED_JOBS
+        self.store = store or IngestionJobStore()
+        self.store.fail_orphans()
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="ingestion")
+        # このプロセスで実行中のジョブ（最新の進捗はここから返す）
+        self._jobs: Dict[str, IngestionJob] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, kind: str, course_id: str, func: Callable[[IngestionJob], Dict],
+               filename: Optional[str] = None, cleanup: Optional[Callable[[], None]] = None) -> IngestionJob:
+        """ジョブを登録（funcはジョブを受け取って結果のdictを返す、cleanupは成否に関わらず最後に呼ぶ）"""
+        job = IngestionJob(kind, course_id, filename, self.store)
+        job.save()
+        with self._lock:
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job, func, cleanup)
+        return job
+
+    def _run(self, job: IngestionJob, func: Callable[[IngestionJob], Dict],
+             cleanup: Optional[Callable[[], None]]):
+        with job._lock:
+            job.status = "running"
+            job.started_at = time.time()
+        job.save()
+        try:
+            result = func(job)
+            with job._lock:
+                job.result = result
+                job.status = "succeeded"
+                job.stage = "done"
+        except Exception as e:
+            print(f"取り込みジョブエラー（{job.kind} {job.filename}）: {e}")
+            traceback.print_exc()
+            with job._lock:
+                job.error = str(e)
+                job.status = "failed"
+                job.stage = "failed"
+        finally:
+            with job._lock:
+                job.finished_at = time.time()
+            job.save()
+            with self._lock:
+                self._jobs.pop(job.id, None)
+            try:
+                self.store.prune(self.max_finished_jobs)
+            except Exception as e:
+                print(f"終了済みジョブの削除エラー: {e}")
+            if cleanup:
+                try:
+                    cleanup()
+                except Exception as e:
+                    print(f"取り込みジョブの後処理エラー: {e}")
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        """ジョブの状態（別のワーカープロセスで登録されたジョブも返す）"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None:
+            return job.to_dict()
+        fields = self.store.get(job_id)
+        return job_dict(fields) if fields else None
+
+    def list(self, course_id: Optional[str] = None) -> List[Dict]:
+        """ジョブ一覧（新しい順、全ワーカープロセス分）"""
+        with self._lock:
+            local = {job.id: job for job in self._jobs.values()}
+        return [
+            local[fields["job_id"]].to_dict() if fields["job_id"] in local else job_dict(fields)
+            for fields in self.store.list(course_id)
+        ]
+
+    def active_courses(self, exclude_kinds: Tuple[str, ...] = ()) -> Set[str]:
+        """待機中・実行中のジョブがあるコース（全ワーカープロセス分、exclude_kindsの種類のジョブは除く）"""
+        return self.store.active_courses(exclude_kinds)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,151 @@
+import numpy as np
+from collections import Counter
+from pathlib import Path
+from typing import List, Dict, Optional
+import json
+import math
+import re
+import unicodedata
+from atomic_files import atomic_write
+
+# 英数字はひとかたまり（講座コードや関数名）、それ以外の文字列（日本語）は2文字ずつに分ける
+_ASCII_WORD = re.compile(r"[a-z0-9_]+")
+_NON_ASCII_RUN = re.compile(r"[^\W\x00-\x7f]+")
+
+def tokenize(text: str) -> List[str]:
+    """BM25用のトークン化（日本語は文字bigram、英数字は単語単位）"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    tokens = _ASCII_WORD.findall(text)
+    for run in _NON_ASCII_RUN.findall(text):
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+class BM25Postings:
+    """1教材分の転置インデックス（語 → チャンク番号・出現回数）"""
+
+    def __init__(self, terms: List[str], term_offsets: np.ndarray, doc_ids: np.ndarray,
+                 term_freqs: np.ndarray, doc_lengths: np.ndarray):
+        self.terms = terms
+        self.term_ids = {term: i for i, term in enumerate(terms)}
+        self.term_offsets = term_offsets
+        self.doc_ids = doc_ids
+        self.term_freqs = term_freqs
+        self.doc_lengths = doc_lengths
+
+    @classmethod
+    def build(cls, texts: List[str]) -> "BM25Postings":
+        """チャンクのテキストから転置インデックスを構築"""
+        term_ids: Dict[str, int] = {}
+        entry_terms = []
+        entry_docs = []
+        entry_freqs = []
+        doc_lengths = np.zeros(len(texts), dtype=np.int32)
+        for doc_id, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            doc_lengths[doc_id] = sum(counts.values())
+            for term, freq in counts.items():
+                entry_terms.append(term_ids.setdefault(term, len(term_ids)))
+                entry_docs.append(doc_id)
+                entry_freqs.append(freq)
+
+        entry_terms = np.array(entry_terms, dtype=np.int32)
+        order = np.argsort(entry_terms, kind="stable")
+        sizes = np.bincount(entry_terms, minlength=len(term_ids))
+        term_offsets = np.concatenate(([0], np.cumsum(sizes))).astype(np.int64)
+        doc_ids = np.array(entry_docs, dtype=np.int32)[order]
+        term_freqs = np.minimum(np.array(entry_freqs, dtype=np.int64)[order], 65535).astype(np.uint16)
+        terms = [""] * len(term_ids)
+        for term, i in term_ids.items():
+            terms[i] = term
+        return cls(terms, term_offsets, doc_ids, term_freqs, doc_lengths)
+
+    @property
+    def doc_count(self) -> int:
+        return int(self.doc_lengths.shape[0])
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.term_offsets.nbytes + self.doc_ids.nbytes + self.term_freqs.nbytes
+                   + self.doc_lengths.nbytes + sum(len(t) for t in self.terms) * 2)
+
+    def postings(self, term: str):
+        """語の出現チャンク番号と出現回数（なければNone）"""
+        term_id = self.term_ids.get(term)
+        if term_id is None:
+            return None
+        start, end = self.term_offsets[term_id], self.term_offsets[term_id + 1]
+        return self.doc_ids[start:end], self.term_freqs[start:end]
+
+    def save(self, path: Path):
+        """保存（一時ファイルに書いてfsyncしてから置き換え）"""
+        with atomic_write(path) as f:
+            np.savez(
+                f,
+                terms=np.array(json.dumps(self.terms, ensure_ascii=False)),
+                term_offsets=self.term_offsets,
+                doc_ids=self.doc_ids,
+                term_freqs=self.term_freqs,
+                doc_lengths=self.doc_lengths
+            )
+
+    @classmethod
+    def load(cls, path: Path) -> Optional["BM25Postings"]:
+        if not path.exists():
+            return None
+        with np.load(path) as data:
+            return cls(
+                json.loads(str(data["terms"])),
+                data["term_offsets"],
+                data["doc_ids"],
+                data["term_freqs"],
+                data["doc_lengths"]
+            )
+
+class LexicalIndex:
+    """コース全体のBM25検索（教材ごとの転置インデックスを束ねる）"""
+
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self, postings: List[BM25Postings], material_starts: np.ndarray):
+        self.postings = postings
+        self.material_starts = material_starts
+        self.doc_count = sum(p.doc_count for p in postings)
+        total_length = sum(int(p.doc_lengths.sum()) for p in postings)
+        self.avg_doc_length = total_length / self.doc_count if self.doc_count else 0.0
+
+    @property
+    def nbytes(self) -> int:
+        return sum(p.nbytes for p in self.postings)
+
+    def score(self, query_text: str) -> Optional[np.ndarray]:
+        """全チャンクのBM25スコア
+
+        質問の語がすべて（平均的な長さのチャンクに1回以上）出現した場合を1.0として、
+        0〜1に正規化して返す。
+        質問から語が取れない場合はNone。
+        """
+        terms = set(tokenize(query_text))
+        if not terms or self.doc_count == 0:
+            return None
+
+        scores = np.zeros(self.doc_count, dtype=np.float32)
+        max_score = 0.0
+        for term in terms:
+            hits = [(i, p.postings(term)) for i, p in enumerate(self.postings)]
+            hits = [(i, h) for i, h in hits if h is not None]
+            df = sum(len(h[0]) for _, h in hits)
+            idf = math.log(1 + (self.doc_count - df + 0.5) / (df + 0.5))
+            max_score += idf
+            for material, (doc_ids, term_freqs) in hits:
+                tf = term_freqs.astype(np.float32)
+                lengths = self.postings[material].doc_lengths[doc_ids]
+                norm = self.K1 * (1 - self.B + self.B * lengths / self.avg_doc_length)
+                scores[self.material_starts[material] + doc_ids] += idf * tf * (self.K1 + 1) / (tf + norm)
+
+        if max_score <= 0:
+            return scores
+        return np.minimum(scores / max_score, 1.0)
@@ -7,6 +7,8 @@ from typing import Optional, List, Dict
 import asyncio
 import json
 import os
+import shutil
+import tempfile
 from datetime import datetime
 from pathlib import Path
 import uuid
@@ -19,10 +21,22 @@ from excel_processor import ExcelProcessor
 from ai_responder import AIResponder
 from satisfaction_analyzer import SatisfactionAnalyzer
 from spreadsheet import SpreadsheetService
+from spreadsheet_sync import SpreadsheetSync
 from slack_notifier import SlackNotifier
 from course_manager import CourseManager
 from conversation_manager import ConversationManager
 from auth import AuthService, verify_token, get_user, create_user
+from index_cache import course_index_cache
+from course_index import CourseIndex
+from embedding_cache import get_chunk_embedding_cache
+from extraction_cache import get_extraction_cache
+from ingestion_jobs import IngestionJobQueue
+from uploads import save_upload_stream, stage_upload
+from compaction import VectorCompactor
+from bulk_ingestion import BulkIngestion
+from material_library import MaterialLibrary
+from index_warmup import IndexWarmup
+from pdf_extraction import start_pool as start_pdf_extraction_pool, shutdown_pool as shutdown_pdf_extraction_pool
 
 app = FastAPI(title="ISAIチャットボット")
 
@@ -58,7 +72,7 @@ except Exception as e:
     excel_processor = None
 
 try:
-    ai_responder = AIResponder()
+    ai_responder = AIResponder(pdf_processor, excel_processor)
 except Exception as e:
     print(f"AIResponder初期化エラー: {e}")
     ai_responder = None
@@ -84,6 +98,26 @@ except Exception as e:
 course_manager = CourseManager()
 conversation_manager = ConversationManager()
 
+# 連携スプレッドシートの差分同期（Google Sheetsとベクトル化の両方が使える場合のみ）
+spreadsheet_sync = (
+    SpreadsheetSync(spreadsheet_service, excel_processor, course_manager)
+    if spreadsheet_service and excel_processor else None
+)
+
+# 起動時のインデックス読み込み（会話の多いコースから）
+index_warmup = IndexWarmup(
+    excel_processor.vector_store if excel_processor else None, conversation_manager, course_manager
+)
+
+# 教材取り込みのジョブキュー（同時に処理する教材数はINGESTION_WORKERSまで）
+ingestion_queue = IngestionJobQueue()
+
+# 複数のコースで共有する教材（コースIDにConfig.LIBRARY_IDを指定して取り込んだ教材）
+material_library = MaterialLibrary(excel_processor.vector_store, excel_processor.data_dir) if excel_processor else None
+
+# zip・フォルダからの一括取り込み（PDFとExcelの両方が使える場合のみ）
+bulk_ingestion = BulkIngestion(pdf_processor, excel_processor) if pdf_processor and excel_processor else None
+
 # LINEボットインスタンス（コースごと）
 line_bots: Dict[str, LineBotService] = {}
 
@@ -131,6 +165,17 @@ async def read_root():
             return f.read()
     return "<h1>ISAIチャットボット管理画面</h1><p>フロントエンドファイルが見つかりません</p>"
 
+@app.get("/api/health")
+async def health():
+    """プロセスが応答できるか（liveness）"""
+    return {"status": "ok"}
+
+@app.get("/api/ready")
+async def ready():
+    """リクエストを受けられるか（readiness、起動時のインデックス読み込みが終わるまでは503）"""
+    warmup = index_warmup.to_dict()
+    return JSONResponse(status_code=200 if warmup["ready"] else 503, content={"warmup": warmup})
+
 @app.get("/login.html", response_class=HTMLResponse)
 async def login_page():
     """ログインページ"""
@@ -339,94 +384,152 @@ async def get_courses(credentials = Depends(verify_token)):
     courses = course_manager.get_all_courses()
     return {"courses": courses}
 
-@app.post("/api/courses/{course_id}/pdf")
+def enqueue_material_job(kind: str, course_id: str, upload: Dict, process) -> Dict:
+    """教材の取り込みジョブを登録（終了後に一時ディレクトリを消す）"""
+    staging_dir = upload["staging_dir"]
+    job = ingestion_queue.submit(
+        kind, course_id, lambda job: process(job.report), upload["path"].name,
+        cleanup=lambda: shutil.rmtree(staging_dir, ignore_errors=True)
+    )
+    return {
+        "status": "accepted",
+        "job_id": job.id,
+        "job": job.to_dict(),
+        "upload": {"filename": upload["path"].name, "size": upload["size"], "sha256": upload["sha256"]}
+    }
+
+@app.post("/api/courses/{course_id}/pdf", status_code=202)
 async def upload_pdf(
     course_id: str,
     file: UploadFile = File(...),
     credentials = Depends(verify_token)
 ):
-    """PDF教材をアップロード"""
+    """PDF教材をアップロード（取り込みはバックグラウンドのジョブで行い、ジョブIDを返す）"""
     if not pdf_processor:
         raise HTTPException(status_code=500, detail="PDF処理サービスが利用できません")
     
-    # 一時ファイルに保存
-    import tempfile
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_file:
-        content = await file.read()
-        tmp_file.write(content)
-        temp_path = Path(tmp_file.name)
+    # 一時ディレクトリに保存（取り込みに成功してからコースのディレクトリへ移す）
+    upload = await stage_upload(file)
     
-    try:
-        # PDFを処理
-        result = pdf_processor.process_pdf(str(temp_path), course_id)
-        return {"status": "success", "data": result}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"PDF処理エラー: {str(e)}")
-    finally:
-        # 一時ファイルを削除
-        if temp_path.exists():
-            temp_path.unlink()
+    # PDFを処理
+    return enqueue_material_job(
+        "pdf", course_id, upload,
+        lambda progress: pdf_processor.process_pdf(
+            str(upload["path"]), course_id, progress, upload["sha256"], move_source=True
+        )
+    )
 
-@app.post("/api/courses/{course_id}/excel")
+@app.post("/api/courses/{course_id}/excel", status_code=202)
 async def upload_excel(
     course_id: str,
     file: UploadFile = File(...),
     credentials = Depends(verify_token)
 ):
-    """Excel教材をアップロード"""
+    """Excel教材をアップロード（取り込みはバックグラウンドのジョブで行い、ジョブIDを返す）"""
     if not excel_processor:
         raise HTTPException(status_code=500, detail="Excel処理サービスが利用できません")
     
-    # 一時ファイルに保存
-    import tempfile
-    file_ext = Path(file.filename).suffix.lower()
-    suffix = ".xlsx" if file_ext in [".xlsx", ".xls"] else file_ext
+    # 一時ディレクトリに保存（取り込みに成功してからコースのディレクトリへ移す）
+    upload = await stage_upload(file)
     
-    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp_file:
-        content = await file.read()
-        tmp_file.write(content)
-        temp_path = Path(tmp_file.name)
-    
-    try:
-        # Excelを処理
-        file_type = "excel"
-        result = excel_processor.process_file(str(temp_path), course_id, file_type)
-        return {"status": "success", "data": result}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Excel処理エラー: {str(e)}")
-    finally:
-        # 一時ファイルを削除
-        if temp_path.exists():
-            temp_path.unlink()
+    # Excelを処理
+    return enqueue_material_job(
+        "excel", course_id, upload,
+        lambda progress: excel_processor.process_file(
+            str(upload["path"]), course_id, "excel", progress, upload["sha256"], move_source=True
+        )
+    )
 
-@app.post("/api/courses/{course_id}/csv")
+@app.post("/api/courses/{course_id}/csv", status_code=202)
 async def upload_csv(
     course_id: str,
     file: UploadFile = File(...),
     credentials = Depends(verify_token)
 ):
-    """CSV教材をアップロード"""
+    """CSV教材をアップロード（取り込みはバックグラウンドのジョブで行い、ジョブIDを返す）"""
     if not excel_processor:
         raise HTTPException(status_code=500, detail="CSV処理サービスが利用できません")
     
-    # 一時ファイルに保存
-    import tempfile
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".csv") as tmp_file:
-        content = await file.read()
-        tmp_file.write(content)
-        temp_path = Path(tmp_file.name)
+    # 一時ディレクトリに保存（取り込みに成功してからコースのディレクトリへ移す）
+    upload = await stage_upload(file)
     
+    # CSVを処理
+    return enqueue_material_job(
+        "csv", course_id, upload,
+        lambda progress: excel_processor.process_file(
+            str(upload["path"]), course_id, "csv", progress, upload["sha256"], move_source=True
+        )
+    )
+
+@app.post("/api/courses/{course_id}/materials/bulk", status_code=202)
+async def upload_materials_bulk(
+    course_id: str,
+    file: Optional[UploadFile] = File(None),
+    folder: Optional[str] = Form(None),
+    force: bool = Form(False),
+    credentials = Depends(verify_token)
+):
+    """zip、またはサーバー上のフォルダ（BULK_IMPORT_ROOT内）の教材をまとめて取り込み
+
+    PDF・Excel・CSVを判定し、同じ内容のファイルや取り込み済みの内容は飛ばす（forceで再取り込み）。
+    取り込みは1件のジョブで行い、ファイルごとの結果はジョブの結果で返す。
+    """
+    if not bulk_ingestion:
+        raise HTTPException(status_code=500, detail="教材の取り込みサービスが利用できません")
+    if (file is None) == (not folder):
+        raise HTTPException(status_code=400, detail="zipファイルかフォルダのどちらか一方を指定してください")
+    
+    if folder:
+        try:
+            folder_path = bulk_ingestion.resolve_folder(folder)
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        job = ingestion_queue.submit(
+            "bulk", course_id,
+            lambda job: bulk_ingestion.ingest_folder(course_id, folder_path, force, job.report),
+            folder
+        )
+        return {"status": "accepted", "job_id": job.id, "job": job.to_dict()}
+    
+    # zipは一時ディレクトリに保存し、展開・取り込みはジョブで行う
+    staging_root = Config.CACHE_DIR / "bulk"
+    staging_root.mkdir(parents=True, exist_ok=True)
+    staging_dir = Path(tempfile.mkdtemp(prefix=f"{course_id}-", dir=staging_root))
     try:
-        # CSVを処理
-        file_type = "csv"
-        result = excel_processor.process_file(str(temp_path), course_id, file_type)
-        return {"status": "success", "data": result}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"CSV処理エラー: {str(e)}")
-    finally:
-        # 一時ファイルを削除
-        if temp_path.exists():
-            temp_path.unlink()
+        upload = await save_upload_stream(file, staging_dir, "materials.zip", Config.BULK_UPLOAD_MAX_BYTES)
+    except BaseException:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+    job = ingestion_queue.submit(
+        "bulk", course_id,
+        lambda job: bulk_ingestion.ingest_zip(course_id, upload["path"], staging_dir, force, job.report),
+        file.filename,
+        cleanup=lambda: shutil.rmtree(staging_dir, ignore_errors=True)
+    )
+    return {
+        "status": "accepted",
+        "job_id": job.id,
+        "job": job.to_dict(),
+        "upload": {"filename": file.filename, "size": upload["size"], "sha256": upload["sha256"]}
+    }
+
+def rebuild_index_job(vector_store, course_id: str, job) -> Dict:
+    """コースの近似最近傍インデックスを作り直すジョブの本体"""
+    job.report("indexing")
+    return {"course_id": course_id, "ann": CourseIndex.rebuild_ann(vector_store, course_id)}
+
+@app.get("/api/jobs")
+async def list_jobs(course_id: Optional[str] = None, credentials = Depends(verify_token)):
+    """取り込みジョブの一覧（新しい順）"""
+    return {"jobs": ingestion_queue.list(course_id)}
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str, credentials = Depends(verify_token)):
+    """取り込みジョブの状態（段階・チャンクの進捗・スループット・結果）"""
+    job = ingestion_queue.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="ジョブが見つかりません")
+    return {"job": job}
 
 class SpreadsheetLinkRequest(BaseModel):
     spreadsheet_id: str
@@ -439,57 +542,15 @@ async def link_spreadsheet(
     credentials = Depends(verify_token)
 ):
     """Googleスプレッドシートを連携（リアルタイム読み込み）"""
-    if not spreadsheet_service or not excel_processor:
+    if not spreadsheet_sync or not spreadsheet_service.service:
         raise HTTPException(status_code=500, detail="スプレッドシート処理サービスが利用できません")
     
     try:
-        # スプレッドシートからデータを読み込み
-        text = spreadsheet_service.read_spreadsheet_for_rag(
-            request.spreadsheet_id, 
-            request.sheet_name
+        # 前回から変わった行だけベクトル化して保存
+        result = await asyncio.to_thread(
+            spreadsheet_sync.sync, course_id, request.spreadsheet_id, request.sheet_name
         )
-        
-        if not text:
-            raise HTTPException(status_code=400, detail="スプレッドシートにデータがありません")
-        
-        # テキストをチャンク分割
-        chunks = excel_processor.split_text(text)
-        
-        # ベクトル化
-        embeddings = excel_processor.create_embeddings(chunks)
-        
-        # メタデータとベクトルを保存
-        vector_dir = Config.VECTOR_STORAGE_DIR
-        vector_file = vector_dir / f"{course_id}_spreadsheet_{request.spreadsheet_id}.json"
-        
-        data = {
-            "course_id": course_id,
-            "spreadsheet_id": request.spreadsheet_id,
-            "sheet_name": request.sheet_name,
-            "chunks": chunks,
-            "embeddings": embeddings,
-            "metadata": {
-                "chunk_count": len(chunks),
-                "total_text_length": len(text),
-                "is_realtime": True
-            }
-        }
-        
-        import json
-        with open(vector_file, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-        
-        return {
-            "status": "success",
-            "data": {
-                "course_id": course_id,
-                "spreadsheet_id": request.spreadsheet_id,
-                "sheet_name": request.sheet_name,
-                "vector_file": str(vector_file),
-                "chunk_count": len(chunks),
-                "text_length": len(text)
-            }
-        }
+        return {"status": "success", "data": result}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"スプレッドシート連携エラー: {str(e)}")
 
@@ -499,10 +560,214 @@ async def refresh_spreadsheet(
     request: SpreadsheetLinkRequest,
     credentials = Depends(verify_token)
 ):
-    """Googleスプレッドシートを再読み込み（リアルタイム更新）"""
+    """Googleスプレッドシートを再読み込み（追加・変更された行だけ再ベクトル化し、削除された行は取り除く）"""
     # 同じ処理を実行
     return await link_spreadsheet(course_id, request, credentials)
 
+@app.get("/api/courses/{course_id}/spreadsheets")
+async def get_linked_spreadsheets(course_id: str, credentials = Depends(verify_token)):
+    """連携中のスプレッドシート一覧（最終同期日時・次回の自動更新予定）"""
+    if not spreadsheet_sync:
+        raise HTTPException(status_code=500, detail="スプレッドシート処理サービスが利用できません")
+    return {
+        "spreadsheets": spreadsheet_sync.linked_sheets(course_id),
+        "refresh_minutes": spreadsheet_sync.refresh_minutes(course_id)
+    }
+
+@app.delete("/api/courses/{course_id}/spreadsheet/{spreadsheet_id}")
+async def unlink_spreadsheet(course_id: str, spreadsheet_id: str, credentials = Depends(verify_token)):
+    """スプレッドシートの連携を解除（保存したベクトルも削除）"""
+    if not excel_processor:
+        raise HTTPException(status_code=500, detail="ベクトル検索サービスが利用できません")
+    vector_store = excel_processor.vector_store
+    vector_name = SpreadsheetSync.vector_name(course_id, spreadsheet_id)
+    if not vector_store.matrix_path(vector_name).exists():
+        raise HTTPException(status_code=404, detail="連携中のスプレッドシートが見つかりません")
+    vector_store.delete(vector_name)
+    # インデックスの作り直しはジョブで行う（結果はジョブのresultで返す）
+    job = ingestion_queue.submit(
+        "indexing", course_id, lambda job: rebuild_index_job(vector_store, course_id, job)
+    )
+    return {"status": "accepted", "job_id": job.id, "job": job.to_dict()}
+
+class SpreadsheetRefreshRequest(BaseModel):
+    refresh_minutes: int  # 0で自動更新しない
+
+@app.put("/api/courses/{course_id}/spreadsheet/refresh-interval")
+async def update_spreadsheet_refresh_interval(
+    course_id: str,
+    request: SpreadsheetRefreshRequest,
+    credentials = Depends(verify_token)
+):
+    """連携スプレッドシートの自動更新間隔（分）を設定"""
+    if request.refresh_minutes < 0:
+        raise HTTPException(status_code=400, detail="更新間隔は0以上で指定してください")
+    if not course_manager.update_course_spreadsheet_refresh(course_id, request.refresh_minutes):
+        raise HTTPException(status_code=404, detail="コースが見つかりません")
+    return {"status": "success", "refresh_minutes": request.refresh_minutes}
+
+class SearchSettingsRequest(BaseModel):
+    ann: Optional[str] = None  # "auto", "on", "off"
+    nprobe: Optional[int] = None
+    nlist: Optional[int] = None
+    quantize: Optional[bool] = None  # int8量子化 + float32再ランキング
+    rerank_candidates: Optional[int] = None
+    embedding_dimensions: Optional[int] = None  # 0はモデルの既定（1536）
+
+@app.get("/api/courses/{course_id}/search-settings")
+async def get_search_settings(course_id: str, credentials = Depends(verify_token)):
+    """コースの検索設定（近似最近傍インデックス）を取得"""
+    if not excel_processor:
+        raise HTTPException(status_code=500, detail="ベクトル検索サービスが利用できません")
+    return {"settings": excel_processor.vector_store.load_search_settings(course_id)}
+
+@app.put("/api/courses/{course_id}/search-settings")
+async def update_search_settings(
+    course_id: str,
+    request: SearchSettingsRequest,
+    credentials = Depends(verify_token)
+):
+    """コースの検索設定を更新（nprobeを上げると再現率が上がり、遅くなる）"""
+    if not excel_processor:
+        raise HTTPException(status_code=500, detail="ベクトル検索サービスが利用できません")
+    if request.ann is not None and request.ann not in ("auto", "on", "off"):
+        raise HTTPException(status_code=400, detail="annは auto / on / off のいずれかを指定してください")
+    if request.nprobe is not None and request.nprobe < 1:
+        raise HTTPException(status_code=400, detail="nprobeは1以上を指定してください")
+    if request.rerank_candidates is not None and request.rerank_candidates < 1:
+        raise HTTPException(status_code=400, detail="rerank_candidatesは1以上を指定してください")
+    if request.embedding_dimensions is not None and request.embedding_dimensions < 0:
+        raise HTTPException(status_code=400, detail="embedding_dimensionsは0以上を指定してください")
+    
+    vector_store = excel_processor.vector_store
+    settings = vector_store.load_search_settings(course_id)
+    previous_dimensions = settings.get("embedding_dimensions") or None
+    rebuild = request.ann is not None or request.nlist is not None
+    settings.update(request.model_dump(exclude_none=True))
+    if request.embedding_dimensions is not None:
+        settings["embedding_dimensions"] = request.embedding_dimensions or None
+    vector_store.save_search_settings(course_id, settings)
+    
+    # 次元数が変わった場合は保存済みのチャンクを再ベクトル化する（インデックスも作り直される）
+    if settings["embedding_dimensions"] != previous_dimensions:
+        job = ingestion_queue.submit(
+            "reembed", course_id,
+            lambda job: CourseIndex.reembed(vector_store, excel_processor.embedder, course_id, job.report)
+        )
+        return {"status": "accepted", "settings": settings, "job_id": job.id, "job": job.to_dict()}
+    
+    # リスト数や有効・無効が変わった場合はインデックスをジョブで作り直す
+    if rebuild:
+        job = ingestion_queue.submit(
+            "indexing", course_id, lambda job: rebuild_index_job(vector_store, course_id, job)
+        )
+        return {"status": "accepted", "settings": settings, "job_id": job.id, "job": job.to_dict()}
+    return {"status": "success", "settings": settings, "ann": None}
+
+@app.get("/api/index/cache")
+async def get_index_cache_stats(credentials = Depends(verify_token)):
+    """コースインデックス・埋め込み・抽出結果キャッシュの統計（ヒット・ミス数など）"""
+    query_cache = ai_responder.query_cache if ai_responder else None
+    return {
+        "cache": course_index_cache.stats(),
+        "query_embedding_cache": query_cache.stats() if query_cache else None,
+        "chunk_embedding_cache": get_chunk_embedding_cache().stats(),
+        "extraction_cache": get_extraction_cache().stats(),
+        "snapshots": excel_processor.vector_store.snapshots.stats() if excel_processor else None
+    }
+
+class CompactionRequest(BaseModel):
+    course_id: Optional[str] = None  # 省略時は全コース
+    dry_run: bool = False  # Trueなら削除せず対象だけ返す
+
+@app.post("/api/index/compact", status_code=202)
+async def compact_vectors(request: CompactionRequest, credentials = Depends(verify_token)):
+    """ベクトル保存ディレクトリを整理（重複した教材・孤立したファイルを削除し、回収したバイト数をジョブの結果で返す）"""
+    if not excel_processor:
+        raise HTTPException(status_code=500, detail="ベクトル検索サービスが利用できません")
+    # 取り込み中のコースは対象外にする（整理ジョブ自身は除く）
+    compactor = VectorCompactor(
+        excel_processor.vector_store, excel_processor.data_dir,
+        active_courses=lambda: ingestion_queue.active_courses(exclude_kinds=("compaction",))
+    )
+    job = ingestion_queue.submit(
+        "compaction", request.course_id,
+        lambda job: compactor.compact(request.course_id, request.dry_run, job.report)
+    )
+    return {"status": "accepted", "job_id": job.id, "job": job.to_dict()}
+
+class LibraryAttachRequest(BaseModel):
+    materials: List[str]  # 共有ライブラリの教材名
+
+class LibraryPromoteRequest(BaseModel):
+    min_courses: int = 2  # 同じ内容の教材がこの数以上のコースにあればまとめる
+    dry_run: bool = False  # Trueなら変更せず対象だけ返す
+
+@app.get("/api/library")
+async def get_library(credentials = Depends(verify_token)):
+    """共有ライブラリの教材一覧（追加しているコース付き）
+
+    教材の取り込みは通常のアップロード・一括取り込みのエンドポイントで、コースIDに library_id を指定する。
+    """
+    if not material_library:
+        raise HTTPException(status_code=500, detail="ベクトル検索サービスが利用できません")
+    materials = await asyncio.to_thread(material_library.materials)
+    return {"library_id": Config.LIBRARY_ID, "materials": materials}
+
+@app.delete("/api/library/{name}")
+async def delete_library_material(name: str, credentials = Depends(verify_token)):
+    """共有ライブラリから教材を削除（追加しているコースからも外す）"""
+    if not material_library:
+        raise HTTPException(status_code=500, detail="ベクトル検索サービスが利用できません")
+    if not material_library.is_library_material(name):
+        raise HTTPException(status_code=404, detail="共有ライブラリに教材が見つかりません")
+    result = await asyncio.to_thread(material_library.delete, name)
+    return {"status": "success", **result}
+
+@app.post("/api/library/promote", status_code=202)
+async def promote_library_materials(request: LibraryPromoteRequest, credentials = Depends(verify_token)):
+    """複数のコースに重複して取り込まれた教材を共有ライブラリにまとめる（ベクトルは再計算しない）"""
+    if not material_library:
+        raise HTTPException(status_code=500, detail="ベクトル検索サービスが利用できません")
+    if request.min_courses < 1:
+        raise HTTPException(status_code=400, detail="min_coursesは1以上を指定してください")
+    job = ingestion_queue.submit(
+        "library", Config.LIBRARY_ID,
+        lambda job: material_library.promote(request.min_courses, request.dry_run, job.report)
+    )
+    return {"status": "accepted", "job_id": job.id, "job": job.to_dict()}
+
+@app.get("/api/courses/{course_id}/library")
+async def get_course_library(course_id: str, credentials = Depends(verify_token)):
+    """コースに追加されている共有ライブラリの教材"""
+    if not material_library:
+        raise HTTPException(status_code=500, detail="ベクトル検索サービスが利用できません")
+    return {"course_id": course_id, "materials": material_library.attached(course_id)}
+
+@app.post("/api/courses/{course_id}/library")
+async def attach_library_materials(
+    course_id: str,
+    request: LibraryAttachRequest,
+    credentials = Depends(verify_token)
+):
+    """共有ライブラリの教材をコースに追加（コースの検索で一緒に検索される）"""
+    if not material_library:
+        raise HTTPException(status_code=500, detail="ベクトル検索サービスが利用できません")
+    try:
+        materials = await asyncio.to_thread(material_library.attach, course_id, request.materials)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"status": "success", "course_id": course_id, "materials": materials}
+
+@app.delete("/api/courses/{course_id}/library/{name}")
+async def detach_library_material(course_id: str, name: str, credentials = Depends(verify_token)):
+    """コースから共有ライブラリの教材を外す（教材自体は残る）"""
+    if not material_library:
+        raise HTTPException(status_code=500, detail="ベクトル検索サービスが利用できません")
+    if not material_library.detach(course_id, name):
+        raise HTTPException(status_code=404, detail="コースに追加されていない教材です")
+    return {"status": "success", "course_id": course_id, "materials": material_library.attached(course_id)}
+
 @app.get("/api/conversations")
 async def get_conversations(
     course_id: Optional[str] = None,
@@ -863,6 +1128,22 @@ async def poll_chatwork_messages():
 async def startup_event():
     """サーバー起動時にポーリングタスクを開始"""
     asyncio.create_task(poll_chatwork_messages())
+    # 連携スプレッドシートの自動更新
+    if spreadsheet_sync and spreadsheet_service.service:
+        asyncio.create_task(spreadsheet_sync.run_scheduler())
+    # PDF抽出のプロセスプールは取り込みスレッドが動き出す前に起動しておく
+    try:
+        start_pdf_extraction_pool()
+    except Exception as e:
+        print(f"PDF抽出プロセスプールの起動エラー: {e}")
+    # 会話の多いコースのインデックスを読み込んでおく（完了するまで/api/readyは503）
+    asyncio.create_task(asyncio.to_thread(index_warmup.run))
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """サーバー停止時に待機中の取り込みジョブを破棄"""
+    ingestion_queue.shutdown()
+    shutdown_pdf_extraction_pool()
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,221 @@
+from collections import defaultdict
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+import shutil
+import time
+from config import Config
+from course_index import CourseIndex
+from vector_store import VectorStore
+
+class MaterialLibrary:
+    """複数のコースで共有する教材（共有ライブラリ）
+
+    ライブラリの教材は予約コースID（Config.LIBRARY_ID）の教材として1回だけ取り込み・ベクトル化し、
+    各コースは検索設定のlibrary_materialsに教材名を追加して参照する。
+    コースの検索ではコースの教材とライブラリのインデックス（全コースで1つ）を両方検索して結果をまとめるので、
+    保存容量・埋め込みの費用・メモリは共有する教材の数だけで済む。
+    """
+
+    # 取り込み時のパスなど、サイドカーのうち教材そのものではない項目
+    _SIDECAR_FIELDS = ("name", "dim", "count", "offsets", "text", "chunk_meta", "matrix")
+
+    def __init__(self, vector_store: VectorStore, source_dir: Optional[Path] = None):
+        self.vector_store = vector_store
+        self.source_dir = Path(source_dir) if source_dir else Config.PDF_STORAGE_DIR
+        self.library_id = Config.LIBRARY_ID
+
+    def is_library_material(self, name: str) -> bool:
+        if not name.startswith(f"{self.library_id}_") or not self.vector_store.sidecar_path(name).exists():
+            return False
+        data = self.vector_store.load(name)
+        return bool(data) and data.get("course_id") == self.library_id
+
+    def attachments(self) -> Dict[str, List[str]]:
+        """ライブラリの教材名 → 追加しているコースIDの一覧"""
+        courses = defaultdict(list)
+        for path in sorted(self.vector_store.ann_dir.glob("*.settings.json")):
+            course_id = path.name[:-len(".settings.json")]
+            if course_id == self.library_id:
+                continue
+            for name in self.vector_store.load_search_settings(course_id).get("library_materials") or []:
+                courses[name].append(course_id)
+        return dict(courses)
+
+    def materials(self) -> List[Dict]:
+        """ライブラリの教材一覧（出典・チャンク数・追加しているコース）"""
+        courses = self.attachments()
+        materials = []
+        for name in sorted(self.vector_store.list_names(f"{self.library_id}_*")):
+            data = self.vector_store.load(name)
+            if not data or data.get("course_id") != self.library_id:
+                continue
+            materials.append({
+                "name": name,
+                "source": CourseIndex.describe_source(name, data),
+                "chunk_count": data.get("count", 0),
+                "sha256": data.get("metadata", {}).get("sha256"),
+                "embedding_dimensions": data.get("embedding_dimensions"),
+                "courses": courses.get(name, [])
+            })
+        return materials
+
+    def attached(self, course_id: str) -> List[str]:
+        """コースに追加されているライブラリの教材名"""
+        return list(self.vector_store.load_search_settings(course_id).get("library_materials") or [])
+
+    def attach(self, course_id: str, names: List[str]) -> List[str]:
+        """ライブラリの教材をコースに追加（追加後の教材名の一覧を返す）"""
+        if course_id == self.library_id:
+            raise Exception("共有ライブラリ自身には追加できません")
+        missing = [name for name in names if not self.is_library_material(name)]
+        if missing:
+            raise Exception(f"共有ライブラリに教材がありません: {', '.join(missing)}")
+        settings = self.vector_store.load_search_settings(course_id)
+        attached = list(settings.get("library_materials") or [])
+        attached.extend(name for name in names if name not in attached)
+        settings["library_materials"] = attached
+        self.vector_store.save_search_settings(course_id, settings)
+        return attached
+
+    def detach(self, course_id: str, name: str) -> bool:
+        """コースからライブラリの教材を外す（教材自体は消さない）"""
+        settings = self.vector_store.load_search_settings(course_id)
+        attached = list(settings.get("library_materials") or [])
+        if name not in attached:
+            return False
+        attached.remove(name)
+        settings["library_materials"] = attached
+        self.vector_store.save_search_settings(course_id, settings)
+        return True
+
+    def delete(self, name: str) -> Dict:
+        """ライブラリから教材を削除（追加しているコースからも外す、元ファイルは整理ジョブで消える）"""
+        if not self.is_library_material(name):
+            raise Exception(f"共有ライブラリに教材がありません: {name}")
+        courses = self.attachments().get(name, [])
+        for course_id in courses:
+            self.detach(course_id, name)
+        self.vector_store.delete(name)
+        ann = CourseIndex.rebuild_ann(self.vector_store, self.library_id)
+        return {"name": name, "detached_courses": courses, "ann": ann}
+
+    def _library_name(self, course_id: str, name: str, sha256: str, existing: Dict[str, str]) -> str:
+        """コースの教材名（{course_id}_...）からライブラリでの教材名を作る（別内容の同名があれば区別する）"""
+        library_name = f"{self.library_id}_{name[len(course_id) + 1:]}"
+        if library_name in existing and existing[library_name] != sha256:
+            library_name = f"{library_name}_{sha256[:8]}"
+        return library_name
+
+    def _copy_source(self, data: Dict) -> Dict:
+        """元ファイルをライブラリのディレクトリにコピーし、サイドカーのパスを書き換える"""
+        info = {key: value for key, value in data.items() if key not in self._SIDECAR_FIELDS}
+        info["course_id"] = self.library_id
+        for key in ("pdf_path", "file_path"):
+            if not info.get(key):
+                continue
+            source = Path(info[key])
+            dest = self.source_dir / self.library_id / source.name
+            if source.exists() and source.resolve() != dest.resolve():
+                dest.parent.mkdir(parents=True, exist_ok=True)
+                shutil.copy2(source, dest)
+            info[key] = str(dest)
+        return info
+
+    def _material_bytes(self, name: str) -> int:
+        paths = (self.vector_store.matrix_path(name), self.vector_store.sidecar_path(name),
+                 self.vector_store.lexical_path(name))
+        return sum(path.stat().st_size for path in paths if path.exists())
+
+    def promote(self, min_courses: int = 2, dry_run: bool = False,
+                progress: Optional[Callable] = None) -> Dict:
+        """複数のコースに同じ内容（SHA-256）で取り込まれている教材をライブラリへまとめる
+
+        ベクトルはコースの教材からそのままコピーし、埋め込みAPIは呼ばない。
+        ライブラリに同じ内容があればそれを使い、min_courses未満のコースにしかない教材は対象外。
+        コース側の教材は削除してライブラリの教材を追加する（元ファイルは次の整理ジョブで消える）。
+        スプレッドシートはコースごとに同期するので対象外。次元数がライブラリの設定と異なる教材も対象外。
+        """
+        started_at = time.perf_counter()
+        if progress:
+            progress("library")
+        dimensions = self.vector_store.embedding_dimensions(self.library_id)
+
+        library_by_hash = {}
+        library_names = {}
+        groups = defaultdict(list)
+        skipped = []
+        for name in sorted(self.vector_store.list_names("*")):
+            data = self.vector_store.load(name)
+            if not data or not data.get("count"):
+                continue
+            course_id = data.get("course_id")
+            sha256 = data.get("metadata", {}).get("sha256")
+            if course_id == self.library_id:
+                library_names[name] = sha256
+                if sha256 and (data.get("embedding_dimensions") or None) == dimensions:
+                    library_by_hash.setdefault(sha256, name)
+                continue
+            if not course_id or not sha256 or data.get("source_type") == "spreadsheet":
+                continue
+            groups[sha256].append((name, course_id, data.get("embedding_dimensions") or None))
+
+        promoted = []
+        touched = set()
+        bytes_saved = 0
+        for sha256, copies in sorted(groups.items()):
+            courses = sorted({course_id for _, course_id, _ in copies})
+            if sha256 not in library_by_hash and len(courses) < min_courses:
+                continue
+            movable = [(name, course_id, dims) for name, course_id, dims in copies if dims == dimensions]
+            movable_names = {name for name, _, _ in movable}
+            skipped.extend(name for name, _, _ in copies if name not in movable_names)
+            if not movable:
+                continue
+
+            library_name = library_by_hash.get(sha256)
+            created = library_name is None
+            if created:
+                name, course_id, _ = movable[0]
+                library_name = self._library_name(course_id, name, sha256, library_names)
+            sizes = [self._material_bytes(name) for name, _, _ in movable]
+            promoted.append({
+                "library_name": library_name,
+                "sha256": sha256,
+                "created": created,
+                "courses": sorted({course_id for _, course_id, _ in movable}),
+                "removed_materials": [name for name, _, _ in movable]
+            })
+            # ライブラリに新しく作る分は1教材分が残る
+            bytes_saved += sum(sizes) - (sizes[0] if created else 0)
+            if dry_run:
+                continue
+
+            if created:
+                data = self.vector_store.load(movable[0][0])
+                self.vector_store.save(
+                    library_name, VectorStore.get_chunks(data), data["matrix"],
+                    self._copy_source(data), data.get("chunk_meta")
+                )
+                library_names[library_name] = sha256
+                library_by_hash[sha256] = library_name
+            for name, course_id, _ in movable:
+                self.attach(course_id, [library_name])
+                self.vector_store.delete(name)
+                touched.add(course_id)
+
+        rebuilt = {}
+        if not dry_run and promoted:
+            if progress:
+                progress("indexing")
+            for course_id in sorted(touched) + [self.library_id]:
+                rebuilt[course_id] = CourseIndex.rebuild_ann(self.vector_store, course_id)
+
+        return {
+            "dry_run": dry_run,
+            "promoted": promoted,
+            "skipped_dimension_mismatch": skipped,
+            "materials_removed": sum(len(p["removed_materials"]) for p in promoted),
+            "bytes_saved": bytes_saved,
+            "rebuilt_courses": rebuilt,
+            "seconds": round(time.perf_counter() - started_at, 3)
+        }
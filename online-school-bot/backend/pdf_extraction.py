@@ -0,0 +1,140 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Iterator, List, Optional
+import multiprocessing
+import threading
+import PyPDF2
+import pdfplumber
+from config import Config
+
+def count_pages(pdf_path: str) -> int:
+    """ページ数（pdfplumberで開けなければPyPDF2で数える）"""
+    try:
+        with pdfplumber.open(pdf_path) as pdf:
+            return len(pdf.pages)
+    except Exception as e:
+        print(f"pdfplumberでエラー: {e}, PyPDF2で再試行")
+        try:
+            with open(pdf_path, 'rb') as file:
+                return len(PyPDF2.PdfReader(file).pages)
+        except Exception as e2:
+            print(f"PyPDF2でもエラー: {e2}")
+            raise Exception(f"PDF抽出失敗: {str(e2)}")
+
+def _extract_with_pypdf2(pdf_path: str, page_numbers: List[int]) -> List[str]:
+    """PyPDF2で指定ページを抽出"""
+    with open(pdf_path, 'rb') as file:
+        pdf_reader = PyPDF2.PdfReader(file)
+        return [pdf_reader.pages[i].extract_text() or "" for i in page_numbers]
+
+def extract_page_range(pdf_path: str, start: int, end: int) -> List[str]:
+    """start〜end-1ページ目のテキストを抽出
+
+    pdfplumberで読めなかったページだけPyPDF2で読み直す。
+    """
+    pages: List[Optional[str]] = []
+    try:
+        # pdfplumberで試行（より高精度）
+        with pdfplumber.open(pdf_path) as pdf:
+            for i in range(start, end):
+                try:
+                    pages.append(pdf.pages[i].extract_text() or "")
+                except Exception as e:
+                    print(f"pdfplumberで{i + 1}ページ目がエラー: {e}, PyPDF2で再試行")
+                    pages.append(None)
+    except Exception as e:
+        print(f"pdfplumberでエラー: {e}, PyPDF2で再試行")
+        pages = [None] * (end - start)
+
+    failed = [start + offset for offset, page in enumerate(pages) if page is None]
+    if failed:
+        # PyPDF2でフォールバック
+        try:
+            for page_number, page_text in zip(failed, _extract_with_pypdf2(pdf_path, failed)):
+                pages[page_number - start] = page_text
+        except Exception as e2:
+            print(f"PyPDF2でもエラー: {e2}")
+            raise Exception(f"PDF抽出失敗: {str(e2)}")
+    return pages
+
+# 抽出用のプロセスプール（取り込みジョブ間で共有）
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+# ワーカーが異常終了した後は作り直さない（リクエストやジョブのスレッドからforkしないように）
+_pool_broken = False
+
+def _noop():
+    return None
+
+def start_pool() -> Optional[ProcessPoolExecutor]:
+    """プロセスプールを起動（サーバー起動時に呼ぶ）
+
+    spawnだと`python main.py`起動時に子プロセスがmain.pyを読み直してサービスを初期化してしまうため、
+    使える環境ではforkを使う。スレッドが増える前にワーカーを起こしておけるよう、
+    空のタスクを1つ投げて全ワーカーをまとめてforkさせる。
+    ワーカーが異常終了した後は、このプロセスでは以降ずっと直列で抽出する。
+    """
+    global _pool
+    if Config.PDF_EXTRACT_WORKERS <= 1 or _pool_broken:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            method = "fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn"
+            _pool = ProcessPoolExecutor(
+                max_workers=Config.PDF_EXTRACT_WORKERS,
+                mp_context=multiprocessing.get_context(method)
+            )
+            _pool.submit(_noop).result()
+        return _pool
+
+def shutdown_pool(broken: bool = False):
+    """プロセスプールを停止（broken=Trueなら以降は作り直さない）"""
+    global _pool, _pool_broken
+    with _pool_lock:
+        _pool_broken = _pool_broken or broken
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+def iter_pages(pdf_path: str) -> Iterator[str]:
+    """ページのテキストを先頭から順に返す
+
+    ページ数が多い場合はPDF_PAGES_PER_TASKページずつプロセスプールで並列に抽出し、
+    先頭から順に揃った分だけ返す（後段のチャンク分割・ベクトル化と重ねて動かせる）。
+    先読みはワーカー数の2倍のタスクまで。
+    """
+    page_count = count_pages(pdf_path)
+    per_task = Config.PDF_PAGES_PER_TASK
+    ranges = [(start, min(start + per_task, page_count)) for start in range(0, page_count, per_task)]
+
+    pool = start_pool() if page_count >= Config.PDF_PARALLEL_MIN_PAGES else None
+    if pool is None:
+        for start, end in ranges:
+            yield from extract_page_range(pdf_path, start, end)
+        return
+
+    max_in_flight = Config.PDF_EXTRACT_WORKERS * 2
+    futures = []
+    next_range = 0
+    try:
+        while next_range < len(ranges) or futures:
+            while next_range < len(ranges) and len(futures) < max_in_flight:
+                start, end = ranges[next_range]
+                futures.append(pool.submit(extract_page_range, pdf_path, start, end))
+                next_range += 1
+            try:
+                pages = futures[0].result()
+            except BrokenProcessPool as e:
+                # ワーカーが落ちた場合はプールを止め、残りと以降のPDFはこのプロセスで抽出する
+                print(f"PDF抽出プロセスが異常終了: {e}, 以降は直列で抽出")
+                shutdown_pool(broken=True)
+                remaining = ranges[next_range - len(futures):]
+                futures = []
+                for start, end in remaining:
+                    yield from extract_page_range(pdf_path, start, end)
+                return
+            futures.pop(0)
+            yield from pages
+    finally:
+        for future in futures:
+            future.cancel()
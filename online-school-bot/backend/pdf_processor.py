@@ -1,179 +1,164 @@
-import PyPDF2
-import pdfplumber
 from pathlib import Path
-from typing import List, Dict, Optional
-import json
-import hashlib
+from typing import Callable, Iterator, List, Dict, Optional, Tuple
 from openai import OpenAI
 from config import Config
-import os
+from vector_store import VectorStore
+from course_index import CourseIndex
+from text_chunker import TextChunker
+from embedder import BatchEmbedder
+from pdf_extraction import iter_pages
+from extraction_cache import file_sha256, get_extraction_cache
+from atomic_files import place_file
 
 class PDFProcessor:
     """PDF教材の処理とベクトル化"""
     
+    # 抽出結果キャッシュのキー（抽出方法を変えたら上げる）
+    EXTRACTOR = "pdf-pages-v1"
+    
     def __init__(self):
         self.client = OpenAI(api_key=Config.OPENAI_API_KEY) if Config.OPENAI_API_KEY else None
         self.pdf_dir = Config.PDF_STORAGE_DIR
         self.vector_dir = Config.VECTOR_STORAGE_DIR
         self.pdf_dir.mkdir(parents=True, exist_ok=True)
         self.vector_dir.mkdir(parents=True, exist_ok=True)
+        self.vector_store = VectorStore(self.vector_dir)
+        self.chunker = TextChunker()
+        self.embedder = BatchEmbedder(self.client, self.chunker.count_tokens)
+        self.extraction_cache = get_extraction_cache()
+    
+    def iter_pages(self, pdf_path: str, file_hash: Optional[str] = None) -> Iterator[str]:
+        """ページごとのテキストを順に返す
+
+        同じ内容のPDFを抽出済みならキャッシュから返す。
+        なければ抽出しながら返し、最後まで読めたらキャッシュに保存する。
+        """
+        file_hash = file_hash or file_sha256(Path(pdf_path))
+        cached = self.extraction_cache.get(file_hash, self.EXTRACTOR)
+        if cached is not None:
+            yield from cached
+            return
+        
+        pages = []
+        for page_text in iter_pages(pdf_path):
+            pages.append(page_text)
+            yield page_text
+        self.extraction_cache.put(file_hash, self.EXTRACTOR, pages)
+    
+    def extract_pages(self, pdf_path: str, file_hash: Optional[str] = None) -> List[str]:
+        """PDFからページごとのテキストを抽出（ページ数が多い場合はプロセスプールで並列に抽出）"""
+        return list(self.iter_pages(pdf_path, file_hash))
     
-    def extract_text(self, pdf_path: str) -> str:
+    def extract_text(self, pdf_path: str, file_hash: Optional[str] = None) -> str:
         """PDFからテキストを抽出"""
-        text = ""
-        try:
-            # pdfplumberで試行（より高精度）
-            with pdfplumber.open(pdf_path) as pdf:
-                for page in pdf.pages:
-                    page_text = page.extract_text()
-                    if page_text:
-                        text += page_text + "\n"
-        except Exception as e:
-            print(f"pdfplumberでエラー: {e}, PyPDF2で再試行")
-            # PyPDF2でフォールバック
-            try:
-                with open(pdf_path, 'rb') as file:
-                    pdf_reader = PyPDF2.PdfReader(file)
-                    for page in pdf_reader.pages:
-                        text += page.extract_text() + "\n"
-            except Exception as e2:
-                print(f"PyPDF2でもエラー: {e2}")
-                raise Exception(f"PDF抽出失敗: {str(e2)}")
-        
-        return text.strip()
+        return "\n".join(page for page in self.extract_pages(pdf_path, file_hash) if page).strip()
     
-    def split_text(self, text: str, chunk_size: int = 1000, overlap: int = 200) -> List[str]:
+    def split_text(self, text: str) -> List[str]:
         """テキストをチャンクに分割"""
-        chunks = []
-        words = text.split()
-        current_chunk = []
-        current_length = 0
-        
-        for word in words:
-            word_length = len(word) + 1  # +1 for space
-            if current_length + word_length > chunk_size and current_chunk:
-                chunks.append(" ".join(current_chunk))
-                # オーバーラップ
-                overlap_words = current_chunk[-overlap:] if len(current_chunk) > overlap else current_chunk
-                current_chunk = overlap_words + [word]
-                current_length = sum(len(w) + 1 for w in current_chunk)
-            else:
-                current_chunk.append(word)
-                current_length += word_length
-        
-        if current_chunk:
-            chunks.append(" ".join(current_chunk))
-        
-        return chunks
+        return self.chunker.split(text)
+    
+    def split_pages(self, pages: List[str]) -> Tuple[List[str], List[Dict]]:
+        """ページごとのテキストをチャンクに分割し、各チャンクの開始ページを返す"""
+        return self.chunker.split_segments(
+            ({"page": page_number}, page_text + "\n")
+            for page_number, page_text in enumerate(pages, start=1)
+        )
     
     def create_embeddings(self, texts: List[str]) -> List[List[float]]:
-        """テキストのベクトル化"""
-        if not self.client:
-            raise Exception("OpenAI APIキーが設定されていません")
-        
-        embeddings = []
-        # バッチ処理（最大100件ずつ）
-        batch_size = 100
-        for i in range(0, len(texts), batch_size):
-            batch = texts[i:i+batch_size]
-            try:
-                response = self.client.embeddings.create(
-                    model=Config.EMBEDDING_MODEL,
-                    input=batch
-                )
-                batch_embeddings = [item.embedding for item in response.data]
-                embeddings.extend(batch_embeddings)
-            except Exception as e:
-                print(f"埋め込み生成エラー: {e}")
-                raise
-        
+        """テキストのベクトル化（キャッシュ済みのチャンクはAPIを呼ばない）"""
+        embeddings, _ = self.embedder.embed(texts)
         return embeddings
     
-    def process_pdf(self, pdf_path: str, course_id: str) -> Dict:
-        """PDFを処理してベクトル化し、保存"""
-        # PDFをコースごとのディレクトリに保存
-        course_pdf_dir = self.pdf_dir / course_id
-        course_pdf_dir.mkdir(parents=True, exist_ok=True)
-        
-        # ファイルをコピー
+    def process_pdf(self, pdf_path: str, course_id: str, progress: Optional[Callable] = None,
+                    file_hash: Optional[str] = None, rebuild_index: bool = True,
+                    filename: Optional[str] = None, move_source: bool = False) -> Dict:
+        """PDFを処理してベクトル化し、保存（progressには段階とチャンクの処理数が通知される）
+
+        元ファイルはpdf_pathから読み、ベクトルを保存してからコースのディレクトリへ置く
+        （move_source=Trueなら移動、Falseならコピー、保存名はfilenameか元のファイル名）。
+        取り込みに失敗した場合、同じ名前の取り込み済み教材の元ファイルは置き換わらない。
+
+        rebuild_index=Falseならコースのバージョン更新と近似最近傍インデックスの再構築をしない
+        （一括取り込みで最後に1回だけ行う場合）。
+        """
+        # PDFの保存先（コースごとのディレクトリ）
         pdf_file = Path(pdf_path)
-        saved_path = course_pdf_dir / pdf_file.name
-        import shutil
-        shutil.copy2(pdf_path, saved_path)
-        
-        # テキスト抽出
-        text = self.extract_text(str(saved_path))
-        
-        # チャンク分割
-        chunks = self.split_text(text)
-        
-        # ベクトル化
-        embeddings = self.create_embeddings(chunks)
+        saved_path = self.pdf_dir / course_id / (filename or pdf_file.name)
+        file_hash = file_hash or file_sha256(pdf_file)
+        
+        # テキスト抽出・チャンク分割（ページ番号付き）・ベクトル化
+        # 抽出できたページから順にチャンクにし、バッチが埋まった時点で埋め込みを送る
+        if progress:
+            progress("extracting")
+        pages = []
+        chunk_meta = []
+        
+        def page_segments():
+            for page_number, page_text in enumerate(self.iter_pages(str(pdf_file), file_hash), start=1):
+                pages.append(page_text)
+                yield {"page": page_number}, page_text + "\n"
+        
+        def chunk_stream():
+            for chunk, meta in self.chunker.iter_segments(page_segments()):
+                chunk_meta.append(meta)
+                yield chunk
+        
+        dimensions = self.vector_store.embedding_dimensions(course_id)
+        chunks, embeddings, embedding_stats = self.embedder.embed_stream(
+            chunk_stream(), progress, dimensions=dimensions
+        )
+        text = "\n".join(page for page in pages if page).strip()
         
         # メタデータとベクトルを保存
-        vector_file = self.vector_dir / f"{course_id}_{saved_path.stem}.json"
-        data = {
+        if progress:
+            progress("saving")
+        vector_name = f"{course_id}_{saved_path.stem}"
+        info = {
             "course_id": course_id,
             "pdf_path": str(saved_path),
-            "chunks": chunks,
-            "embeddings": embeddings,
+            "source_type": "pdf",
+            "embedding_model": self.embedder.model,
+            "embedding_dimensions": dimensions,
             "metadata": {
-                "filename": pdf_file.name,
+                "filename": saved_path.name,
+                "sha256": file_hash,
                 "chunk_count": len(chunks),
                 "total_text_length": len(text)
             }
         }
-        
-        with open(vector_file, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        vector_file = self.vector_store.save(vector_name, chunks, embeddings, info, chunk_meta,
+                                             update_version=rebuild_index)
+        if pdf_file.resolve() != saved_path.resolve():
+            place_file(pdf_file, saved_path, move=move_source)
+        
+        # 大きいコースは近似最近傍インデックスを再構築
+        ann = None
+        if rebuild_index:
+            if progress:
+                progress("indexing")
+            ann = CourseIndex.rebuild_ann(self.vector_store, course_id)
         
         return {
             "course_id": course_id,
             "pdf_path": str(saved_path),
             "vector_file": str(vector_file),
             "chunk_count": len(chunks),
-            "text_length": len(text)
+            "text_length": len(text),
+            "ann": ann,
+            "embeddings": embedding_stats
         }
     
-    def load_vectors(self, course_id: str) -> Optional[Dict]:
-        """コースのベクトルデータを読み込み"""
-        vector_files = list(self.vector_dir.glob(f"{course_id}_*.json"))
-        if not vector_files:
-            return None
-        
-        # 最新のファイルを読み込み
-        latest_file = max(vector_files, key=lambda p: p.stat().st_mtime)
-        with open(latest_file, "r", encoding="utf-8") as f:
-            return json.load(f)
+    def load_vectors(self, course_id: str) -> Optional[CourseIndex]:
+        """コースのベクトルデータを読み込み（全教材をまとめたインデックス）"""
+        return CourseIndex.get(self.vector_store, course_id)
     
-    def search_similar_chunks(self, query_embedding: List[float], course_id: str, top_k: int = 5) -> List[Dict]:
-        """類似チャンクを検索"""
-        vector_data = self.load_vectors(course_id)
-        if not vector_data:
-            return []
-        
-        chunks = vector_data["chunks"]
-        embeddings = vector_data["embeddings"]
-        
-        # コサイン類似度を計算
-        import numpy as np
-        
-        query_vec = np.array(query_embedding)
-        similarities = []
-        
-        for i, emb in enumerate(embeddings):
-            emb_vec = np.array(emb)
-            # コサイン類似度
-            similarity = np.dot(query_vec, emb_vec) / (np.linalg.norm(query_vec) * np.linalg.norm(emb_vec))
-            similarities.append((similarity, i, chunks[i]))
-        
-        # 上位k件を返す
-        similarities.sort(reverse=True, key=lambda x: x[0])
-        return [
-            {
-                "chunk": chunk,
-                "similarity": float(sim),
-                "index": idx
-            }
-            for sim, idx, chunk in similarities[:top_k]
-        ]
+    def search_similar_chunks(self, query_embedding: Optional[List[float]], course_id: str, top_k: int = 5,
+                              query_text: Optional[str] = None) -> List[Dict]:
+        """類似チャンクを検索（コース内の全PDFと、コースに追加された共有ライブラリのPDFが対象）
+
+        query_textを渡すとBM25とのハイブリッド検索（query_embeddingがNoneならBM25のみ）。
+        """
+        return CourseIndex.search_with_library(
+            self.vector_store, course_id, query_embedding, top_k, source_types=["pdf"],
+            query_text=query_text
+        )
@@ -0,0 +1,56 @@
+import numpy as np
+from typing import List, Optional
+
+class Int8Matrix:
+    """行ごとのスケールでint8に量子化した埋め込み行列（float32の約1/4のメモリ）
+
+    x ≈ codes * scale（scale = max|x| / 127）として保持し、
+    一次スコアリングはブロック単位でfloat32に戻してから内積を取る。
+
+    メモリを減らすための形式で、検索は速くならない。numpyにはint8の内積を速く計算する手段がなく、
+    質問もint8にしてint32で積和すると、float32のまま（BLAS）より遅い（1536次元・5万行で約1.7倍）。
+    float32に戻す方式でも、行列がCPUキャッシュに収まる規模では総当たりのfloat32よりやや遅い
+    （5,000行で約1.2倍）。メモリ帯域が律速になる5万行以上でほぼ同等になる。
+    検索全体では、これに再ランキングの分が加わる（benchmarks.retrievalの--quantizeで計測できる）。
+    """
+
+    # 一時的なfloat32ブロックがCPUキャッシュに収まる程度の行数で採点する
+    SCORE_BLOCK_ROWS = 128
+    QUANTIZE_BLOCK_ROWS = 4096
+
+    def __init__(self, codes: np.ndarray, scales: np.ndarray):
+        self.codes = codes
+        self.scales = scales
+
+    @classmethod
+    def from_matrices(cls, matrices: List[np.ndarray]) -> "Int8Matrix":
+        """float32行列（mmapでも可）をブロックごとに量子化"""
+        count = sum(m.shape[0] for m in matrices)
+        dim = matrices[0].shape[1]
+        codes = np.empty((count, dim), dtype=np.int8)
+        scales = np.empty(count, dtype=np.float32)
+        row = 0
+        for matrix in matrices:
+            for start in range(0, matrix.shape[0], cls.QUANTIZE_BLOCK_ROWS):
+                block = np.asarray(matrix[start:start + cls.QUANTIZE_BLOCK_ROWS], dtype=np.float32)
+                block_scales = np.abs(block).max(axis=1) / 127.0
+                block_scales[block_scales == 0] = 1.0
+                end = row + block.shape[0]
+                codes[row:end] = np.rint(block / block_scales[:, None]).astype(np.int8)
+                scales[row:end] = block_scales
+                row = end
+        return cls(codes, scales)
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.codes.nbytes + self.scales.nbytes)
+
+    def score(self, query_vec: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """近似の内積スコア（rowsを指定した場合はその行だけ）"""
+        codes = self.codes if rows is None else self.codes[rows]
+        scales = self.scales if rows is None else self.scales[rows]
+        scores = np.empty(codes.shape[0], dtype=np.float32)
+        for start in range(0, codes.shape[0], self.SCORE_BLOCK_ROWS):
+            block = codes[start:start + self.SCORE_BLOCK_ROWS].astype(np.float32)
+            scores[start:start + self.SCORE_BLOCK_ROWS] = block @ query_vec
+        return scores * scales
@@ -244,6 +244,33 @@ class SpreadsheetService:
             print(f'スプレッドシート読み込みエラー: {error}')
             raise Exception(f"スプレッドシート読み込み失敗: {str(error)}")
     
+    def read_spreadsheet_rows(self, spreadsheet_id: str, sheet_name: str = None) -> Dict:
+        """スプレッドシートを行単位で読み込み（差分同期用、行番号は1始まり）"""
+        if not self.service:
+            raise Exception("Google Sheetsサービスが利用できません")
+
+        try:
+            # シート名が指定されていない場合は最初のシートを使用
+            if not sheet_name:
+                spreadsheet = self.service.spreadsheets().get(spreadsheetId=spreadsheet_id).execute()
+                sheet_name = spreadsheet['sheets'][0]['properties']['title']
+
+            result = self.service.spreadsheets().values().get(
+                spreadsheetId=spreadsheet_id,
+                range=f"{sheet_name}!A:Z"  # A列からZ列まで
+            ).execute()
+
+            values = result.get('values', [])
+            return {
+                'sheet_name': sheet_name,
+                'headers': [str(h) for h in values[0]] if values else [],
+                'rows': [(row_number, row) for row_number, row in enumerate(values[1:], start=2)]
+            }
+
+        except HttpError as error:
+            print(f'スプレッドシート読み込みエラー: {error}')
+            raise Exception(f"スプレッドシート読み込み失敗: {str(error)}")
+
     def get_spreadsheet_info(self, spreadsheet_id: str) -> Dict:
         """スプレッドシートの情報を取得"""
         if not self.service:
@@ -0,0 +1,316 @@
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Optional
+import asyncio
+import hashlib
+import json
+import threading
+import time
+import numpy as np
+from atomic_files import atomic_write
+from config import Config
+from course_index import CourseIndex
+
+try:
+    import fcntl
+except ImportError:  # Windowsではプロセス間のロックなし（スレッド間のロックのみ）
+    fcntl = None
+
+class SpreadsheetSync:
+    """連携中のGoogleスプレッドシートの差分同期
+
+    1行を1チャンク（長い行は分割）として、チャンクごとに行のハッシュを持たせておく。
+    再読み込み時は前回と同じハッシュの行は保存済みの埋め込みをそのまま使い、
+    追加・変更された行だけをベクトル化し、なくなった行は取り除く。
+    チャンクの本文には行番号を含めないので、行の挿入で後ろの行がずれても再ベクトル化しない。
+    同じスプレッドシートの同期はファイルロックでワーカープロセス間でも1つずつ行い、
+    自動更新はロックを取れた1プロセスだけが行う。
+    """
+
+    def __init__(self, spreadsheet_service, excel_processor, course_manager):
+        self.spreadsheet_service = spreadsheet_service
+        self.excel_processor = excel_processor
+        self.course_manager = course_manager
+        self.vector_store = excel_processor.vector_store
+        self._locks: Dict[str, threading.Lock] = {}
+        self._locks_lock = threading.Lock()
+        # 連携中のシートの情報（シート名 -> (コースのバージョン, サイドカーから読んだ情報)）
+        self._sheet_info: Dict[str, tuple] = {}
+        # 自動更新を受け持つプロセスが持ち続けるロックファイル
+        self._scheduler_lock_file = None
+
+    @staticmethod
+    def vector_name(course_id: str, spreadsheet_id: str) -> str:
+        return f"{course_id}_spreadsheet_{spreadsheet_id}"
+
+    @staticmethod
+    def row_hash(row_text: str) -> str:
+        return hashlib.sha256(row_text.encode("utf-8")).hexdigest()[:16]
+
+    def sync_state_path(self, name: str) -> Path:
+        """シートの同期状態（最後に確認した日時）のパス"""
+        return self.vector_store.manifest_dir / f".{name}.sync.json"
+
+    def load_sync_state(self, name: str) -> Dict:
+        try:
+            with open(self.sync_state_path(name), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            print(f"同期状態の読み込みエラー ({name}): {e}")
+            return {}
+
+    def save_sync_state(self, name: str, checked_at: float):
+        # 変更がなく保存しなかった同期も記録し、再起動後に全シートを一斉に読み直さないようにする
+        # （コースのバージョンは上げない）
+        with atomic_write(self.sync_state_path(name), "w", encoding="utf-8") as f:
+            json.dump({"checked_at": checked_at}, f)
+
+    def _lock_for(self, name: str) -> threading.Lock:
+        with self._locks_lock:
+            return self._locks.setdefault(name, threading.Lock())
+
+    @contextmanager
+    def _sheet_locked(self, name: str):
+        # 別のワーカープロセスが同じシートを同時に書き換えないよう、ファイルロックも取る
+        with self._lock_for(name):
+            if fcntl is None:
+                yield
+                return
+            self.vector_store.manifest_dir.mkdir(parents=True, exist_ok=True)
+            with open(self.vector_store.manifest_dir / f".{name}.sync.lock", "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _is_scheduler(self) -> bool:
+        """自動更新を受け持つプロセスか（ロックを取れなければ他のプロセスが受け持っている）
+
+        受け持ちのプロセスが終了するとロックが外れ、次の確認で別のプロセスが引き継ぐ。
+        """
+        if fcntl is None or self._scheduler_lock_file is not None:
+            return True
+        self.vector_store.manifest_dir.mkdir(parents=True, exist_ok=True)
+        lock_file = open(self.vector_store.manifest_dir / ".spreadsheet_scheduler.lock", "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._scheduler_lock_file = lock_file
+        return True
+
+    def build_chunks(self, sheet: Dict) -> List[tuple]:
+        """行を(チャンク, メタ情報)の列にする（メタ情報は行番号と行のハッシュ）"""
+        sheet_name = sheet["sheet_name"]
+        chunker = self.excel_processor.chunker
+        chunks = []
+        for row_number, values in sheet["rows"]:
+            row_text = self.excel_processor.format_row(sheet["headers"], values)
+            if not row_text:
+                continue
+            meta = {"sheet": sheet_name, "row": row_number, "row_hash": self.row_hash(row_text)}
+            header = f"シート名: {sheet_name}\n"
+            if chunker.count_tokens(header + row_text) <= chunker.max_tokens:
+                chunks.append((header + row_text, meta))
+            else:
+                chunks.extend((header + piece, meta) for piece in chunker.split(row_text))
+        return chunks
+
+    def sync(self, course_id: str, spreadsheet_id: str, sheet_name: Optional[str] = None) -> Dict:
+        """スプレッドシートを読み込み、変わった行だけ再ベクトル化して保存"""
+        name = self.vector_name(course_id, spreadsheet_id)
+        with self._sheet_locked(name):
+            started_at = time.perf_counter()
+            sheet = self.spreadsheet_service.read_spreadsheet_rows(spreadsheet_id, sheet_name)
+            chunks = self.build_chunks(sheet)
+            if not chunks:
+                raise Exception("スプレッドシートにデータがありません")
+
+            # 前回保存分の埋め込みを行のハッシュで引けるようにする（次元数の設定が変わっていれば使わない）
+            dimensions = self.vector_store.embedding_dimensions(course_id)
+            previous = self.vector_store.load(name)
+            if previous and previous.get("embedding_dimensions") != dimensions:
+                previous = None
+            previous_rows: Dict[str, List[int]] = {}
+            previous_chunks: Dict[str, List[str]] = {}
+            if previous and previous.get("chunk_meta") and previous.get("dim"):
+                for i, meta in enumerate(previous["chunk_meta"]):
+                    row_hash = meta.get("row_hash")
+                    if row_hash:
+                        previous_rows.setdefault(row_hash, []).append(i)
+                        previous_chunks.setdefault(row_hash, []).append(self.vector_store.get_chunk(previous, i))
+
+            texts = [chunk for chunk, _ in chunks]
+            chunk_meta = [meta for _, meta in chunks]
+            current_chunks: Dict[str, List[str]] = {}
+            for text, meta in chunks:
+                current_chunks.setdefault(meta["row_hash"], []).append(text)
+            reuse = {}
+            for row_hash, indices in previous_rows.items():
+                # 見出しが変わった場合などチャンクの本文が違えば使わない
+                if current_chunks.get(row_hash) == previous_chunks[row_hash]:
+                    reuse[row_hash] = indices
+
+            seen = {}
+            reused_positions = []
+            missing_positions = []
+            for position, meta in enumerate(chunk_meta):
+                row_hash = meta["row_hash"]
+                indices = reuse.get(row_hash)
+                k = seen.get(row_hash, 0)
+                seen[row_hash] = k + 1
+                if indices is not None and k < len(indices):
+                    reused_positions.append((position, indices[k]))
+                else:
+                    missing_positions.append(position)
+
+            # なくなったハッシュのうち、新しいハッシュと対になる分は変更された行として数える
+            added_hashes = len(set(current_chunks) - set(previous_rows))
+            dropped_hashes = len(set(previous_rows) - set(current_chunks))
+            changed_rows = min(added_hashes, dropped_hashes)
+            unchanged = (
+                previous is not None
+                and not missing_positions
+                and [p for _, p in reused_positions] == list(range(previous.get("count", 0)))
+                and previous.get("sheet_name") == sheet["sheet_name"]
+            )
+
+            embedding_stats = None
+            ann = None
+            if not unchanged:
+                new_embeddings, embedding_stats = self.excel_processor.embedder.embed(
+                    [texts[p] for p in missing_positions], dimensions=dimensions
+                )
+                dim = len(new_embeddings[0]) if new_embeddings else int(previous["dim"])
+                matrix = np.empty((len(texts), dim), dtype=np.float32)
+                for position, previous_index in reused_positions:
+                    matrix[position] = previous["matrix"][previous_index]
+                for position, embedding in zip(missing_positions, new_embeddings):
+                    matrix[position] = embedding
+
+                info = {
+                    "course_id": course_id,
+                    "spreadsheet_id": spreadsheet_id,
+                    "sheet_name": sheet["sheet_name"],
+                    "source_type": "spreadsheet",
+                    "embedding_model": self.excel_processor.embedder.model,
+                    "embedding_dimensions": dimensions,
+                    "synced_at": time.time(),
+                    "metadata": {
+                        "chunk_count": len(texts),
+                        "total_text_length": sum(len(t) for t in texts),
+                        "is_realtime": True
+                    }
+                }
+                self.vector_store.save(name, texts, matrix, info, chunk_meta)
+                ann = CourseIndex.rebuild_ann(self.vector_store, course_id)
+            self.save_sync_state(name, time.time())
+
+            return {
+                "course_id": course_id,
+                "spreadsheet_id": spreadsheet_id,
+                "sheet_name": sheet["sheet_name"],
+                "vector_file": str(self.vector_store.matrix_path(name)),
+                "chunk_count": len(texts),
+                "text_length": sum(len(t) for t in texts),
+                "changed": not unchanged,
+                "rows": {
+                    "total": len(sheet["rows"]),
+                    "embedded_chunks": len(missing_positions),
+                    "reused_chunks": len(reused_positions),
+                    "added_rows": added_hashes - changed_rows,
+                    "changed_rows": changed_rows,
+                    "removed_rows": dropped_hashes - changed_rows
+                },
+                "seconds": round(time.perf_counter() - started_at, 3),
+                "ann": ann,
+                "embeddings": embedding_stats
+            }
+
+    def last_synced_at(self, name: str, info: Dict) -> float:
+        checked_at = self.load_sync_state(name).get("checked_at") or 0.0
+        return max(checked_at, info.get("synced_at") or 0.0)
+
+    def sheet_info(self, name: str, versions: Dict[str, Optional[int]]) -> Optional[Dict]:
+        """シートの情報（コースのバージョンが変わっていなければサイドカーを読み直さない）"""
+        course_id = name.split("_spreadsheet_", 1)[0]
+        if course_id not in versions:
+            versions[course_id] = self.vector_store.course_version(course_id)
+        version = versions[course_id]
+        cached = self._sheet_info.get(name)
+        if cached is not None and version is not None and cached[0] == version:
+            return cached[1]
+
+        data = self.vector_store.load(name)
+        if not data or data.get("source_type") != "spreadsheet":
+            self._sheet_info.pop(name, None)
+            return None
+        info = {
+            "course_id": data["course_id"],
+            "spreadsheet_id": data["spreadsheet_id"],
+            "sheet_name": data.get("sheet_name"),
+            "chunk_count": data.get("count", 0),
+            "synced_at": data.get("synced_at")
+        }
+        if data["course_id"] == course_id:
+            self._sheet_info[name] = (version, info)
+        return info
+
+    def linked_sheets(self, course_id: Optional[str] = None) -> List[Dict]:
+        """連携中のスプレッドシート一覧（同期日時・次回の自動更新予定付き）"""
+        pattern = f"{course_id}_spreadsheet_*" if course_id else "*_spreadsheet_*"
+        sheets = []
+        versions: Dict[str, Optional[int]] = {}
+        for name in self.vector_store.list_names(pattern):
+            info = self.sheet_info(name, versions)
+            if info is None:
+                continue
+            interval = self.refresh_minutes(info["course_id"])
+            synced_at = self.last_synced_at(name, info)
+            sheets.append({
+                "name": name,
+                "course_id": info["course_id"],
+                "spreadsheet_id": info["spreadsheet_id"],
+                "sheet_name": info["sheet_name"],
+                "chunk_count": info["chunk_count"],
+                "synced_at": synced_at or None,
+                "refresh_minutes": interval,
+                "next_refresh_at": synced_at + interval * 60 if interval and synced_at else None
+            })
+        return sheets
+
+    def refresh_minutes(self, course_id: str) -> int:
+        """コースの自動更新間隔（分、0は自動更新しない）"""
+        course = self.course_manager.get_course(course_id) or {}
+        minutes = course.get("spreadsheet_refresh_minutes")
+        return Config.SPREADSHEET_REFRESH_MINUTES if minutes is None else int(minutes)
+
+    def refresh_due(self) -> List[Dict]:
+        """自動更新の時刻を過ぎたスプレッドシートを同期"""
+        results = []
+        now = time.time()
+        for sheet in self.linked_sheets():
+            if not sheet["refresh_minutes"] or (sheet["next_refresh_at"] or 0) > now:
+                continue
+            try:
+                results.append(self.sync(sheet["course_id"], sheet["spreadsheet_id"], sheet["sheet_name"]))
+            except Exception as e:
+                print(f"スプレッドシート自動更新エラー（{sheet['name']}）: {e}")
+        return results
+
+    async def run_scheduler(self):
+        """連携中のスプレッドシートをコースごとの間隔で自動更新（バックグラウンドタスク）"""
+        while True:
+            try:
+                results = await asyncio.to_thread(self.refresh_due) if self._is_scheduler() else []
+                for result in results:
+                    if result["changed"]:
+                        print(f"スプレッドシート自動更新: {result['course_id']} {result['spreadsheet_id']} "
+                              f"{result['rows']}")
+            except Exception as e:
+                print(f"スプレッドシート自動更新エラー: {e}")
+            await asyncio.sleep(Config.SPREADSHEET_SYNC_CHECK_SECONDS)
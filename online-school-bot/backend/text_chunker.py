@@ -0,0 +1,100 @@
+from collections import deque
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+import re
+from config import Config
+
+try:
+    import tiktoken
+except ImportError:  # tiktokenがない環境では文字数から概算する
+    tiktoken = None
+
+# 文末（。！？!?）と改行の直後で区切る
+_SENTENCE_END = re.compile(r"(?<=[。！？!?\n])")
+_ASCII = re.compile(r"[\x00-\x7f]")
+
+class TextChunker:
+    """文単位のチャンク分割（PDF・Excel共通）
+
+    日本語の文末記号と改行で文に分け、トークン数の上限まで文を詰めてチャンクにする。
+    各文のトークン数は1回だけ数え、オーバーラップは直前のチャンク末尾の文を
+    dequeから取り出して再利用するため、全体で入力長に対して線形時間で動く。
+    """
+
+    def __init__(self, max_tokens: Optional[int] = None, overlap_tokens: Optional[int] = None):
+        self.max_tokens = max_tokens or Config.CHUNK_MAX_TOKENS
+        self.overlap_tokens = Config.CHUNK_OVERLAP_TOKENS if overlap_tokens is None else overlap_tokens
+        if self.overlap_tokens >= self.max_tokens:
+            raise ValueError("overlap_tokensはmax_tokensより小さくしてください")
+        self._encoding = None
+        if tiktoken is not None:
+            try:
+                self._encoding = tiktoken.encoding_for_model(Config.EMBEDDING_MODEL)
+            except Exception:
+                self._encoding = tiktoken.get_encoding("cl100k_base")
+
+    def count_tokens(self, text: str) -> int:
+        """トークン数（tiktokenがなければ英数字4文字・それ以外1文字を1トークンとして概算）"""
+        if self._encoding is not None:
+            return len(self._encoding.encode_ordinary(text))
+        ascii_chars = len(_ASCII.findall(text))
+        return (ascii_chars + 3) // 4 + (len(text) - ascii_chars)
+
+    def split_sentences(self, text: str) -> List[str]:
+        """文に分割（区切り文字は文の末尾に残す）"""
+        return [s for s in _SENTENCE_END.split(text) if s.strip()]
+
+    def _pieces(self, sentence: str) -> Iterable[Tuple[str, int]]:
+        """文とトークン数（上限を超える長い文は文字数の比率で分割）"""
+        tokens = self.count_tokens(sentence)
+        if tokens <= self.max_tokens:
+            yield sentence, tokens
+            return
+        size = max(1, len(sentence) * self.max_tokens // tokens)
+        for start in range(0, len(sentence), size):
+            piece = sentence[start:start + size]
+            yield piece, self.count_tokens(piece)
+
+    def iter_segments(self, segments: Iterable[Tuple[Dict, str]]) -> Iterator[Tuple[str, Dict]]:
+        """(メタ情報, テキスト)の列を順に読み、チャンクができるたびに(チャンク, 開始位置のメタ情報)を返す"""
+        window = deque()  # (文, トークン数, メタ情報)
+        window_tokens = 0
+        new_since_emit = False
+
+        def emit():
+            text = "".join(piece for piece, _, _ in window).strip()
+            return (text, window[0][2]) if text else None
+
+        for meta, text in segments:
+            for sentence in self.split_sentences(text):
+                for piece, tokens in self._pieces(sentence):
+                    if window_tokens + tokens > self.max_tokens and new_since_emit:
+                        chunk = emit()
+                        if chunk:
+                            yield chunk
+                        new_since_emit = False
+                        # 末尾の文をオーバーラップとして残す
+                        while window and (window_tokens > self.overlap_tokens
+                                          or window_tokens + tokens > self.max_tokens):
+                            window_tokens -= window.popleft()[1]
+                    window.append((piece, tokens, meta))
+                    window_tokens += tokens
+                    new_since_emit = True
+
+        if new_since_emit:
+            chunk = emit()
+            if chunk:
+                yield chunk
+
+    def split_segments(self, segments: Iterable[Tuple[Dict, str]]) -> Tuple[List[str], List[Dict]]:
+        """(メタ情報, テキスト)の列をチャンクに分割し、各チャンクの開始位置のメタ情報を返す"""
+        chunks = []
+        chunk_meta = []
+        for text, meta in self.iter_segments(segments):
+            chunks.append(text)
+            chunk_meta.append(meta)
+        return chunks, chunk_meta
+
+    def split(self, text: str) -> List[str]:
+        """テキストをチャンクに分割"""
+        chunks, _ = self.split_segments([({}, text)])
+        return chunks
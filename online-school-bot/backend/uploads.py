@@ -0,0 +1,73 @@
+from pathlib import Path
+from typing import Dict, Optional
+import asyncio
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import uuid
+from fastapi import HTTPException, UploadFile
+from config import Config
+
+_UNSAFE_CHARS = re.compile(r'[\\/:*?"<>|\x00-\x1f]')
+
+def safe_filename(filename: Optional[str], default_suffix: str = "") -> str:
+    """保存用のファイル名（ディレクトリ部分や使えない文字を除く）"""
+    name = _UNSAFE_CHARS.sub("_", Path(filename or "").name).strip(" .")
+    return name or f"upload{default_suffix}"
+
+async def save_upload_stream(file: UploadFile, dest_dir: Path, filename: Optional[str] = None,
+                             max_bytes: Optional[int] = None) -> Dict:
+    """アップロードを一定サイズずつ読み、保存先へ直接書き込む
+
+    ファイル全体をメモリに載せず、一時ファイルからのコピーもしない。
+    書き込みと同時にSHA-256を計算し、上限サイズを超えた時点で中断して413を返す。
+    書き込み中は.partファイルに書き、完了してから本来の名前に置き換える。
+    """
+    max_bytes = max_bytes or Config.UPLOAD_MAX_BYTES
+    dest_dir.mkdir(parents=True, exist_ok=True)
+    path = dest_dir / (filename or safe_filename(file.filename))
+    part_path = dest_dir / f".{path.name}.{uuid.uuid4().hex}.part"
+
+    sha256 = hashlib.sha256()
+    size = 0
+    try:
+        with open(part_path, "wb") as f:
+            while True:
+                chunk = await file.read(Config.UPLOAD_CHUNK_BYTES)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise HTTPException(
+                        status_code=413,
+                        detail=f"ファイルサイズが上限（{max_bytes // (1024 * 1024)}MB）を超えています"
+                    )
+                sha256.update(chunk)
+                await asyncio.to_thread(f.write, chunk)
+        os.replace(part_path, path)
+    finally:
+        if part_path.exists():
+            part_path.unlink()
+        await file.close()
+
+    return {"path": path, "size": size, "sha256": sha256.hexdigest()}
+
+async def stage_upload(file: UploadFile, max_bytes: Optional[int] = None) -> Dict:
+    """アップロードをジョブ専用の一時ディレクトリ（CACHE_DIR/uploads/…）に保存
+
+    コースのディレクトリには取り込みに成功してから移すので、再アップロードが失敗しても
+    取り込み済みの教材や取り込み中のジョブの元ファイルは置き換わらない。
+    一時ディレクトリ（戻り値のstaging_dir）はジョブの終了後に呼び出し側で消す。
+    """
+    staging_root = Config.CACHE_DIR / "uploads"
+    staging_root.mkdir(parents=True, exist_ok=True)
+    staging_dir = Path(tempfile.mkdtemp(dir=staging_root))
+    try:
+        upload = await save_upload_stream(file, staging_dir, max_bytes=max_bytes)
+    except BaseException:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+    upload["staging_dir"] = staging_dir
+    return upload
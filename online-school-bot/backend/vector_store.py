@@ -0,0 +1,311 @@
+import numpy as np
+from pathlib import Path
+from typing import List, Dict, Optional
+from contextlib import contextmanager
+import json
+import threading
+import time
+from atomic_files import atomic_write
+from config import Config
+from index_cache import course_index_cache
+from index_snapshot import IndexSnapshots
+from lexical_index import BM25Postings
+
+try:
+    import fcntl
+except ImportError:  # Windowsではプロセス間のロックなし（スレッド間のロックのみ）
+    fcntl = None
+
+# マニフェストの読み書きをプロセス内で直列化する
+_manifest_lock = threading.Lock()
+
+class VectorStore:
+    """ベクトルデータのバイナリ保存（正規化済みfloat32の.npy + チャンクのサイドカー）
+
+    ファイルはすべて一時ファイルに書いてfsyncしてから置き換えるので、検索中の読み込みが
+    書きかけのファイルを見ることはない。教材はBM25・行列・サイドカーの順に書き、
+    サイドカーの置き換えを保存の完了とする。
+    コースごとのマニフェスト（manifests/{course_id}.json）のバージョンは教材・検索設定・
+    近似最近傍インデックスを書き換えるたびに1つ上がり、キャッシュはこの値で更新を判定する。
+    """
+
+    MATRIX_SUFFIX = ".npy"
+    SIDECAR_SUFFIX = ".chunks.json"
+    LEXICAL_SUFFIX = ".bm25.npz"
+    # サイドカーと行列の件数が合わないとき（保存の途中）に読み直す回数と間隔
+    LOAD_RETRIES = 3
+    LOAD_RETRY_SECONDS = 0.05
+
+    def __init__(self, vector_dir: Optional[Path] = None):
+        self.vector_dir = Path(vector_dir) if vector_dir else Config.VECTOR_STORAGE_DIR
+        self.vector_dir.mkdir(parents=True, exist_ok=True)
+        self.ann_dir = self.vector_dir / "ann"
+        self.ann_dir.mkdir(parents=True, exist_ok=True)
+        # ワーカー間で共有する連結済み行列（コースインデックスのスナップショット）
+        self.snapshots = IndexSnapshots(self.vector_dir / "published")
+        self.manifest_dir = self.vector_dir / "manifests"
+        self.manifest_dir.mkdir(parents=True, exist_ok=True)
+        self.migrate_legacy_files()
+
+    def matrix_path(self, name: str) -> Path:
+        """埋め込み行列ファイルのパス"""
+        return self.vector_dir / f"{name}{self.MATRIX_SUFFIX}"
+
+    def sidecar_path(self, name: str) -> Path:
+        """チャンクテキスト（サイドカー）ファイルのパス"""
+        return self.vector_dir / f"{name}{self.SIDECAR_SUFFIX}"
+
+    def lexical_path(self, name: str) -> Path:
+        """BM25転置インデックスファイルのパス"""
+        return self.vector_dir / f"{name}{self.LEXICAL_SUFFIX}"
+
+    def ann_path(self, course_id: str) -> Path:
+        """コースの近似最近傍インデックスのパス"""
+        return self.ann_dir / f"{course_id}.ivf.npz"
+
+    def search_settings_path(self, course_id: str) -> Path:
+        """コースの検索設定のパス"""
+        return self.ann_dir / f"{course_id}.settings.json"
+
+    def manifest_path(self, course_id: str) -> Path:
+        """コースのマニフェスト（バージョン番号）のパス"""
+        return self.manifest_dir / f"{course_id}.json"
+
+    def load_manifest(self, course_id: str) -> Optional[Dict]:
+        """コースのマニフェストを読み込み（まだ一度も書き込みがなければNone）"""
+        try:
+            with open(self.manifest_path(course_id), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"マニフェストの読み込みエラー ({course_id}): {e}")
+            return None
+
+    def course_version(self, course_id: str) -> Optional[int]:
+        """コースのバージョン番号（マニフェストがなければNone）"""
+        manifest = self.load_manifest(course_id)
+        return manifest.get("version") if manifest else None
+
+    @contextmanager
+    def _manifest_locked(self):
+        # 複数のワーカープロセスが同時に番号を上げても取りこぼさないよう、ファイルロックも取る
+        with _manifest_lock:
+            if fcntl is None:
+                yield
+                return
+            with open(self.manifest_dir / ".lock", "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def bump_version(self, course_id: str) -> int:
+        """コースのバージョンを1つ上げる（教材・設定・インデックスを書き換えた後に呼ぶ）
+
+        コースの教材がなくなってもマニフェストは消さない（番号が1に戻ると、
+        古い内容を読み込んだキャッシュが最新と判定されてしまうため）。
+        """
+        with self._manifest_locked():
+            manifest = self.load_manifest(course_id) or {"course_id": course_id, "version": 0}
+            manifest["version"] = int(manifest.get("version", 0)) + 1
+            manifest["updated_at"] = time.time()
+            manifest["materials"] = sorted(self.list_names(f"{course_id}_*"))
+            with atomic_write(self.manifest_path(course_id), "w", encoding="utf-8") as f:
+                json.dump(manifest, f, ensure_ascii=False, indent=2)
+        course_index_cache.invalidate(course_id)
+        return manifest["version"]
+
+    def load_search_settings(self, course_id: str) -> Dict:
+        """コースの検索設定（ann: auto/on/off、nprobe、nlist、quantize、rerank_candidates、embedding_dimensions）を読み込み"""
+        settings = {
+            "ann": "auto",
+            "nprobe": Config.ANN_DEFAULT_NPROBE,
+            "nlist": None,
+            "quantize": Config.QUANTIZE_INT8,
+            "rerank_candidates": Config.QUANTIZE_RERANK_CANDIDATES,
+            "embedding_dimensions": Config.EMBEDDING_DIMENSIONS or None
+        }
+        path = self.search_settings_path(course_id)
+        if path.exists():
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    settings.update(json.load(f))
+            except Exception as e:
+                print(f"検索設定の読み込みエラー ({course_id}): {e}")
+        return settings
+
+    def embedding_dimensions(self, course_id: str) -> Optional[int]:
+        """コースの教材・質問をベクトル化するときの次元数（Noneはモデルの既定）"""
+        return self.load_search_settings(course_id).get("embedding_dimensions") or None
+
+    def save_search_settings(self, course_id: str, settings: Dict):
+        """コースの検索設定を保存"""
+        with atomic_write(self.search_settings_path(course_id), "w", encoding="utf-8") as f:
+            json.dump(settings, f, ensure_ascii=False, indent=2)
+        self.bump_version(course_id)
+
+    @staticmethod
+    def normalize(embeddings) -> np.ndarray:
+        """float32に変換してL2正規化（ゼロベクトルはそのまま）"""
+        matrix = np.asarray(embeddings, dtype=np.float32)
+        if matrix.ndim == 1:
+            matrix = matrix.reshape(1, -1)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return matrix / norms
+
+    def save(self, name: str, chunks: List[str], embeddings: List[List[float]], info: Dict,
+             chunk_meta: Optional[List[Dict]] = None, update_version: bool = True) -> Path:
+        """チャンクと埋め込みを保存（chunk_metaはチャンクごとのページ・シート情報）
+
+        update_version=Falseならコースのバージョンを上げない（一括取り込みで最後に1回だけ上げる場合）。
+        それまでは読み込み済みのインデックスが置き換え前のファイルのmmapで検索を続ける。
+        """
+        if len(chunks) != len(embeddings):
+            raise Exception(f"チャンク数と埋め込み数が一致しません: {len(chunks)} != {len(embeddings)}")
+
+        matrix = self.normalize(embeddings) if len(embeddings) else np.zeros((0, 0), dtype=np.float32)
+        # 同じチャンクからBM25の転置インデックスも作る
+        BM25Postings.build(chunks).save(self.lexical_path(name))
+
+        # キャッシュ中のmmapが壊れないよう、別ファイルに書いてから置き換える
+        matrix_path = self.matrix_path(name)
+        with atomic_write(matrix_path) as f:
+            np.save(f, matrix)
+
+        # チャンクは1つの文字列に連結し、各チャンクの開始位置を保持する
+        offsets = [0]
+        for chunk in chunks:
+            offsets.append(offsets[-1] + len(chunk))
+        sidecar = dict(info)
+        sidecar.update({
+            "name": name,
+            "dim": int(matrix.shape[1]) if matrix.size else 0,
+            "count": len(chunks),
+            "offsets": offsets,
+            "text": "".join(chunks)
+        })
+        if chunk_meta is not None:
+            sidecar["chunk_meta"] = chunk_meta
+        # サイドカーの置き換えで保存が完了する（読む側は件数が行列と合うかで確認する）
+        with atomic_write(self.sidecar_path(name), "w", encoding="utf-8") as f:
+            json.dump(sidecar, f, ensure_ascii=False, separators=(",", ":"))
+
+        if update_version:
+            course_index_cache.invalidate_material(name)
+            if info.get("course_id"):
+                self.bump_version(info["course_id"])
+        return matrix_path
+
+    def load(self, name: str) -> Optional[Dict]:
+        """埋め込み行列をmmapで開き、サイドカーと合わせて返す
+
+        行列とサイドカーは別々に置き換わるため、保存の途中だと新しい行列と古いサイドカーを
+        組み合わせて読むことがある。件数・次元数が合わなければ少し待って読み直す。
+        """
+        matrix_path = self.matrix_path(name)
+        sidecar_path = self.sidecar_path(name)
+        for attempt in range(self.LOAD_RETRIES):
+            if not matrix_path.exists() or not sidecar_path.exists():
+                return None
+            with open(sidecar_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            matrix = np.load(matrix_path, mmap_mode="r")
+            count = data.get("count", 0)
+            if matrix.shape[0] == count and (not count or matrix.shape[1] == data.get("dim", matrix.shape[1])):
+                data["matrix"] = matrix
+                return data
+            del matrix
+            time.sleep(self.LOAD_RETRY_SECONDS)
+        print(f"行列とサイドカーの件数が一致しないため読み込みをスキップ ({name})")
+        return None
+
+    def load_lexical(self, name: str, data: Dict) -> BM25Postings:
+        """BM25転置インデックスを読み込み（古いデータでファイルがなければ作成して保存）"""
+        postings = BM25Postings.load(self.lexical_path(name))
+        if postings is None or postings.doc_count != data.get("count", 0):
+            postings = BM25Postings.build(self.get_chunks(data))
+            postings.save(self.lexical_path(name))
+        return postings
+
+    def list_names(self, pattern: str) -> List[str]:
+        """パターンに一致する保存名の一覧（更新日時の新しい順）"""
+        matrix_files = sorted(
+            self.vector_dir.glob(f"{pattern}{self.MATRIX_SUFFIX}"),
+            key=lambda p: p.stat().st_mtime,
+            reverse=True
+        )
+        return [p.name[:-len(self.MATRIX_SUFFIX)] for p in matrix_files]
+
+    def material_stat(self, name: str) -> tuple:
+        """行列ファイルの状態（置き換えるとinodeが変わるので、同じ更新日時でも区別できる）"""
+        stat = self.matrix_path(name).stat()
+        return (name, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def course_signature(self, course_id: str) -> tuple:
+        """コースの更新状態（キャッシュの無効化判定用）
+
+        マニフェストがあればそのバージョン番号だけを返す（ファイルを1つ読むだけで済む）。
+        マニフェストを作る前に保存されたコースは、従来どおりファイルの更新日時から作る。
+        """
+        version = self.course_version(course_id)
+        if version is not None:
+            return ("version", version)
+        signature = []
+        for path in sorted(self.vector_dir.glob(f"{course_id}_*{self.MATRIX_SUFFIX}")):
+            name = path.name[:-len(self.MATRIX_SUFFIX)]
+            try:
+                matrix_stat = path.stat()
+                sidecar_stat = self.sidecar_path(name).stat()
+            except FileNotFoundError:
+                continue
+            signature.append((name, matrix_stat.st_mtime_ns, matrix_stat.st_size, sidecar_stat.st_mtime_ns))
+        for path in (self.ann_path(course_id), self.search_settings_path(course_id)):
+            if path.exists():
+                signature.append((path.name, path.stat().st_mtime_ns))
+        return tuple(signature)
+
+    def delete(self, name: str):
+        """保存データを削除（サイドカーから先に消すので、読む側は削除途中の教材を読まない）"""
+        course_id = None
+        try:
+            with open(self.sidecar_path(name), "r", encoding="utf-8") as f:
+                course_id = json.load(f).get("course_id")
+        except Exception:
+            pass
+        for path in (self.sidecar_path(name), self.matrix_path(name), self.lexical_path(name)):
+            if path.exists():
+                path.unlink()
+        course_index_cache.invalidate_material(name)
+        if course_id:
+            self.bump_version(course_id)
+
+    @staticmethod
+    def get_chunk(data: Dict, index: int) -> str:
+        """サイドカーからチャンクテキストを取り出す"""
+        offsets = data["offsets"]
+        return data["text"][offsets[index]:offsets[index + 1]]
+
+    @classmethod
+    def get_chunks(cls, data: Dict) -> List[str]:
+        """全チャンクテキストを取り出す"""
+        return [cls.get_chunk(data, i) for i in range(data.get("count", 0))]
+
+    def migrate_legacy_files(self):
+        """旧形式（埋め込みを含むJSON）のファイルをバイナリ形式に変換"""
+        for legacy_file in self.vector_dir.glob("*.json"):
+            if legacy_file.name.endswith(self.SIDECAR_SUFFIX):
+                continue
+            try:
+                with open(legacy_file, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                if "embeddings" not in data or "chunks" not in data:
+                    continue
+                chunks = data.pop("chunks")
+                embeddings = data.pop("embeddings")
+                self.save(legacy_file.stem, chunks, embeddings, data)
+                legacy_file.unlink()
+            except Exception as e:
+                print(f"旧形式ベクトルファイルの変換エラー ({legacy_file.name}): {e}")
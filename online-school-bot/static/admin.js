@@ -209,6 +209,32 @@ function changeMaterialType() {
     }
 }
 
+// 取り込みジョブの完了を待つ（進捗をonProgressに渡す）
+async function waitForJob(jobId, onProgress) {
+    while (true) {
+        const data = await apiCall(`/jobs/${jobId}`);
+        const job = data.job;
+        if (job.status === 'succeeded') {
+            return job.result;
+        }
+        if (job.status === 'failed') {
+            throw new Error(job.error || '取り込みに失敗しました');
+        }
+        if (onProgress) {
+            onProgress(job);
+        }
+        await new Promise(resolve => setTimeout(resolve, 1000));
+    }
+}
+
+function formatJobProgress(job) {
+    const progress = job.progress;
+    if (job.stage === 'embedding' && progress.chunks_total) {
+        return `${job.stage_label} ${progress.chunks_done} / ${progress.chunks_total} チャンク`;
+    }
+    return job.stage_label;
+}
+
 // 教材をアップロード（PDF/Excel/CSV）
 async function uploadMaterial() {
     const courseId = document.getElementById('courseSelect').value;
@@ -258,7 +284,10 @@ async function uploadMaterial() {
         }
         
         const data = await response.json();
-        statusDiv.innerHTML = `<div class="success">${materialType.toUpperCase()}ファイルのアップロードが完了しました！<br>チャンク数: ${data.data.chunk_count}</div>`;
+        const result = await waitForJob(data.job_id, job => {
+            statusDiv.innerHTML = `<div>${formatJobProgress(job)}...</div>`;
+        });
+        statusDiv.innerHTML = `<div class="success">${materialType.toUpperCase()}ファイルのアップロードが完了しました！<br>チャンク数: ${result.chunk_count}</div>`;
         fileInput.value = '';
     } catch (error) {
         statusDiv.innerHTML = `<div class="error">エラー: ${error.message}</div>`;
@@ -399,10 +428,13 @@ async function uploadPDF() {
         }
         
         const data = await response.json();
+        const result = await waitForJob(data.job_id, job => {
+            document.getElementById('uploadStatus').innerHTML = `<div>${formatJobProgress(job)}...</div>`;
+        });
         document.getElementById('uploadStatus').innerHTML = `
             <div style="padding: 10px; background: #d4edda; color: #155724; border-radius: 4px; margin-top: 10px;">
                 PDFをアップロードしました！<br>
-                チャンク数: ${data.data.chunk_count}, テキスト長: ${data.data.text_length}
+                チャンク数: ${result.chunk_count}, テキスト長: ${result.text_length}
             </div>
         `;
         fileInput.value = '';